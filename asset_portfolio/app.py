@@ -1,4 +1,5 @@
 import os
+import math
 import datetime 
 import pandas as pd
 
@@ -22,7 +23,7 @@ from bokeh.server.server import Server
 from bokeh.themes import Theme
 from tornado.ioloop import IOLoop
 from bokeh.palettes import inferno
-from bokeh.transform import factor_cmap, dodge
+from bokeh.transform import factor_cmap, dodge, cumsum
 
 from bokeh.core.properties import value
 
@@ -40,14 +41,24 @@ from models import (Security, Transaction, Broker,
                     Event, CryptoCurrency, CryptoWallet,
                     Position,)
 from models import init_tables
+from migrate_database import migrate_database
 from forms import (CryptoWalletForm, RegisterBrokerForm, 
                    TransactionsForm, CheckEntryForm)
-from command_engine import command_engine
-
-from tools import get_id_to_symbol_dict, get_symbol_to_id_dict
+from command_engine import parse_commands, CommandSyntaxError
+
+from tools import (get_id_to_symbol_dict, get_symbol_to_id_dict, get_positions_fingerprint,
+                   query_table_page, CHECK_ENTRIES_TABLES)
+from ledger_cache import get_cached, get_ledger_version
+from holdings_engine import get_cached_holdings_by_term
+from valuation_engine import get_valuation_engine
+from returns_engine import get_cached_returns
+from dividend_engine import get_cached_dividend_calendar, get_dividend_version, MONTHS
+from price_store import get_price_store
+from query_profiler import install_query_profiler
 
 from table_updaters import (update_transactions_table,
-                            update_positions_table,)
+                            incremental_update_positions_table,
+                            get_entity_resolver,)
 
 import yaml
 #=================================================
@@ -81,84 +92,60 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_URI
 FAKE_SECRET_KEY = 'super_duper_secure_key_1234'    #need secret key for CSRF from WTF-Forms to work
 app.config['SECRET_KEY'] = FAKE_SECRET_KEY
 
+app.config['QUERY_PROFILER_SLOW_SECONDS'] = 0.25   #statements slower than this are printed with their call site
+
 Bootstrap(app)
 db.init_app(app)
+install_query_profiler(app, db)     #X-Query-Count/X-Query-Time headers and /debug/queries (debug mode)
 
 with app.app_context():
     db.create_all()
+    migrate_database(db)    #indexes added after the tables were first created
 
 #==============================================================
 #                           ROUTES
 #==============================================================
 @app.route("/",methods=['GET','POST'])
 def home():
-    sym_dic = get_symbol_to_id_dict(db)
-    #update_positions_table(db,sym_dic.keys())
     form = TransactionsForm(request.form)
-    form_was_submitted = False
 
     if request.method == 'POST' and form.validate_on_submit():
-        form_was_submitted = True
         trans_str = form.transactions_str.data
 
-        #process the str command into dict of TransactionEvent objects
-        tickers_dict = command_engine(trans_str)  
+        #process the str command into a TransactionBatch (one list per column)
+        try:
+            batch = parse_commands(trans_str)
+        except CommandSyntaxError as e:
+            batch = None
+            form.transactions_str.errors.append(str(e))
 
-        #update relevant tables
-        update_transactions_table(db,tickers_dict)
-        update_positions_table(db,tickers_dict.keys())  #I could technically just send tickers_dict and it should work
+        if batch is not None:
+            #update relevant tables
+            update_transactions_table(db,batch)
+            incremental_update_positions_table(db,batch.symbols())
 
-    # This is the display portion
-    plot_fig = histogram_holdings()
-    if plot_fig is not None:
-        script, div = components(plot_fig)
+            #redirecting prevents the form from being re-submitted when the page is refreshed
+            return redirect(url_for("home"))
 
-        print()
-        print(f"\n * Script is:\n\t{script}\n")
-        print(f"\n * Div is:\n\t{div}\n")
-
-    else:
-        script = ''
-        div    = ''
+    # This is the display portion
+    script, div = get_home_chart_components()
     js_resources = ''  #INLINE.render_js()
     css_resources = '' #INLINE.render_css()
 
-    if form_was_submitted:
-        return redirect(url_for("home",
-                                js_resources=js_resources,
-                                css_resources=css_resources,
-                                form=form,
-                                script=script,
-                                div=div,))
-    else:
-        # render template
-        html = render_template(
-            'home.html',
-            js_resources=js_resources,
-            css_resources=css_resources,
-            form=form,
-            script=script,
-            div=div,
-        )
-        return html
+    # render template
+    html = render_template(
+        'home.html',
+        js_resources=js_resources,
+        css_resources=css_resources,
+        form=form,
+        script=script,
+        div=div,
+    )
+    return html
 
 @app.route("/holdings")
 def holdings():
-    sql_statement = db.session.query(Transaction).statement 
-    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
-
-    long_term_start = datetime.datetime.utcnow() - datetime.timedelta(days=366)
-    long_term_df  = df[df['time_execution']<=long_term_start]
-    short_term_df = df[df['time_execution']>long_term_start]
-    
-    #sum up all the shares; cost basis and others are not needed right now, but I think they should be added eventually
-    long_term_df  = long_term_df[['symbol_id','num_shares']].groupby('symbol_id').sum().reset_index()
-    short_term_df = short_term_df[['symbol_id','num_shares']].groupby('symbol_id').sum().reset_index()
-
-    #replacing symbol IDs with the corresponding symbol
-    id_symbols_dict = get_id_to_symbol_dict(db)
-    long_term_df  = long_term_df.replace({'symbol_id':id_symbols_dict})
-    short_term_df = short_term_df.replace({'symbol_id':id_symbols_dict})
+    long_term_df, short_term_df = get_cached_holdings_by_term(db)
     
     #setting up the values to send back
     tables_long_term = [long_term_df.to_html(classes='mystyle',index=False),]
@@ -173,6 +160,15 @@ def holdings():
                            tables_short_term=tables_short_term,
                            titles_short_term=titles_short_term,)
 
+@app.route("/dividends")
+def dividends():
+    script, div, annual_df = get_dividend_chart_components()
+    return render_template('dividends.html',
+                           script=script,
+                           div=div,
+                           tables=[annual_df.to_html(classes='mystyle',index=False),],
+                           total_income=annual_df['annual_income'].sum(),)
+
 @app.route('/wallet_registration',methods=['GET','POST'])
 def wallet_registration():
     form = CryptoWalletForm(request.form)
@@ -181,10 +177,8 @@ def wallet_registration():
         address  = form.address.data
         nickname = form.nickname.data
         symbol   = form.symbol.data.lower()
-        CURRENCY_object = get_cryptocurrency_object(symbol)
         WALLET_object = CryptoWallet(address,nickname)
-
-        CURRENCY_object.wallets.append(WALLET_object)
+        WALLET_object.cryptocurrency_id = get_entity_resolver(db).cryptocurrency_id(symbol)
         db.session.add(WALLET_object)
         db.session.commit()
         return redirect(url_for('home'))
@@ -205,57 +199,72 @@ def register_broker():
     #else:
     return render_template('register_broker.html',form=form)
 
+CHECK_ENTRIES_PARAMS = ('table','rows_to_show','columns','symbol','broker','date_from','date_to')
+
+def parse_date_param(value):
+    '''A yyyy-mm-dd value stays a date (so a `date_to` includes the whole day), anything else is a datetime'''
+    value = value.strip()
+    if len(value) == 10:
+        return datetime.date.fromisoformat(value)
+    return datetime.datetime.fromisoformat(value)
+
 @app.route('/check_entries',methods=['GET','POST'])
 def check_entries():
     form = CheckEntryForm(request.form)
-    tables = []
-    titles = []
     if request.method=='POST' and form.validate_on_submit():
-        table_to_show = form.table.data 
-        #print(f"\n\nTable name chosen: {table_to_show}, type={type(table_to_show)}\n\n")
-        if table_to_show == '0': #'securities':
-            sql_statement = db.session.query(Security).statement
-
-        elif table_to_show == '1': #'transactions':
-            sql_statement =db.session.query(Transaction).statement
-
-        elif table_to_show == '2': #'brokers':
-            sql_statement = db.session.query(Broker).statement
-
-        elif table_to_show == '3': #'crypto':
-            sql_statement = db.session.query(CryptoCurrency).statement
+        #the query lives in the url, so that next/prev links can carry it
+        params = {name:getattr(form, name).data for name in CHECK_ENTRIES_PARAMS}
+        params = {name:value for name,value in params.items() if value not in (None, '')}
+        return redirect(url_for('check_entries', **params))
 
-        elif table_to_show == '4': #'wallets':
-            sql_statement = db.session.query(CryptoWallet).statement
-        
-        elif table_to_show == '5': #'events':  
-            sql_statement = db.session.query(Event).statement
-        
-        elif table_to_show == '6': #'positions'
-            sql_statement = db.session.query(Position).statement
-
-        elif table_to_show == '7': #dividends
-            sql_statement = db.session.query(Dividend).statement
-
-        #=====GET DATAFRAME FROM DATABASE
-        df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    tables = []
+    titles = []
+    older_url = None
+    newer_url = None
+    table_to_show = request.args.get('table')
+    if table_to_show in CHECK_ENTRIES_TABLES:
+        params = {name:request.args.get(name) for name in CHECK_ENTRIES_PARAMS if request.args.get(name)}
+        for name in params:
+            getattr(form, name).data = params[name]   #show the current query in the form
 
         #-----determine how many rows to show
-        rows_to_show = form.rows_to_show.data
+        rows_to_show = params.get('rows_to_show','50')
         if rows_to_show == 'all':
-            num_rows = len(df)
+            num_rows = None
         else:
             try:
-                num_rows = int(rows_to_show)
+                num_rows = max(int(rows_to_show), 1)
             except ValueError:
-                num_rows = len(df)
+                num_rows = 50
         #--------
-
-        tables=[df.tail(num_rows).to_html(classes='mystyle',index=False)]
+        columns = [column.strip() for column in params.get('columns','').split(',') if len(column.strip()) > 0]
+
+        try:
+            date_from = parse_date_param(params['date_from']) if 'date_from' in params else None
+            date_to   = parse_date_param(params['date_to'])   if 'date_to'   in params else None
+        except ValueError:
+            date_from, date_to = None, None
+
+        df, has_older, has_newer = query_table_page(db, CHECK_ENTRIES_TABLES[table_to_show],
+                                                    num_rows=num_rows,
+                                                    before_id=request.args.get('before_id', type=int),
+                                                    after_id=request.args.get('after_id', type=int),
+                                                    columns=columns,
+                                                    symbol=params.get('symbol'),
+                                                    broker=params.get('broker'),
+                                                    date_from=date_from,
+                                                    date_to=date_to,)
+        if has_older and len(df) > 0:
+            older_url = url_for('check_entries', before_id=int(df['id'].iloc[0]), **params)
+        if has_newer and len(df) > 0:
+            newer_url = url_for('check_entries', after_id=int(df['id'].iloc[-1]), **params)
+
+        tables=[df.to_html(classes='mystyle',index=False)]
         titles=df.columns.values
-        return render_template('check_entries.html',form=form,tables=tables,titles=titles)
-    else:
-        return render_template('check_entries.html',form=form,tables=tables,titles=titles)
+
+    return render_template('check_entries.html',form=form,tables=tables,titles=titles,
+                           older_url=older_url,newer_url=newer_url)
+
 #======================================
 #  Creating a Bokeh App to embed into Flask
 
@@ -281,32 +290,108 @@ def bkapp(doc):
 
     doc.theme = Theme(filename="theme.yaml")
 
-def histogram_holdings():
+def get_home_chart_components():
     '''
-    sec_df = pd.read_sql(sql=db.session.query(Security).statement,con=db.session.bind)
+    Script and div of the holdings chart. They are only regenerated when the ledger
+    version or the positions table change; otherwise the cached ones are returned.
+    '''
+    version = (get_ledger_version(), get_positions_fingerprint(db),
+               get_price_store().fingerprint(), datetime.date.today())
 
-    if len(sec_df) < 1:
-        return None
+    def build_components():
+        plot_fig = histogram_holdings()
+        if plot_fig is None:
+            return '', ''
+        return components(plot_fig)
+
+    return get_cached('home_chart', version, build_components)
 
-    id_to_symbol_mapping = {
-        symbol_id:symbol for symbol_id,symbol in zip(sec_df['id'],sec_df['symbol'])
-    }
-    #sec_df = sec_df[['symbol','id']]
+def get_dividend_chart_components():
     '''
-    id_to_symbol_mapping = get_id_to_symbol_dict(db)
-    
-    trans_df = pd.read_sql(sql=db.session.query(Transaction).statement,con=db.session.bind)
-    if len(trans_df) < 1:
+    Script and div of the dividend charts plus the table of annual income per symbol, all
+    built from the cached dividend calendar and only regenerated when it changes.
+    '''
+    def build_components():
+        calendar  = get_cached_dividend_calendar(db)
+        annual_df = calendar.sum(axis=1).rename('annual_income').reset_index()
+        if len(calendar) < 1:
+            return '', '', annual_df
+        script, div = components(row(dividend_pie_chart(annual_df), dividend_calendar_chart(calendar)))
+        return script, div, annual_df
+
+    return get_cached('dividend_charts', get_dividend_version(db), build_components)
+
+def dividend_pie_chart(annual_df):
+    '''Share of the projected annual dividend income of each symbol'''
+    data = annual_df.copy()
+    data['angle']      = data['annual_income'] / data['annual_income'].sum() * 2*math.pi
+    data['percentage'] = data['annual_income'] / data['annual_income'].sum()
+    palette = inferno(min(max(len(data),3), 256))
+    data['color'] = [palette[idx % len(palette)] for idx in range(len(data))]
+
+    plot_fig = figure(plot_height=350, title="Projected Annual Dividend Income per Security",
+                      toolbar_location=None, tools="hover",
+                      tooltips="@symbol: @annual_income{($ 0.00 a)} (@percentage{0.00%})",
+                      x_range=(-0.5, 1.0))
+    plot_fig.wedge(x=0, y=1, radius=0.4, source=ColumnDataSource(data=data),
+                   start_angle=cumsum('angle', include_zero=True), end_angle=cumsum('angle'),
+                   line_color="white", fill_color='color', legend_field='symbol')
+    plot_fig.axis.axis_label = None
+    plot_fig.axis.visible = False
+    plot_fig.grid.grid_line_color = None
+    return plot_fig
+
+def dividend_calendar_chart(calendar):
+    '''Projected dividend income per month of the year, stacked by symbol'''
+    symbols = list(calendar.index)
+    data    = {'month':list(MONTHS)}
+    data.update({symbol:calendar.loc[symbol].to_numpy() for symbol in symbols})
+    palette = inferno(min(max(len(symbols),3), 256))
+
+    plot_fig = figure(x_range=list(MONTHS), plot_height=350, title="Dividend Payment Calendar",
+                      toolbar_location=None, tools="hover",
+                      tooltips="$name @month: @$name{($ 0.00 a)}")
+    plot_fig.vbar_stack(symbols, x='month', width=0.8, source=ColumnDataSource(data=data),
+                        color=[palette[idx % len(palette)] for idx in range(len(symbols))])
+    plot_fig.y_range.start = 0
+    plot_fig.xgrid.grid_line_color = None
+    return plot_fig
+
+def get_invested_by_symbol():
+    '''Shares and money invested per symbol, read from the maintained `security_positions` table'''
+    sql_statement = db.session.query(
+                        Security.symbol,
+                        Position.total_shares.label('num_shares'),
+                        Position.invested,
+                        Position.cost_basis.label('avg_price'),
+                        ).join(Security, Security.id==Position.symbol_id
+                        ).order_by(Security.symbol.asc()).statement
+    by_symbol = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    for column in ('num_shares','invested','avg_price'):
+        by_symbol[column] = by_symbol[column].astype(float)
+    return by_symbol
+
+def get_market_value_by_symbol(symbols):
+    '''Latest market value per symbol from the valuation engine (NaN for symbols without stored prices)'''
+    engine = get_valuation_engine(db)
+    if len(engine.dates) < 1:
+        return pd.Series(float('nan'), index=symbols)
+    latest = engine.symbol_values().ffill().iloc[-1]
+    return latest.reindex(symbols)
+
+def histogram_holdings():
+    by_symbol = get_invested_by_symbol()
+    if len(by_symbol) < 1:
         return None
-    trans_df['invested'] = trans_df['num_shares'] * trans_df['cost_basis']
-    #trans_df = trans_df[['symbol_id','invested']]
-    by_symbol = trans_df.groupby('symbol_id')
-    by_symbol = by_symbol[['num_shares','invested']].sum().reset_index()
-    by_symbol['avg_price'] = by_symbol['invested'] / by_symbol['num_shares']
+    by_symbol['market_value'] = get_market_value_by_symbol(by_symbol['symbol']).to_numpy()
+    has_market_data = by_symbol['market_value'].notna().any()
 
-    #by_symbol['symbol'] = sec_df.loc[by_symbol['symbol_id']==sec_df['id']]['symbol']
-    by_symbol['symbol'] = by_symbol['symbol_id'].copy()
-    by_symbol = by_symbol.replace({'symbol':id_to_symbol_mapping})
+    returns_by_symbol, portfolio_returns = get_cached_returns(db)
+    by_symbol['xirr'] = returns_by_symbol['xirr'].reindex(by_symbol['symbol']).to_numpy()
+    by_symbol['twr']  = returns_by_symbol['twr'].reindex(by_symbol['symbol']).to_numpy()
+    title = "Money Invested per Security"
+    if pd.notna(portfolio_returns['xirr']):
+        title += f" (XIRR: {portfolio_returns['xirr']:.2%}, TWR: {portfolio_returns['twr']:.2%})"
 
     #=====================================================================
     #=====================================================================
@@ -315,7 +400,7 @@ def histogram_holdings():
     source = ColumnDataSource(data=by_symbol)
 
     plot_fig = figure(x_range=by_symbol['symbol'], y_range=(0, by_symbol['invested'].max() + 200), 
-            plot_height=250, title="Money Invested per Security",
+            plot_height=250, title=title,
             toolbar_location=None, 
             tools=['tap'], 
     )
@@ -324,7 +409,10 @@ def histogram_holdings():
                 ('symbol','@symbol'),
                 ('invested','@invested{($ 0.00 a)}'),
                 ('shares','@num_shares{(0.0000)}'),
-                ('avg. price','@avg_price{($ 0.00 a)}')
+                ('avg. price','@avg_price{($ 0.00 a)}'),
+                ('market value','@market_value{($ 0.00 a)}'),
+                ('XIRR','@xirr{0.00%}'),
+                ('TWR','@twr{0.00%}'),
             ],
         formatters={
             '@symbol':'printf'
@@ -335,8 +423,15 @@ def histogram_holdings():
     #plot_fig.vbar(x=dodge('symbol', -0.5, range=plot_fig.x_range), top='invested', width=0.4, source=source,
     #   color="#c9d9d3", legend_label="Dollars Invested")
 
-    plot_fig.vbar(x=dodge('symbol',0, range=plot_fig.x_range), top='invested', width=0.8, source=source,
-       color="#c9d9d3", legend_label=f"Money Invested (Total: $ {by_symbol['invested'].sum():.2f})")
+    if has_market_data:
+        plot_fig.vbar(x=dodge('symbol',-0.2, range=plot_fig.x_range), top='invested', width=0.4, source=source,
+           color="#c9d9d3", legend_label=f"Money Invested (Total: $ {by_symbol['invested'].sum():.2f})")
+        plot_fig.vbar(x=dodge('symbol',0.2, range=plot_fig.x_range), top='market_value', width=0.4, source=source,
+           color="#718dbf", legend_label=f"Market Value (Total: $ {by_symbol['market_value'].sum():.2f})")
+        plot_fig.y_range.end = max(by_symbol['invested'].max(), by_symbol['market_value'].max()) + 200
+    else:
+        plot_fig.vbar(x=dodge('symbol',0, range=plot_fig.x_range), top='invested', width=0.8, source=source,
+           color="#c9d9d3", legend_label=f"Money Invested (Total: $ {by_symbol['invested'].sum():.2f})")
 
     plot_fig.x_range.range_padding = 0.1
     plot_fig.xgrid.grid_line_color = None
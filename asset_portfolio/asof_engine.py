@@ -0,0 +1,275 @@
+'''
+Point-in-time positions ("what did I hold on 2021-03-15").
+
+Monthly snapshots of every symbol (shares, invested amount and cumulative split factor) are
+kept in the `position_snapshots` table. The position at any date is then the nearest earlier
+snapshot plus only the transactions and splits since that snapshot, so the cost of a query
+is bounded by the snapshot interval instead of the full history.
+
+A snapshot dated B holds the state right before B: transactions executed and splits dated
+earlier than B are included. Shares are in the units of that moment, not adjusted for later
+splits. Snapshots after a back-dated transaction or a newly collected split are deleted by
+`invalidate_position_snapshots` and rebuilt by `update_position_snapshots`.
+'''
+import datetime
+import decimal
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from models import Transaction, PositionSnapshot
+from tools import get_split_events_df, get_id_to_symbol_dict, upsert_rows
+from split_engine import SHARES_DECIMALS, CURRENCY_DECIMALS
+from fixed_point import (scaled_column, aggregate_positions_fixed, average_cost,
+                         split_ratios, to_fixed, from_fixed, MAX_SPLIT_DENOMINATOR)
+
+VERY_OLD_DATE   = datetime.datetime(1800,1,1)    #state date of symbols without a snapshot
+FACTOR_DECIMALS = 10                             #same precision as `Event.split_factor`
+
+
+def month_start(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+def next_month_start(date):
+    if date.month == 12:
+        return datetime.datetime(date.year+1, 1, 1)
+    return datetime.datetime(date.year, date.month+1, 1)
+
+def _latest_snapshot_dates(db, before=None, symbol_ids=None):
+    '''Subquery with the date of the latest snapshot of each symbol (only snapshots dated `before` or earlier)'''
+    query = db.session.query(
+                PositionSnapshot.symbol_id.label('symbol_id'),
+                db.func.max(PositionSnapshot.snapshot_date).label('snapshot_date'),
+                )
+    if before is not None:
+        query = query.filter(PositionSnapshot.snapshot_date <= before)
+    if symbol_ids is not None:
+        query = query.filter(PositionSnapshot.symbol_id.in_(list(symbol_ids)))
+    return query.group_by(PositionSnapshot.symbol_id).subquery()
+
+def load_snapshot_states(db, before=None, symbol_ids=None):
+    '''
+    Latest snapshot of each symbol dated `before` or earlier, as replay states.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by `symbol_id`, with columns `snapshot_date`, `total_shares`, `invested`
+        (fixed-point ints) and `split_factor` (fractions.Fraction)
+    '''
+    latest = _latest_snapshot_dates(db, before, symbol_ids)
+    rows = db.session.query(
+                PositionSnapshot.symbol_id,
+                PositionSnapshot.snapshot_date,
+                PositionSnapshot.total_shares,
+                PositionSnapshot.invested,
+                PositionSnapshot.split_factor,
+                ).join(latest, db.and_(latest.c.symbol_id==PositionSnapshot.symbol_id,
+                                       latest.c.snapshot_date==PositionSnapshot.snapshot_date)
+                ).all()
+
+    states = pd.DataFrame({
+        'snapshot_date' : [row.snapshot_date for row in rows],
+        'total_shares'  : [to_fixed(row.total_shares, SHARES_DECIMALS) for row in rows],
+        'invested'      : [to_fixed(row.invested, CURRENCY_DECIMALS) for row in rows],
+        'split_factor'  : [Fraction(str(row.split_factor)).limit_denominator(MAX_SPLIT_DENOMINATOR) for row in rows],
+    }, index=pd.Index([row.symbol_id for row in rows], name='symbol_id'), dtype=object)
+    return states
+
+def load_ledger_since_snapshots(db, until, before=None, symbol_ids=None):
+    '''
+    Transactions executed at or before `until` that are not included in the latest snapshot
+    (dated `before` or earlier) of their symbol, in the format of `fixed_point.load_ledger`.
+    '''
+    latest = _latest_snapshot_dates(db, before, symbol_ids)
+    query  = db.session.query(
+                Transaction.symbol_id,
+                Transaction.time_execution,
+                scaled_column(Transaction.num_shares, SHARES_DECIMALS),
+                scaled_column(Transaction.cost_basis, CURRENCY_DECIMALS),
+                ).outerjoin(latest, latest.c.symbol_id==Transaction.symbol_id
+                ).filter(
+                    Transaction.time_execution <= until,
+                    db.or_(latest.c.snapshot_date.is_(None), Transaction.time_execution >= latest.c.snapshot_date),
+                )
+    if symbol_ids is not None:
+        query = query.filter(Transaction.symbol_id.in_(list(symbol_ids)))
+    sql_statement = query.order_by(Transaction.symbol_id.asc(), Transaction.time_execution.asc()).statement
+
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    df['num_shares'] = df['num_shares'].astype(np.int64)
+    df['cost_basis'] = df['cost_basis'].astype(np.int64)
+    return df
+
+def replay_positions(states, ledger_df, splits_df, until):
+    '''
+    Moves `states` forward to `until` by applying the transactions of `ledger_df` and the
+    splits of `splits_df` dated after each state and up to `until` (inclusive).
+
+    Parameters
+    ----------
+    states: pandas.DataFrame
+        As returned by `load_snapshot_states`. Symbols of `ledger_df` missing from it start
+        from an empty position
+    ledger_df: pandas.DataFrame
+        Transactions executed after the state of their symbol (see `load_ledger_since_snapshots`)
+    splits_df: pandas.DataFrame
+        Split events with columns `symbol_id`, `event_date` and `split_factor`
+    until: datetime
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by `symbol_id`, with fixed-point int columns `total_shares`, `invested` and
+        `cost_basis`, plus `split_factor` (fractions.Fraction)
+    '''
+    ledger_df = ledger_df[ledger_df['time_execution'] <= until]
+    splits_df = splits_df[splits_df['event_date'] <= until]
+
+    symbol_ids = states.index.union(pd.Index(ledger_df['symbol_id'].unique()))
+    states = states.reindex(symbol_ids)
+    states['snapshot_date'] = states['snapshot_date'].fillna(VERY_OLD_DATE)
+    states['total_shares']  = states['total_shares'].fillna(0)
+    states['invested']      = states['invested'].fillna(0)
+    states['split_factor']  = [Fraction(1) if pd.isna(factor) else factor for factor in states['split_factor']]
+
+    #each state enters the replay as a transaction made right before its snapshot date (with no cost),
+    #so splits dated on the snapshot date or later are applied to it
+    state_rows = pd.DataFrame({
+        'symbol_id'      : symbol_ids.to_numpy(dtype=np.int64),
+        'time_execution' : pd.to_datetime(states['snapshot_date']).to_numpy() - np.timedelta64(1,'s'),
+        'num_shares'     : states['total_shares'].to_numpy(dtype=np.int64),
+        'cost_basis'     : np.zeros(len(symbol_ids), dtype=np.int64),
+    })
+    columns   = ['symbol_id','time_execution','num_shares','cost_basis']
+    positions = aggregate_positions_fixed(pd.concat([state_rows, ledger_df[columns]], ignore_index=True), splits_df)
+
+    split_factors = states['split_factor'].to_dict()
+    ratios        = split_ratios(splits_df['split_factor'].to_numpy())
+    for split_symbol, event_date, ratio in zip(splits_df['symbol_id'], splits_df['event_date'], ratios):
+        if (split_symbol in split_factors) and (event_date >= states.at[split_symbol, 'snapshot_date']):
+            split_factors[split_symbol] *= ratio
+
+    positions['invested']     = [invested + int(states.at[symbol_id, 'invested']) for symbol_id, invested in positions['invested'].items()]
+    positions['cost_basis']   = [average_cost(invested, shares) for shares, invested in zip(positions['total_shares'], positions['invested'])]
+    positions['split_factor'] = [split_factors[symbol_id] for symbol_id in positions.index]
+    return positions
+
+def factor_to_decimal(factor):
+    scaled = Fraction(factor) * 10**FACTOR_DECIMALS
+    return decimal.Decimal(round(scaled)).scaleb(-FACTOR_DECIMALS)
+
+def get_positions_as_of(db, as_of, symbol_ids=None):
+    '''
+    Positions held at `as_of`, in the share units of that date (only splits dated on or
+    before `as_of` are applied).
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    as_of: datetime
+        Transactions executed and splits dated at or before this time are included
+    symbol_ids: iterable of int, optional
+        Symbols to compute (all symbols if None)
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by `symbol_id`, with columns `symbol`, `total_shares`, `cost_basis`,
+        `invested` and `split_factor` (decimal.Decimal). Symbols without transactions up to
+        `as_of` are not included.
+    '''
+    states    = load_snapshot_states(db, before=as_of, symbol_ids=symbol_ids)
+    ledger_df = load_ledger_since_snapshots(db, as_of, before=as_of, symbol_ids=symbol_ids)
+    splits_df = get_split_events_df(db, symbol_ids)
+
+    positions = replay_positions(states, ledger_df, splits_df, as_of)
+
+    id_to_symbol = get_id_to_symbol_dict(db)
+    result = pd.DataFrame({
+        'symbol'       : [id_to_symbol.get(symbol_id) for symbol_id in positions.index],
+        'total_shares' : [from_fixed(value, SHARES_DECIMALS) for value in positions['total_shares']],
+        'cost_basis'   : [from_fixed(value, CURRENCY_DECIMALS) for value in positions['cost_basis']],
+        'invested'     : [from_fixed(value, CURRENCY_DECIMALS) for value in positions['invested']],
+        'split_factor' : [factor_to_decimal(value) for value in positions['split_factor']],
+    }, index=positions.index)
+    return result
+
+def update_position_snapshots(db, symbol_ids=None, until=None):
+    '''
+    Creates the missing monthly snapshots of `symbol_ids` (all symbols if None) up to
+    `until` (default: the start of the current month), continuing from the latest snapshot
+    of each symbol. Every month is replayed once, over all the symbols at the same time,
+    and the snapshots are written with one bulk upsert and a single commit.
+
+    Returns
+    -------
+    int
+        Number of snapshots written
+    '''
+    if until is None:
+        until = month_start(datetime.datetime.utcnow())
+
+    states    = load_snapshot_states(db, symbol_ids=symbol_ids)
+    ledger_df = load_ledger_since_snapshots(db, until - datetime.timedelta(microseconds=1), symbol_ids=symbol_ids)
+    if len(ledger_df) < 1 and len(states) < 1:
+        return 0
+    splits_df = get_split_events_df(db, symbol_ids)
+
+    #first snapshot to build for every symbol
+    next_dates = {symbol_id: next_month_start(date) for symbol_id, date in states['snapshot_date'].items()}
+    for symbol_id, first_time in ledger_df.groupby('symbol_id')['time_execution'].min().items():
+        if symbol_id not in next_dates:
+            next_dates[symbol_id] = next_month_start(first_time)
+
+    #transactions grouped by the first snapshot that includes them
+    ledger_df = ledger_df.copy()
+    ledger_df['time_execution'] = pd.to_datetime(ledger_df['time_execution'])
+    ledger_df['snapshot_date'] = ledger_df['time_execution'].dt.to_period('M').dt.to_timestamp() + pd.offsets.MonthBegin(1)
+    ledger_by_month = dict(tuple(ledger_df.groupby('snapshot_date')))
+
+    rows     = []
+    boundary = min(next_dates.values(), default=until)
+    while boundary <= until:
+        active = [symbol_id for symbol_id, next_date in next_dates.items() if next_date <= boundary]
+        if len(active) > 0:
+            month_ledger = ledger_by_month.get(pd.Timestamp(boundary), ledger_df.iloc[:0])
+            month_states = states.reindex(active)
+            positions = replay_positions(month_states.dropna(subset=['snapshot_date']), month_ledger,
+                                         splits_df, boundary - datetime.timedelta(microseconds=1))
+            positions = positions.reindex(active)   #a symbol without state nor transactions yet is not replayed
+
+            for symbol_id, row in positions.dropna(subset=['total_shares']).iterrows():
+                rows.append({
+                    'symbol_id'     : int(symbol_id),
+                    'snapshot_date' : boundary,
+                    'total_shares'  : from_fixed(row['total_shares'], SHARES_DECIMALS),
+                    'invested'      : from_fixed(row['invested'], CURRENCY_DECIMALS),
+                    'split_factor'  : factor_to_decimal(row['split_factor']),
+                })
+                states.loc[symbol_id, ['snapshot_date','total_shares','invested','split_factor']] = [
+                    boundary, row['total_shares'], row['invested'], row['split_factor']]
+        boundary = next_month_start(boundary)
+
+    upsert_rows(db, PositionSnapshot, rows, key_columns=['symbol_id','snapshot_date'],
+                update_columns=['total_shares','invested','split_factor'])
+    db.session.commit()
+    return len(rows)
+
+def invalidate_position_snapshots(db, earliest_dates):
+    '''
+    Deletes the snapshots that no longer match the ledger. It does not commit.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    earliest_dates: dict
+        Maps `symbol_id` to the earliest date of its new (or changed) transactions or split
+        events. Every snapshot of that symbol dated after it is deleted.
+    '''
+    if len(earliest_dates) < 1:
+        return
+    conditions = [db.and_(PositionSnapshot.symbol_id==symbol_id, PositionSnapshot.snapshot_date > date)
+                  for symbol_id, date in earliest_dates.items()]
+    db.session.query(PositionSnapshot).filter(db.or_(*conditions)).delete(synchronize_session=False)
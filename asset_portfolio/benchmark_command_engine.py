@@ -0,0 +1,46 @@
+'''Measures the throughput of the command parser on a synthetic DRIP history.
+
+Usage:
+    python benchmark_command_engine.py [num_transactions] [-n repetitions]
+
+It times `parse_commands` (columnar TransactionBatch) and `command_engine` (dictionary of
+TransactionEvent objects) over the same command string.
+'''
+import sys
+import random
+import timeit
+import datetime
+
+from command_engine import parse_commands, command_engine
+
+def build_command(num_transactions, seed=0):
+    '''One transaction per line, like a pasted dividend reinvestment history'''
+    rng     = random.Random(seed)
+    tickers = ['aapl','msft','nrz','o','t','vz','stag','main','ko','pep']
+    day     = datetime.date(2015,1,2)
+    lines   = []
+    for idx in range(num_transactions):
+        ticker = rng.choice(tickers)
+        shares = f"{rng.uniform(0.001, 2):.9f}"
+        price  = f"{rng.uniform(5, 300):.2f}"
+        flags  = f"-div -b robinhood -date {day + datetime.timedelta(days=idx // 7):%Y-%m-%d}"
+        lines.append(f"{ticker} {shares} {price} {flags}")
+    return '\n'.join(lines)
+
+def benchmark(num_transactions, repetitions=5):
+    command = build_command(num_transactions)
+    print(f"{num_transactions} transactions, {len(command)/1024:.1f} KiB")
+    for name, function in (('parse_commands', parse_commands), ('command_engine', command_engine)):
+        seconds = min(timeit.repeat(lambda: function(command), number=1, repeat=repetitions))
+        print(f"{name:>15}: {seconds*1000:9.2f} ms  ({num_transactions/seconds:,.0f} transactions/s)")
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    repetitions = 5
+    if '-n' in args:
+        idx = args.index('-n')
+        repetitions = int(args[idx+1])
+        del args[idx:idx+2]
+
+    num_transactions = int(args[0]) if len(args) > 0 else 10000
+    benchmark(num_transactions, repetitions=repetitions)
@@ -0,0 +1,78 @@
+'''Compares the per-page cost of the fast and the html5lib parsers of tipranks dividend pages.
+
+Usage:
+    python benchmark_tipranks_parser.py [folder_or_html_files ...] [-n repetitions]
+
+By default it uses the pages cached by `dividends_table_updater` in db_files/html_cache and
+the sample pages of the tests (tests/fixtures/tipranks), which include pages of symbols
+without dividends.
+'''
+import os
+import sys
+import glob
+import timeit
+
+from tools import parse_tipranks_dividends
+
+DEFAULT_FIXTURES_FOLDERS = [
+    os.path.join('db_files','html_cache'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'tipranks'),
+]
+
+def load_fixtures(paths):
+    fixtures = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '*.html')))
+        else:
+            files = [path]
+        for filename in files:
+            with open(filename, encoding='utf-8') as f_handler:
+                fixtures[filename] = f_handler.read()
+    return fixtures
+
+def benchmark(fixtures, repetitions=5):
+    totals = {'fast':0.0, 'html5lib':0.0}
+    for filename, html in fixtures.items():
+        ticker = os.path.splitext(os.path.basename(filename))[0]
+        results = {}
+        for parser in totals:
+            try:
+                results[parser] = parse_tipranks_dividends(ticker, html, parser=parser)
+            except (IndexError, AttributeError, ValueError) as e:
+                results[parser] = repr(e)
+            seconds = min(timeit.repeat(lambda: _safe_parse(ticker, html, parser), number=1, repeat=repetitions))
+            totals[parser] += seconds
+            no_dividend = ' (no dividend)' if isinstance(results[parser], tuple) and results[parser][1] is None else ''
+            print(f"{ticker:>8} | {parser:>8}: {seconds*1000:9.3f} ms{no_dividend}")
+
+        if results['fast'] != results['html5lib']:
+            print(f"--> WARNING: parsers disagree for {ticker}:\n\tfast:     {results['fast']}\n\thtml5lib: {results['html5lib']}")
+
+    num_pages = len(fixtures)
+    print('-'*40)
+    for parser in totals:
+        print(f"{parser:>8}: {totals[parser]/num_pages*1000:9.3f} ms per page ({num_pages} pages)")
+    if totals['fast'] > 0:
+        print(f" speedup: {totals['html5lib']/totals['fast']:.1f}x")
+
+def _safe_parse(ticker, html, parser):
+    try:
+        parse_tipranks_dividends(ticker, html, parser=parser)
+    except (IndexError, AttributeError, ValueError):
+        pass
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    repetitions = 5
+    if '-n' in args:
+        idx = args.index('-n')
+        repetitions = int(args[idx+1])
+        del args[idx:idx+2]
+
+    paths = args if len(args) > 0 else [folder for folder in DEFAULT_FIXTURES_FOLDERS if os.path.isdir(folder)]
+    fixtures = load_fixtures(paths)
+    if len(fixtures) < 1:
+        print(f"No html fixtures found in {paths}. Run `python database_operations.py mysql dividends` first or pass saved pages.")
+        sys.exit()
+    benchmark(fixtures, repetitions=repetitions)
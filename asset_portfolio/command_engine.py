@@ -1,11 +1,84 @@
 import datetime
 import re
 
+#----------------------------------------------------------------------------
+#   Tokenizer
+#
+#   Patterns are compiled once, when the module is imported. A well formed transaction
+#   ("ticker shares price -flags...", followed by a comma or a new line) is matched as a
+#   whole by ITEM_RE, so a command is read in one left-to-right pass with one match per
+#   transaction. Anything else (flags before the numbers, typos) goes through TOKEN_RE,
+#   which splits the transaction into tokens and reports the offset of the one that is
+#   wrong.
+#----------------------------------------------------------------------------
+_TIME_PATTERN     = r"[0-9]{1,2}:[0-9]{2}(?::[0-9]{2}(?:\.[0-9]+)?)?"
+_DATE_PATTERN     = r"[0-9]{4}-[0-9]{2}-[0-9]{2}"
+_DATETIME_PATTERN = f"{_DATE_PATTERN}(?:[ \\t]+{_TIME_PATTERN})?"
+_VALUE_PATTERN    = f"{_DATETIME_PATTERN}|{_TIME_PATTERN}|[a-z][a-z0-9_.]*"
+_NUMBER_PATTERN   = r"[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)"
+_TICKER_PATTERN   = r"[a-z][a-z0-9.]*"
+_END              = r"(?=[\s,]|$)"
+
+ITEM_RE = re.compile(f"""
+    [ \\t\\r\\f\\v]*
+    (?:(?P<ticker>{_TICKER_PATTERN})[ \\t]+)?
+    (?P<num_shares>{_NUMBER_PATTERN})[ \\t]+
+    (?P<cost_basis>{_NUMBER_PATTERN})
+    (?P<flags>(?:[ \\t]+-[a-z]+(?:[ \\t]+(?:{_VALUE_PATTERN}))?)*)
+    [ \\t\\r\\f\\v]*
+    (?:[,\\n]|$)
+""", re.VERBOSE)
+
+FLAG_RE = re.compile(f"-([a-z]+)(?:[ \\t]+({_VALUE_PATTERN}))?")
+
+TOKEN_RE = re.compile(f"""
+    -(?P<flag>[a-z]+){_END}(?:[ \\t]+(?P<value>{_VALUE_PATTERN}){_END})?
+  | (?P<number>{_NUMBER_PATTERN}){_END}
+  | (?P<word>{_TICKER_PATTERN}){_END}
+  | (?P<error>[^\\s,]+)
+""", re.VERBOSE)   #whitespace between tokens is skipped by `finditer`
+
+SEPARATOR_RE = re.compile(r"[,\n]")
+
+#pattern of the old flag parser, kept for `get_flags`
+_FLAGS_RE = re.compile(r"\s*-([a-zA-Z]+)\s*([a-zA-Z]+|[0-9]+\-[0-9]+\-[0-9]+\s*[0-9\:\.]+|[0-9\:\.]+|\s*)")
+
+
+class CommandSyntaxError(ValueError):
+    '''
+    Raised when a transaction in a command string cannot be parsed.
+
+    Attributes
+    ----------
+    message: str
+        What is wrong, without the location
+    position: int
+        Offset of the offending token in the command string
+    item: int
+        Index (0-based) of the comma-separated transaction it belongs to
+    '''
+    def __init__(self, message, command, position, item):
+        self.message  = message
+        self.command  = command
+        self.position = position
+        self.item     = item
+        line_start = command.rfind('\n', 0, position) + 1
+        line_end   = command.find('\n', position)
+        line_end   = len(command) if line_end < 0 else line_end
+        pointer    = ' '*(position - line_start) + '^'
+        super().__init__(f"{message} (transaction #{item+1}, position {position}):\n{command[line_start:line_end]}\n{pointer}")
+
 
 class TransactionEvent(object):
     '''Storage object for transaction Events. It seems more organized than keeping
     a bunch of lists of tuples of lists and dicts. There are some useful external methods
-    such as is_dividend() to return a boolean if the transaction is a dividend payment.'''
+    such as is_dividend() to return a boolean if the transaction is a dividend payment.
+
+    Flags are resolved once, when the event is created (see `resolve_flags`): execution
+    time, broker and dividend flag get their own fields and `flags` keeps only the rest.
+    Events use `__slots__`, so they have no per-instance `__dict__`.'''
+    __slots__ = ('_ticker', '_amount', '_cost_basis', '_datetime', '_broker', '_is_dividend', '_flags')
+
     DIVIDEND_FLAG = 'div'
     BROKER_FLAG   = 'b'
     DT_FLAG       = 'dt'
@@ -13,91 +86,31 @@ class TransactionEvent(object):
     DATE_FLAG     = 'date'
 
     DEFAULT_BROKER = 'robinhood'
-    def __init__(self, ticker,amount,cost_basis,flags=[]):
-        self._ticker = ticker
-        self._amount = amount
-        self._cost_basis = cost_basis
-        self.flag_list = flags  #list of tuples
-        
-        #set datetime value
-        self._datetime = None 
-        self._set_datetime()
-        
-    
-    def _set_datetime(self):
-        """sets datetime value from flags and also deletes those flags from self.flag_list after it's done"""
-        if len(self.flag_list) > 0:
-            flags,vals = zip(*self.flag_list) #split list of tuples into two lists
-        else:
-            self._datetime = datetime.datetime.utcnow()
-            return 
-
-        #----
-        indexes_to_delete = []
-        if (self.DATE_FLAG in flags) and (self.TIME_FLAG not in flags):
-            idx = flags.index(self.DATE_FLAG)
-            val = vals[idx]
-            date = datetime.datetime.fromisoformat(val)
-            time = datetime.time(hour=8,minute=0)
-            self._datetime = datetime.datetime.combine(date,time)
-            indexes_to_delete.append(idx)
-
-        elif (self.TIME_FLAG in flags) and (self.DATE_FLAG not in flags):
-            idx = flags.index(self.TIME_FLAG)
-            val = vals[idx]
-            date = datetime.datetime.utcnow().date()
-            time = datetime.time.fromisoformat(val)
-            self._datetime = datetime.datetime.combine(date,time)
-            indexes_to_delete.append(idx)
-
-        elif (self.DATE_FLAG in flags) and (self.TIME_FLAG in flags):
-            idx_date = flags.index(self.DATE_FLAG)
-            idx_time = flags.index(self.self.TIME_FLAG)
-            
-            date_str = vals[idx_date]
-            time_str = vals[idx_time]
-            dt_str   = f"{date_str} {time_str}"
-            self._datetime = datetime.datetime.fromisoformat(dt_str)
-            indexes_to_delete.append(idx_date)
-            indexes_to_delete.append(idx_time)
-
-        else: #when neither date or time flags are present
-            if self.DT_FLAG in flags:
-                idx = flags.index(self.DT_FLAG)
-                val = vals[idx]
-                #print(f"\n**ERROR CATCHER:\n--> self.flags={self.flags}\n--> idx={idx}\n--> val={val}\n")
-                self._datetime = datetime.datetime.fromisoformat(val)
-                indexes_to_delete.append(idx)
-            else:
-                #self._datetime = datetime.datetime.utcnow()
-                self._datetime = None  #return none for now. It will be handled server side on mysql
-
-
-        #here I delete the flags from flag list since they have a dedicated variable
-        for idx_pos in sorted(indexes_to_delete,reverse=True):
-            del self.flag_list[idx_pos]
+    def __init__(self, ticker,amount,cost_basis,flags=None):
+        time_execution, broker, is_dividend, remaining = resolve_flags(flags or ())
+        self._set_fields(ticker, amount, cost_basis, time_execution, broker, is_dividend, remaining)
+
+    @classmethod
+    def from_resolved(cls, ticker, amount, cost_basis, time_execution=None, broker=DEFAULT_BROKER, is_dividend=False, flags=()):
+        '''Event from values that are already resolved (i.e. a row of a TransactionBatch), without parsing flags'''
+        event = cls.__new__(cls)
+        event._set_fields(ticker, amount, cost_basis, time_execution, broker, is_dividend, flags)
+        return event
+
+    def _set_fields(self, ticker, amount, cost_basis, time_execution, broker, is_dividend, flags):
+        self._ticker      = ticker
+        self._amount      = amount
+        self._cost_basis  = cost_basis
+        self._datetime    = time_execution   #None: the UTC time of the insert is used
+        self._broker      = broker
+        self._is_dividend = bool(is_dividend)
+        self._flags       = tuple(flags)     #remaining (flag, value) pairs
 
     def is_dividend(self):
-        if len(self.flags) < 1:
-            return False 
-        
-        flags,vals = zip(*self.flags)
-        if self.DIVIDEND_FLAG in flags:
-            return True 
-        else:
-            return False
+        return self._is_dividend
 
     def get_broker(self):
-        if len(self.flags) < 1:
-            return self.DEFAULT_BROKER
-
-        flags,vals = zip(*self.flags)
-        if self.BROKER_FLAG in flags:
-            idx = flags.index(self.BROKER_FLAG)
-            broker = vals[idx]
-        else:
-            broker = 'robinhood'  #default broker for now
-        return broker
+        return self._broker
 
     #-----Read-only methods
     @property
@@ -128,72 +141,254 @@ class TransactionEvent(object):
         return time
     @property
     def flags(self):
-        return self.flag_list
+        return self._flags
     @property 
     def broker(self):
-        return self.get_broker()
+        return self._broker
     
     def __repr__(self):
-        return f"<TransactionEvent>: {self.ticker:>5} {float(self.amount):.7f} {float(self.cost_basis):.4f} {self.date} {self.time:%H:%M:%S} {self.flags}"
-   
+        time = f"{self.time:%H:%M:%S}" if self.time is not None else None
+        return f"<TransactionEvent>: {self.ticker:>5} {float(self.amount):.7f} {float(self.cost_basis):.4f} {self.date} {time} {self.broker} div={self.is_dividend()} {list(self.flags)}"
+
+
+class TransactionBatch(object):
+    '''
+    Parsed transactions stored by column (one list per field, one position per transaction),
+    in the order they were entered.
+
+    Attributes
+    ----------
+    tickers: list of str
+    num_shares, cost_basis: list of str
+        Numbers exactly as written, so they can become `decimal.Decimal` without rounding
+    datetimes: list of datetime.datetime or None
+        Execution time from the date/time flags (None: the UTC time of the insert is used)
+    brokers: list of str
+    is_dividend: list of bool
+    flags: list of list of tuples
+        Remaining (flag, value) pairs of every transaction
+    positions: list of int
+        Offset of every transaction in the command string
+    '''
+    COLUMNS = ('tickers','num_shares','cost_basis','datetimes','brokers','is_dividend','flags','positions')
+
+    def __init__(self):
+        for column in self.COLUMNS:
+            setattr(self, column, [])
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @classmethod
+    def from_columns(cls, tickers, num_shares, cost_basis, datetimes, brokers, is_dividend, positions=None):
+        '''Batch from whole columns (lists or arrays of the same length), i.e. from a parsed CSV file'''
+        batch = cls()
+        batch.tickers     = list(tickers)
+        batch.num_shares  = list(num_shares)
+        batch.cost_basis  = list(cost_basis)
+        batch.datetimes   = list(datetimes)
+        batch.brokers     = list(brokers)
+        batch.is_dividend = [bool(value) for value in is_dividend]
+        batch.flags       = [[] for _ in range(len(batch.tickers))]
+        batch.positions   = list(positions) if positions is not None else list(range(len(batch.tickers)))
+        return batch
+
+    def append(self, ticker, num_shares, cost_basis, time_execution, broker, is_dividend, flags, position):
+        self.tickers.append(ticker)
+        self.num_shares.append(num_shares)
+        self.cost_basis.append(cost_basis)
+        self.datetimes.append(time_execution)
+        self.brokers.append(broker)
+        self.is_dividend.append(is_dividend)
+        self.flags.append(flags)
+        self.positions.append(position)
+
+    def extend(self, other):
+        for column in self.COLUMNS:
+            getattr(self, column).extend(getattr(other, column))
+
+    def symbols(self):
+        '''Distinct tickers in order of appearance'''
+        return list(dict.fromkeys(self.tickers))
+
+    @classmethod
+    def from_tickers_dict(cls, tickers_dict):
+        '''Batch from a dictionary of TransactionEvent lists per ticker (as returned by `command_engine`)'''
+        batch = cls()
+        for ticker in tickers_dict:
+            for event in tickers_dict[ticker]:
+                batch.append(ticker, event.amount, event.cost_basis, event.datetime, event.broker,
+                             event.is_dividend(), list(event.flags), len(batch))
+        return batch
+
+    def rows(self):
+        '''(ticker, num_shares, cost_basis, datetime, broker, is_dividend) of every transaction, read straight from the columns'''
+        return zip(self.tickers, self.num_shares, self.cost_basis, self.datetimes, self.brokers, self.is_dividend)
+
+    def to_tickers_dict(self):
+        '''Dictionary of TransactionEvent lists per ticker, as returned by `command_engine`'''
+        tickers_dict = {}
+        for idx, ticker in enumerate(self.tickers):
+            event = TransactionEvent.from_resolved(ticker, self.num_shares[idx], self.cost_basis[idx], self.datetimes[idx],
+                                                   self.brokers[idx], self.is_dividend[idx], self.flags[idx])
+            tickers_dict.setdefault(ticker, []).append(event)
+        return tickers_dict
+
+    def __repr__(self):
+        return f"<TransactionBatch: {len(self)} transactions, {len(self.symbols())} symbols>"
+
+
+_TIME_FLAGS = (TransactionEvent.DATE_FLAG, TransactionEvent.TIME_FLAG, TransactionEvent.DT_FLAG)
+
+def resolve_flags(flags):
+    '''
+    Turns the (flag, value) pairs of a transaction into its execution time, broker and
+    dividend flag: a date alone is taken at 08:00, a time alone is for today (UTC), `dt`
+    holds both and is ignored when `date` or `t` are given. Without any of them the time is
+    None (the UTC time of the insert is used, see `table_updaters.bulk_insert_transactions`).
+
+    Returns
+    -------
+    tuple
+        (datetime.datetime or None, broker, is_dividend, remaining flags)
+
+    Raises
+    ------
+    ValueError
+        When a date or time does not exist (i.e. month 13)
+    '''
+    times       = {}
+    broker      = TransactionEvent.DEFAULT_BROKER
+    is_dividend = False
+    remaining   = []
+    for flag, value in flags:
+        if (flag in _TIME_FLAGS) and (flag not in times):
+            times[flag] = value
+        elif flag == TransactionEvent.DIVIDEND_FLAG:
+            is_dividend = True
+        elif flag == TransactionEvent.BROKER_FLAG:
+            if value:       #a `-b` without a broker is dropped
+                broker = value
+        else:
+            remaining.append((flag, value))
+
+    date_str = times.get(TransactionEvent.DATE_FLAG)
+    time_str = times.get(TransactionEvent.TIME_FLAG)
+    dt_str   = times.get(TransactionEvent.DT_FLAG)
+    if (date_str is not None) and (time_str is not None):
+        time_execution = datetime.datetime.fromisoformat(f"{date_str} {time_str}")
+    elif date_str is not None:
+        time_execution = datetime.datetime.combine(datetime.date.fromisoformat(date_str[:10]), datetime.time(hour=8,minute=0))
+    elif time_str is not None:
+        time_execution = datetime.datetime.combine(datetime.datetime.utcnow().date(), datetime.time.fromisoformat(time_str))
+    elif dt_str is not None:
+        time_execution = datetime.datetime.fromisoformat(dt_str)
+    else:
+        time_execution = None
+
+    if (dt_str is not None) and (date_str is not None or time_str is not None):
+        remaining.append((TransactionEvent.DT_FLAG, dt_str))
+    return time_execution, broker, is_dividend, remaining
+
+def parse_commands(cmd_str, batch=None, last_ticker=None):
+    '''
+    Parses a command string into a TransactionBatch.
+
+    Transactions are separated by commas or new lines. Each one is an optional ticker (the
+    previous ticker is used when it is left out), the number of shares, the price per share
+    and any flags (`-div`, `-b <broker>`, `-date <yyyy-mm-dd>`, `-t <hh:mm:ss>`,
+    `-dt <yyyy-mm-dd hh:mm:ss>`). Empty transactions (blank lines, trailing commas) are skipped.
+
+    Parameters
+    ----------
+    cmd_str: str
+    batch: TransactionBatch, optional
+        Batch to append to (a new one by default)
+    last_ticker: str, optional
+        Ticker for a first transaction without one (i.e. when a long command is parsed in pieces)
+
+    Raises
+    ------
+    CommandSyntaxError
+        With the position of the first token that cannot be parsed
+    '''
+    if batch is None:
+        batch = TransactionBatch()
+    command = cmd_str.lower()
+
+    resolved_flags = {}     #flag strings repeat a lot (i.e. DRIP histories), so each one is resolved once
+    item, pos, length = 0, 0, len(command)
+    while pos < length:
+        match = ITEM_RE.match(command, pos)
+        if match is not None:
+            ticker = match.group('ticker') or last_ticker
+            flags  = match.group('flags')
+            resolved = resolved_flags.get(flags)
+            if resolved is None:
+                try:
+                    resolved = resolved_flags[flags] = resolve_flags(FLAG_RE.findall(flags))
+                except ValueError:
+                    resolved = None
+            if (ticker is not None) and (resolved is not None):
+                time_execution, broker, is_dividend, remaining = resolved
+                batch.append(ticker, match.group('num_shares'), match.group('cost_basis'), time_execution,
+                             broker, is_dividend, list(remaining), match.start('num_shares') if match.group('ticker') is None else match.start('ticker'))
+                last_ticker = ticker
+                pos  = match.end()
+                item += 1
+                continue
+
+        #irregular or invalid transaction: tokenize it to parse it or to locate the error
+        separator = SEPARATOR_RE.search(command, pos)
+        end = length if separator is None else separator.start()
+        last_ticker = _parse_tokens(batch, command, pos, end, item, last_ticker)
+        pos  = end + 1
+        item += 1
+    return batch
+
+def _parse_tokens(batch, command, start, end, item, last_ticker):
+    '''Parses the transaction in command[start:end] token by token. Returns the current ticker'''
+    ticker, numbers, flags, item_start, time_position = None, [], [], None, None
+    for match in TOKEN_RE.finditer(command, start, end):
+        kind     = match.lastgroup
+        position = match.start()
+        if item_start is None:
+            item_start = position
+
+        if kind == 'number':
+            if len(numbers) >= 2:
+                raise CommandSyntaxError("Unexpected number (a transaction has only shares and price)", command, position, item)
+            numbers.append(match.group('number'))
+        elif kind in ('flag','value'):
+            flags.append((match.group('flag'), match.group('value') or ''))
+            if (time_position is None) and (match.group('flag') in _TIME_FLAGS):
+                time_position = position
+        elif kind == 'word':
+            if (ticker is not None) or (len(numbers) > 0):
+                raise CommandSyntaxError(f"Unexpected word '{match.group('word')}' (the ticker goes first)", command, position, item)
+            ticker = match.group('word')
+        else:
+            raise CommandSyntaxError(f"Invalid token '{match.group('error')}'", command, position, item)
+
+    if item_start is None:
+        return last_ticker      #empty transaction
+    if ticker is None:
+        if last_ticker is None:
+            raise CommandSyntaxError("Missing ticker symbol", command, item_start, item)
+        ticker = last_ticker
+    if len(numbers) < 2:
+        raise CommandSyntaxError("Expected number of shares and price per share", command, item_start, item)
+    try:
+        time_execution, broker, is_dividend, remaining = resolve_flags(flags)
+    except ValueError as e:
+        raise CommandSyntaxError(f"Invalid date or time ({e})", command, time_position, item) from None
+
+    batch.append(ticker, numbers[0], numbers[1], time_execution, broker, is_dividend, remaining, item_start)
+    return ticker
 
 def command_parser(cmd_str):   #aka get_ticker_dict_data
     """Processes a command str without the instruction word ('add','sell','sub','buy',etc)"""
-    #clean-up process
-    cmd_str          = cmd_str.lower().strip()
-    raw_transactions = [transaction.strip() for transaction in cmd_str.split(',')]   #each transaction is separated by a comma
-    
-    #patterns
-    ticker_pattern = r"[a-zA-Z]+"  #could use some alteration of r"(?<!-)[a-zA-Z]+" to ignore flags, but it is already taken care of
-    
-    #================MAIN LOOP
-    last_ticker = ''
-    transactions_dict = {}   #dict to map ticker symbol to list of TransactionEvent objects
-    
-    flag_idx=0
-    for idx, trans_str in enumerate(raw_transactions):
-
-        #Parse flags
-        flags,trans_str = get_flags(trans_str)  #returns flags and a new string without flags
-
-        # Match the ticker symbol
-        res = re.match(ticker_pattern,trans_str)
-        if res:
-            ticker = res.group()
-            trans_str = re.sub(ticker,'',trans_str).strip()  #remove ticker from string
-            
-            if ticker!=last_ticker:          #reset flag index only when new ticker is different  (to prevent cases when user enters same ticker explicitely i.e: add nrz 0.3 200, nrz 4 10.5)
-                flag_idx  =0
-            else:
-                flag_idx += 1
-        else:
-            if len(last_ticker) > 0:
-                ticker    = last_ticker
-                flag_idx += 1
-            else:
-                print(f"Could not find valid ticker symbol in '{trans_str}' string.\n" + \
-                      f"Full command string:\n'{cmd_str}'")
-                raise ValueError
-        
-        
-        
-        #Determine the parameters of the transaction (amount, cost_basis, etc)
-        trans_items = trans_str.split()
-        num_shares  = trans_items[0]
-        cost_basis  = trans_items[1]
-        
-        t = TransactionEvent(ticker=ticker,
-                             amount=num_shares,
-                             cost_basis=cost_basis,
-                             flags=flags)
-        try:
-            transactions_dict[ticker].append(t)
-        
-        except KeyError:
-            transactions_dict[ticker] = [t]   #create list with first item
-        last_ticker = ticker
-    
-    return transactions_dict 
+    return parse_commands(cmd_str).to_tickers_dict()
 
 def command_engine(command_str):
     '''
@@ -205,9 +400,14 @@ def command_engine(command_str):
     Parameters
     ----------
     command_str: str
-        The string to parse. It should contain comma-separated transactions. For example:
+        The string to parse. It should contain transactions separated by commas or new
+        lines. For example:
         aapl 3.5 148.5 -div -b robinhood, msft 10 220.8 -b robinhood, nrz 5 9.68
 
+    Raises
+    ------
+    CommandSyntaxError
+        (a ValueError) with the position of the token that could not be parsed
     
     Returns
     -------
@@ -233,7 +433,7 @@ def get_flags(flag_string):
     Sample string: 
     s  = 'python main.py -f hello -d  -broker          robinhood -t 2000-10-01           14:44:20.999 -D -R'
 
-    result from re.findall(wp,s):
+    result from get_flags(s)[0]:
 
         [('f', 'hello'),
         ('d', ''),
@@ -242,16 +442,6 @@ def get_flags(flag_string):
         ('D', ''),
         ('R', '')]
     """
-    word_pattern     = r"[a-zA-Z]+"
-    #time_pattern     = r"[0-9]+\:[0-9]+\:[0-9]+\.[0-9]+"   #this pattern is not flexible
-    time_pattern = r"[0-9\:\.]+"
-    datetime_pattern = f"[0-9]+\-[0-9]+\-[0-9]+\s*{time_pattern}"
-    #wp = r"\s*-([a-zA-Z]+)\s*([a-zA-Z]+|[0-9]+\-[0-9]+\-[0-9]+\s*[0-9\:\.]+|\s*)"  #this string was tested to work sufficiently well for a well formatted string like
-
-    wp = f"\s*-([a-zA-Z]+)\s*({word_pattern}|{datetime_pattern}|{time_pattern}|\s*)"
-    
-    flags = re.findall(wp,flag_string)
-
-    clean_string = re.sub(wp,'',flag_string)
-    #print(f"--> get_flags():\n\t{flags}\n\tOriginal String: {flag_string}")
-    return flags,clean_string
\ No newline at end of file
+    flags = _FLAGS_RE.findall(flag_string)
+    clean_string = _FLAGS_RE.sub('',flag_string)
+    return flags,clean_string
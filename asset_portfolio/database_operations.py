@@ -6,6 +6,7 @@ import yfinance as yf
 import pandas as pd
 
 from flask import Flask
+import datetime
 import os
 import sys
 
@@ -13,87 +14,170 @@ from models import db
 from models import (Security, Transaction, Broker, 
                     Event, CryptoCurrency, CryptoWallet, Dividend)
 
-from tools import get_symbol_to_id_dict, webscrape_tipranks, get_mysql_uri
+from tools import (get_symbol_to_id_dict, webscrape_tipranks, get_mysql_uri,
+                   fetch_concurrently, upsert_rows,
+                   FileCache, HttpFetcher)
+from table_updaters import update_positions_table
+from migrate_database import migrate_database
+from asof_engine import invalidate_position_snapshots, update_position_snapshots
+from price_store import get_price_store
+from query_profiler import install_query_profiler, profile_job
 
 import yaml
 #=================================================
-
-def events_table_updater(db):
-    '''Uses yfinance library to collect split events and stores them in the database'''
+DIVIDENDS_CACHE_FOLDER = os.path.join('db_files','html_cache')
+
+
+def fetch_yfinance_splits(symbol):
+    '''Split history of `symbol` as a pandas Series (split factor indexed by date)'''
+    return yf.Ticker(symbol).splits
+
+def _to_naive_datetime(date):
+    date = pd.Timestamp(date)
+    if date.tzinfo is not None:
+        date = date.tz_localize(None)   #keeps the local date of the exchange
+    return date.to_pydatetime()
+
+def events_table_updater(db, fetcher=fetch_yfinance_splits, max_workers=8, rate_limit=4.0, retries=3, backoff=1.0):
+    '''
+    Uses yfinance library to collect split events and stores them in the database.
+
+    Split histories are fetched concurrently through a bounded thread pool with a rate limit
+    and retries. New events are deduplicated against the `(symbol_id, event_date)` keys already
+    stored (loaded with a single query) and inserted in bulk with one commit.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    fetcher: callable
+        Function that takes a symbol and returns its split history as a pandas Series
+        indexed by date. Defaults to yfinance; a local stub can be used for testing.
+    max_workers: int
+        Number of concurrent fetches
+    rate_limit: float or None
+        Maximum number of fetches started per second (None for no limit)
+    retries: int
+        Number of retries for a failed fetch
+    backoff: float
+        Seconds to wait before the first retry. It doubles on each retry
+
+    Returns
+    -------
+    dict
+        Number of new split events stored for each symbol
+    '''
+    event_type = 'split'
     sec_dict = get_symbol_to_id_dict(db)
     
-    for symbol in sec_dict:
-        events_df = pd.DataFrame(yf.Ticker(symbol).splits)
-
-        if len(events_df) < 1:
+    splits_by_symbol, errors = fetch_concurrently(fetcher, list(sec_dict),
+                                                  max_workers=max_workers,
+                                                  rate_limit=rate_limit,
+                                                  retries=retries,
+                                                  backoff=backoff)
+    for symbol in errors:
+        print(f"\nSymbol: {symbol.upper()}\n--> Could not fetch splits: {errors[symbol]}")
+
+    existing_keys = set(db.session.query(Event.symbol_id, Event.event_date).filter(Event.event_type==event_type).all())
+
+    new_rows = []
+    new_events_per_symbol = {}
+    earliest_dates        = {}    #position snapshots after a new split are stale
+    for symbol in splits_by_symbol:
+        symbol_id = sec_dict[symbol]
+        splits    = splits_by_symbol[symbol]
+        if splits is None:
             continue
-        
-        #Retrive security from database to link to event
-        SEC_object = db.session.query(Security).filter(Security.symbol==symbol).first()
-
-        for row in events_df.itertuples():
-            date         = row.Index   #should be a datetime object
-            split_factor = row[1]
-            event_type   = 'split'
-
-            #Check that the event is not already in the database
-            existing_match = db.session.query(Event).filter(Event.event_type == event_type,
-                                                            Event.symbol_id  == sec_dict[symbol],
-                                                            Event.event_date == date).first()
-            if existing_match is None:
-                EVENT_obj = Event(event_type   = event_type,
-                                  event_date   = date,
-                                  split_factor = split_factor,)
-                #link event to security
-                SEC_object.events.append(EVENT_obj)
-                db.session.add(EVENT_obj)
-
-                print(f"\nSymbol: {SEC_object.symbol.upper()}\n--> Added:\n{EVENT_obj}")
-            else:
-                print(f"\nSymbol: {SEC_object.symbol.upper()}\n--> <{existing_match}> already exists in database")
 
+        for date, split_factor in splits.items():
+            date = _to_naive_datetime(date)
+            if (symbol_id, date) in existing_keys:
+                continue
+            existing_keys.add((symbol_id, date))
+
+            new_rows.append({
+                'symbol_id'    : symbol_id,
+                'event_type'   : event_type,
+                'event_date'   : date,
+                'split_factor' : float(split_factor),
+            })
+            if (symbol_id not in earliest_dates) or (date < earliest_dates[symbol_id]):
+                earliest_dates[symbol_id] = date
+            new_events_per_symbol[symbol] = new_events_per_symbol.get(symbol, 0) + 1
+
+    #the unique index on (symbol_id, event_type, event_date) makes this safe against concurrent refreshes
+    upsert_rows(db, Event, new_rows, key_columns=['symbol_id','event_type','event_date'])
+    invalidate_position_snapshots(db, earliest_dates)
     db.session.commit()
 
-def dividends_table_updater(db):
+    print(f"\n--> Added {len(new_rows)} new split events for {len(new_events_per_symbol)} symbols: {new_events_per_symbol}")
+    return new_events_per_symbol
+
+def get_payment_schedule(schedule_type, div_pay_date):
+    '''Maps the schedule scraped from tipranks to the codes in `Dividend.SCHEDULE_DICT`'''
+    if schedule_type=='monthly':
+        pay_schedule = 0
+    elif schedule_type=='quarterly':
+        pay_schedule = ((div_pay_date.month - 1) % 3) + 1 #Jan,Apr,July,Oct -> 1; Feb,May,Aug,Nov -> 2; Mar,June,Sep,Dec -> 3
+    elif schedule_type in ('semi','semiannual','biannual','bi'):    #the scraped word stops at the first hyphen
+        pay_schedule = 4
+    elif schedule_type=='irregular':
+        pay_schedule = 5
+    elif schedule_type is None:
+        pay_schedule = -1
+    else:
+        pay_schedule = -1
+    return pay_schedule
+
+def dividends_table_updater(db, max_workers=8, max_per_host=2, cache_ttl=12*3600, cache_folder=DIVIDENDS_CACHE_FOLDER, retries=2, force=False):
+    '''
+    Scrapes the latest dividend information of every security and stores it in the database.
+
+    Pages are downloaded concurrently through a shared HTTP session that allows at most
+    `max_per_host` simultaneous requests per host, and raw responses are cached on disk
+    for `cache_ttl` seconds. Symbols whose stored ex-dividend date has not passed yet are
+    skipped (unless `force` is True), since their information cannot have changed. All the 
+    dividend rows are written with one bulk upsert and a single commit.
+
+    Returns
+    -------
+    list of str
+        Symbols whose dividend information was refreshed
+    '''
     sec_dict = get_symbol_to_id_dict(db)
+    stored_exdividend_dates = dict(db.session.query(Dividend.symbol_id, Dividend.exdividend_date).all())
 
+    now = datetime.datetime.now()
+    symbols_to_fetch = []
     for symbol in sec_dict:
-        symbol_id = sec_dict[symbol]
-        #events_df = pd.DataFrame(yf.Ticker(symbol).splits)
-
-        #Retrive security from database to link to dividend
-        SEC_object = db.session.query(Security).filter(Security.symbol==symbol).first()
-
-        _, _, div_amount, ex_div_date, div_pay_date, schedule_type, *extras = webscrape_tipranks(symbol)
-        if schedule_type=='monthly':
-            pay_schedule = 0
-        elif schedule_type=='quarterly':
-            pay_schedule = (div_pay_date.month % 3) + 1 #this will make the value between [1-3]
-        elif schedule_type is None:
-            pay_schedule = -1
-        else:
-            pay_schedule = -1
-
-        DIVIDEND_OBJ = db.session.query(Dividend).filter(Dividend.symbol_id==symbol_id).first()
-        
-        if DIVIDEND_OBJ is None:
-            DIVIDEND_OBJ = Dividend(dividend_amount  =div_amount,
-                                    exdividend_date  =ex_div_date,
-                                    payment_date     =div_pay_date,
-                                    payment_schedule =pay_schedule,) 
-            SEC_object.dividends.append(DIVIDEND_OBJ)
-            db.session.add(DIVIDEND_OBJ)
-        else:
-            update_dict = {
-                'dividend_amount'  : div_amount,
-                'payment_schedule' : pay_schedule,
-                'exdividend_date'  : ex_div_date,
-                'payment_date'     : div_pay_date,
-            }
-            DIVIDEND_OBJ.dividend_amount = div_amount
-            db.session.query(Dividend).filter_by(symbol_id=symbol_id).update(update_dict)
-
-        db.session.commit()
+        exdividend_date = stored_exdividend_dates.get(sec_dict[symbol])
+        if (not force) and (exdividend_date is not None) and (exdividend_date > now):
+            continue
+        symbols_to_fetch.append(symbol)
+
+    fetcher = HttpFetcher(max_per_host=max_per_host, cache=FileCache(cache_folder, ttl=cache_ttl, suffix='.html'))
+    scraped, errors = fetch_concurrently(lambda symbol: webscrape_tipranks(symbol, fetcher=fetcher), 
+                                         symbols_to_fetch,
+                                         max_workers=max_workers,
+                                         retries=retries)
+    for symbol in errors:
+        print(f"\nSymbol: {symbol.upper()}\n--> Could not scrape dividends: {errors[symbol]}")
+
+    rows = []
+    for symbol in scraped:
+        _, _, div_amount, ex_div_date, div_pay_date, schedule_type, *extras = scraped[symbol]
+        rows.append({
+            'symbol_id'        : sec_dict[symbol],
+            'dividend_amount'  : div_amount,
+            'payment_schedule' : get_payment_schedule(schedule_type, div_pay_date),
+            'exdividend_date'  : ex_div_date,
+            'payment_date'     : div_pay_date,
+        })
+
+    upsert_rows(db, Dividend, rows, key_columns=['symbol_id'],
+                update_columns=['dividend_amount','payment_schedule','exdividend_date','payment_date'])
+    db.session.commit()
+
+    return list(scraped)
 
 if __name__ == '__main__':
     #Here we define a database connection
@@ -126,8 +210,28 @@ if __name__ == '__main__':
         func_to_run = 'splits'
 
     db.init_app(app)
+    install_query_profiler(app, db)
     with app.app_context():
-        if func_to_run=='splits':
-            events_table_updater(db)
-        elif func_to_run=='dividends':
-            dividends_table_updater(db)
\ No newline at end of file
+        migrate_database(db)    #the upserts below rely on the unique indexes
+        with profile_job(func_to_run):     #prints the number of queries and the time spent in the database
+            if func_to_run=='splits':
+                new_events_per_symbol = events_table_updater(db)
+                #split-adjusted prices of those symbols change all the way back
+                store = get_price_store()
+                stored_symbols = [symbol for symbol in new_events_per_symbol if store.get_meta(symbol) is not None]
+                if len(stored_symbols) > 0:
+                    store.backfill_from_yfinance(stored_symbols, full_refresh=stored_symbols)
+            elif func_to_run=='dividends':
+                dividends_table_updater(db)
+            elif func_to_run=='positions':
+                #re-sync every position, i.e. after new splits were collected
+                update_positions_table(db, get_symbol_to_id_dict(db).keys())
+            elif func_to_run=='prices':
+                #daily price history of every security, used by the valuation engine
+                errors = get_price_store().backfill_from_yfinance(get_symbol_to_id_dict(db).keys())
+                for symbol in errors:
+                    print(f"--> Could not download prices for {symbol.upper()}: {errors[symbol]}")
+            elif func_to_run=='snapshots':
+                #monthly snapshots used by the "positions as of date" queries
+                num_snapshots = update_position_snapshots(db)
+                print(f"--> Wrote {num_snapshots} position snapshots")
\ No newline at end of file
@@ -0,0 +1,89 @@
+'''
+Projected dividend income.
+
+The latest dividend of every symbol (`current_dividends` table) is expanded by its
+`payment_schedule` code (see `Dividend.SCHEDULE_DICT`) into the calendar months it is paid
+in, and multiplied by the split-adjusted shares held (`security_positions` table). The
+result is a symbols x 12 months matrix of expected payments, built for all symbols in one
+vectorized pass and cached until the dividends or the positions change.
+
+    0       monthly             every month
+    1,2,3   quarterly           every third month, in the cycle of the month of the last payment
+                                (the code only picks the cycle when that month is unknown)
+    4       bi-annual           the month of the last payment and six months later
+    5, -1   irregular, N/A      only the month of the last payment
+'''
+import numpy as np
+import pandas as pd
+
+from models import Security, Position, Dividend
+from tools import get_positions_fingerprint, get_dividends_fingerprint
+from ledger_cache import get_cached, get_ledger_version
+
+MONTHS = ('Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec')
+
+
+def get_dividends_df(db):
+    '''Latest dividend and shares held of every symbol with a dividend and shares'''
+    sql_statement = db.session.query(
+                        Security.symbol,
+                        Dividend.dividend_amount,
+                        Dividend.payment_schedule,
+                        Dividend.payment_date,
+                        Position.total_shares,
+                        ).join(Security, Security.id==Dividend.symbol_id
+                        ).join(Position, Position.symbol_id==Dividend.symbol_id
+                        ).filter(Position.total_shares > 0, Dividend.dividend_amount > 0
+                        ).order_by(Security.symbol.asc()).statement
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    df['dividend_amount'] = df['dividend_amount'].astype(float)
+    df['total_shares']    = df['total_shares'].astype(float)
+    df['payment_date']    = pd.to_datetime(df['payment_date'])
+    return df
+
+def schedule_months(schedules, payment_months):
+    '''
+    Boolean symbols x 12 matrix with the months each symbol pays in.
+
+    Parameters
+    ----------
+    schedules: numpy.ndarray of int
+        `payment_schedule` codes (-1 for unknown)
+    payment_months: numpy.ndarray of int
+        Month (1-12) of the last payment, or 0 when it is unknown
+    '''
+    schedules = np.asarray(schedules, dtype=np.int64)[:, None]
+    last_paid = np.asarray(payment_months, dtype=np.int64)[:, None] - 1
+    months    = np.arange(12)[None, :]
+
+    #the quarterly cycle comes from the last payment: codes stored before the fix of
+    #`get_payment_schedule` are off by one month and are only trusted without a payment date
+    cycle     = np.where(last_paid >= 0, last_paid % 3, schedules - 1)
+    monthly   = schedules == 0
+    quarterly = ((schedules >= 1) & (schedules <= 3)) & (months % 3 == cycle)
+    biannual  = (schedules == 4) & (last_paid >= 0) & (months % 6 == last_paid % 6)
+    once      = ((schedules == 5) | (schedules < 0)) & (months == last_paid)
+    return monthly | quarterly | biannual | once
+
+def build_dividend_calendar(db):
+    '''
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by symbol, one column per month (`MONTHS`) with the income expected in that
+        month of the year
+    '''
+    df = get_dividends_df(db)
+    schedules      = df['payment_schedule'].fillna(-1).to_numpy(dtype=np.int64)
+    payment_months = df['payment_date'].dt.month.fillna(0).to_numpy(dtype=np.int64)
+
+    per_payment = (df['dividend_amount'] * df['total_shares']).to_numpy()
+    calendar    = schedule_months(schedules, payment_months) * per_payment[:, None]
+    return pd.DataFrame(calendar, index=pd.Index(df['symbol'], name='symbol'), columns=MONTHS)
+
+def get_dividend_version(db):
+    return (get_ledger_version(), get_positions_fingerprint(db), get_dividends_fingerprint(db))
+
+def get_cached_dividend_calendar(db):
+    '''`build_dividend_calendar`, rebuilt only when the dividends or the positions change'''
+    return get_cached('dividend_calendar', get_dividend_version(db), lambda: build_dividend_calendar(db))
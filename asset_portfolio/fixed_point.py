@@ -0,0 +1,193 @@
+'''Fixed-point (scaled int64) representation of the ledger.
+
+`num_shares` and `total_shares` have 9 decimals and money columns have 5, so they are read
+from the database already multiplied by 1e9 and 1e5 and cast to integers. Sums, split
+adjustments and cost basis are then computed with exact integer math on NumPy arrays and
+values only become `decimal.Decimal` again when they are written back (`from_fixed`).
+
+Invested amounts are rounded to 1e-5 per transaction. Split factors are turned into
+fractions (i.e. a 1:10 reverse split is 1/10), shares are summed per symbol and per "split
+segment" (transactions sharing the same later splits) and only those few group totals are
+multiplied by the cumulative factor, so the per transaction work stays in int64.
+'''
+import decimal
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from models import db, Transaction, Position
+from split_engine import first_later_split, SHARES_DECIMALS, CURRENCY_DECIMALS
+
+SHARES_SCALE   = 10**SHARES_DECIMALS
+CURRENCY_SCALE = 10**CURRENCY_DECIMALS
+
+#split factors are stored as Numeric(20,10); this is plenty to recover ratios like 2/3
+MAX_SPLIT_DENOMINATOR = 10**6
+
+
+def scaled_column(column, decimals):
+    '''SQL expression that reads a Numeric `column` as an integer scaled by 10**`decimals`'''
+    scaled = db.func.round(column * db.literal_column(str(10**decimals)))
+    return db.cast(scaled, db.BigInteger).label(column.key)
+
+def to_fixed(value, decimals):
+    '''Converts a number (Decimal, int, str or float) into an int scaled by 10**`decimals`'''
+    scaled = decimal.Decimal(str(value)).scaleb(decimals)
+    return int(scaled.to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
+
+def from_fixed(value, decimals):
+    '''Converts an int scaled by 10**`decimals` back into a decimal.Decimal'''
+    return decimal.Decimal(int(value)).scaleb(-decimals)
+
+def round_fraction(numerator, denominator):
+    '''Rounds numerator/denominator to the nearest int (ties to even), without floats'''
+    return round(Fraction(int(numerator), int(denominator)))
+
+def average_cost(invested, total_shares):
+    '''Cost basis per share (currency scale) from scaled `invested` and `total_shares`. 0 without shares'''
+    if total_shares == 0:
+        return 0
+    return round_fraction(invested * SHARES_SCALE, total_shares)
+
+def load_ledger(db, symbol_ids=None, newer_than_positions=False):
+    '''
+    Reads the transactions needed for computing positions with `num_shares` and `cost_basis`
+    as scaled int64 columns, sorted by symbol and execution time.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    symbol_ids: iterable of int, optional
+        Symbols to read (all symbols if None)
+    newer_than_positions: bool
+        Only read transactions with an id above `Position.last_transaction_id` of their
+        symbol (the ones not yet included in the stored positions)
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns `id`, `symbol_id`, `time_execution`, `num_shares` (int64, 1e-9 shares),
+        `cost_basis` (int64, 1e-5 currency) and `last_updated`
+    '''
+    query = db.session.query(
+                Transaction.id,
+                Transaction.symbol_id,
+                Transaction.time_execution,
+                scaled_column(Transaction.num_shares, SHARES_DECIMALS),
+                scaled_column(Transaction.cost_basis, CURRENCY_DECIMALS),
+                Transaction.last_updated,
+                )
+    if newer_than_positions:
+        #transactions are only ever inserted, so ids are an exact high-water mark (times only have seconds)
+        query = query.join(Position, Position.symbol_id==Transaction.symbol_id).filter(
+                    Transaction.id > Position.last_transaction_id)
+    if symbol_ids is not None:
+        query = query.filter(Transaction.symbol_id.in_(list(symbol_ids)))
+    sql_statement = query.order_by(Transaction.symbol_id.asc(), Transaction.time_execution.asc()).statement
+
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    df['num_shares'] = df['num_shares'].astype(np.int64)
+    df['cost_basis'] = df['cost_basis'].astype(np.int64)
+    return df
+
+def split_ratios(split_factors):
+    '''Converts split factors (Decimal or float) into exact fractions'''
+    return [Fraction(str(factor)).limit_denominator(MAX_SPLIT_DENOMINATOR) for factor in split_factors]
+
+def exact_invested(num_shares, cost_basis):
+    '''
+    Exact `num_shares * cost_basis` for scaled int64 arrays, without overflowing int64.
+
+    The product has 14 decimals, so shares are split as hi*1e9 + mid*1e5 + lo and each partial
+    product is folded into the next one with `divmod`. The result is returned as a whole part
+    in currency scale plus a remainder in units of 1e-9 of that scale.
+
+    Returns
+    -------
+    whole: numpy.ndarray of int64
+        Invested amount (1e-5 currency) rounded down
+    remainder: numpy.ndarray of int64
+        What was rounded down, in [0, 1e9)
+    '''
+    num_shares = np.asarray(num_shares, dtype=np.int64)
+    cost_basis = np.asarray(cost_basis, dtype=np.int64)
+
+    hi, lo  = np.divmod(num_shares, SHARES_SCALE)
+    mid, lo = np.divmod(lo, CURRENCY_SCALE)
+
+    lo_carry, lo_rest   = np.divmod(lo * cost_basis, CURRENCY_SCALE)
+    mid_carry, mid_rest = np.divmod(mid * cost_basis + lo_carry, SHARES_SCALE // CURRENCY_SCALE)
+
+    whole     = hi * cost_basis + mid_carry
+    remainder = mid_rest * CURRENCY_SCALE + lo_rest
+    return whole, remainder
+
+def rounded_invested(num_shares, cost_basis):
+    '''
+    `num_shares * cost_basis` of every transaction rounded to currency scale (ties to even).
+    Rounding each transaction, instead of the total, keeps sums associative: a full rebuild,
+    an incremental update and a replay from a snapshot add up to exactly the same amount.
+    '''
+    whole, remainder = exact_invested(num_shares, cost_basis)
+    half = SHARES_SCALE // 2
+    round_up = (remainder > half) | ((remainder == half) & (whole % 2 == 1))
+    return whole + round_up.astype(np.int64)
+
+def aggregate_positions_fixed(ledger_df, splits_df):
+    '''
+    Fixed-point version of `split_engine.aggregate_positions`.
+
+    Parameters
+    ----------
+    ledger_df: pandas.DataFrame
+        As returned by `load_ledger`
+    splits_df: pandas.DataFrame
+        Split events with columns `symbol_id`, `event_date` and `split_factor`
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by `symbol_id`, with int columns `total_shares` (1e-9 shares), `invested` and
+        `cost_basis` (1e-5 currency). `cost_basis` is 0 when there are no shares left.
+    '''
+    segments, order = first_later_split(ledger_df['symbol_id'].to_numpy(), ledger_df['time_execution'],
+                                        splits_df['symbol_id'].to_numpy(), splits_df['event_date'])
+
+    #cumulative factor of each split and every later split of the same symbol
+    split_symbols = splits_df['symbol_id'].to_numpy()[order]
+    ratios        = split_ratios(splits_df['split_factor'].to_numpy()[order])
+    cum_ratios    = [None]*len(ratios)
+    for idx in reversed(range(len(ratios))):
+        if (idx+1 < len(ratios)) and (split_symbols[idx+1] == split_symbols[idx]):
+            cum_ratios[idx] = ratios[idx] * cum_ratios[idx+1]
+        else:
+            cum_ratios[idx] = ratios[idx]
+
+    columns = pd.DataFrame({
+        'symbol_id'  : ledger_df['symbol_id'].to_numpy(dtype=np.int64),
+        'segment'    : segments,
+        'num_shares' : ledger_df['num_shares'].to_numpy(dtype=np.int64),
+        'invested'   : rounded_invested(ledger_df['num_shares'].to_numpy(), ledger_df['cost_basis'].to_numpy()),
+    })
+    shares_by_segment = columns.groupby(['symbol_id','segment'])['num_shares'].sum()
+    invested_totals   = columns.groupby('symbol_id')['invested'].sum()
+
+    total_shares = {}
+    for (symbol_id, segment), num_shares in shares_by_segment.items():
+        adjusted = Fraction(int(num_shares)) if segment < 0 else int(num_shares) * cum_ratios[segment]
+        total_shares[symbol_id] = total_shares.get(symbol_id, 0) + adjusted
+
+    rows = {}
+    for symbol_id, invested in invested_totals.items():
+        shares   = round(total_shares[symbol_id])
+        invested = int(invested)
+        rows[symbol_id] = {
+            'total_shares' : shares,
+            'invested'     : invested,
+            'cost_basis'   : average_cost(invested, shares),
+        }
+
+    positions = pd.DataFrame.from_dict(rows, orient='index', columns=['total_shares','invested','cost_basis'], dtype=object)
+    positions.index.name = 'symbol_id'
+    return positions
@@ -20,5 +20,10 @@ class RegisterBrokerForm(FlaskForm):
 
 class CheckEntryForm(FlaskForm):
     table = SelectField('Table',choices=[(0,'securities'),(1,'transactions'),(2,'brokers'),(3,'crypto'),(4,'wallets'),(5,'events'),(6,'positions'),(7,'dividends')])
-    rows_to_show = StringField('Rows to Show (from latest; default: all)',default='all')
+    rows_to_show = StringField('Rows per Page (from latest; "all" shows every row)',default='50')
+    columns   = StringField('Columns to Show (comma-separated; default: all)')
+    symbol    = StringField('Filter by Symbol (optional)')
+    broker    = StringField('Filter by Broker (optional)')
+    date_from = StringField('From Date (optional, i.e. 2021-01-31)')
+    date_to   = StringField('To Date (optional, i.e. 2021-12-31)')
     submit = SubmitField('Submit')
\ No newline at end of file
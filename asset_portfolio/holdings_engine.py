@@ -0,0 +1,55 @@
+'''
+Holdings split by holding period: shares held for longer than a year (long term capital 
+gains) and shares bought more recently (short term).
+
+Holdings are the open lots left by the lot engine (`lot_engine.py`), so shares that were
+already sold are taken out of the lots they were matched with instead of being netted
+against the most recent purchases. Lots are cached under the ledger version; only the
+bucketing by age is done per day.
+'''
+import datetime
+
+from tools import get_id_to_symbol_dict, get_positions_fingerprint
+from split_engine import SHARES_DECIMALS, CURRENCY_DECIMALS
+from lot_engine import get_cached_lot_engine
+from ledger_cache import get_cached, get_ledger_version
+
+def get_holdings_by_term(db, now=None, method='fifo'):
+    '''
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    now: datetime or None
+        Reference time for the holding period (default: current UTC time)
+    method: str
+        Lot matching method (see `lot_engine.METHODS`)
+
+    Returns
+    -------
+    long_term_df, short_term_df: pandas.DataFrame
+        Columns `symbol`, `num_shares` (split-adjusted) and `invested`
+    '''
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    lots = get_cached_lot_engine(db, method).open_lots_df(now)
+    lots['num_shares'] = lots['num_shares'].astype(float) / 10**SHARES_DECIMALS
+    lots['invested']   = lots['invested'].astype(float) / 10**CURRENCY_DECIMALS
+
+    by_term = lots.groupby(['term','symbol_id'])[['num_shares','invested']].sum().reset_index()
+    by_term['symbol'] = by_term['symbol_id'].map(get_id_to_symbol_dict(db))
+
+    columns = ['symbol','num_shares','invested']
+    long_term_df  = by_term[by_term['term']=='long'][columns].reset_index(drop=True)
+    short_term_df = by_term[by_term['term']=='short'][columns].reset_index(drop=True)
+    return long_term_df, short_term_df
+
+def get_cached_holdings_by_term(db):
+    '''
+    Same as `get_holdings_by_term`, but cached for the current day. The long term boundary
+    only moves once a day, so results are reused until the date changes or the ledger does.
+    '''
+    today   = datetime.datetime.utcnow().date()
+    version = (today, get_ledger_version(), get_positions_fingerprint(db))
+    start_of_day = datetime.datetime.combine(today, datetime.time.min)
+    return get_cached('holdings_by_term', version, lambda: get_holdings_by_term(db, now=start_of_day))
@@ -0,0 +1,51 @@
+'''
+In-process cache for values derived from the ledger (charts, aggregated tables, etc).
+
+Every function that writes transactions or positions bumps the ledger version, and cached
+values are stored together with the version they were built from. A value is only rebuilt
+when it is requested under a different version.
+'''
+import threading
+
+_lock  = threading.Lock()
+_ledger_version = 0
+_cache = {}   #name -> (version, value)
+
+def get_ledger_version():
+    return _ledger_version
+
+def bump_ledger_version():
+    '''Call after committing changes to the `transactions` or `security_positions` tables'''
+    global _ledger_version
+    with _lock:
+        _ledger_version += 1
+        return _ledger_version
+
+def get_cached(name, version, builder):
+    '''
+    Returns the value cached under `name` if it was built for `version`. Otherwise it calls
+    `builder()`, caches its result for `version` and returns it.
+
+    Parameters
+    ----------
+    name: str
+        Name of the cached value (i.e. 'home_chart')
+    version: hashable
+        Anything identifying the state the value depends on, usually `get_ledger_version()`
+        or a tuple that includes it
+    builder: callable
+        Function without arguments that computes the value
+    '''
+    with _lock:
+        cached = _cache.get(name)
+    if (cached is not None) and (cached[0] == version):
+        return cached[1]
+
+    value = builder()
+    with _lock:
+        _cache[name] = (version, value)
+    return value
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,301 @@
+'''
+Tax lots and realized gains.
+
+Every buy (positive `num_shares`) opens a lot and every sell (negative `num_shares`) closes
+shares from the open lots of its symbol, chosen by the matching method:
+
+    fifo        first in, first out (a deque, closed from the left)
+    lifo        last in, first out (a deque, closed from the right)
+    hifo        highest cost per share first (a heap)
+    specific    lots chosen per sell (by transaction id), then FIFO for the rest
+
+Each closed portion emits a realized gain tagged as long or short term. The whole ledger is
+processed in one pass ordered by execution time, with splits interleaved. A split only
+multiplies the running split multiplier of its symbol: lots keep their shares in the units
+of the multiplier they were last touched with and are converted lazily, so a split costs
+O(1) no matter how many lots are open.
+
+Shares and money are fixed-point ints (see `fixed_point.py`), so nothing is lost to floats.
+'''
+import heapq
+import datetime
+from collections import deque
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from models import Transaction
+from tools import get_split_events_df, get_positions_fingerprint
+from split_engine import SHARES_DECIMALS, CURRENCY_DECIMALS
+from fixed_point import scaled_column, split_ratios, round_fraction, from_fixed, SHARES_SCALE
+from ledger_cache import get_cached, get_ledger_version
+
+LONG_TERM_DAYS = 366
+METHODS = ('fifo','lifo','hifo','specific')
+
+
+class Lot(object):
+    __slots__ = ('transaction_id', 'symbol_id', 'open_time', 'shares', 'multiplier', 'cost')
+
+    def __init__(self, transaction_id, symbol_id, open_time, shares, multiplier, cost):
+        self.transaction_id = transaction_id
+        self.symbol_id      = symbol_id
+        self.open_time      = open_time
+        self.shares         = shares        #fixed-point shares, in the units of `multiplier`
+        self.multiplier     = multiplier    #split multiplier of the symbol when `shares` was last updated
+        self.cost           = cost          #fixed-point money paid for the remaining shares
+
+    def current_shares(self, multiplier):
+        '''Shares in the units of `multiplier` (the lot is rebased to it)'''
+        if multiplier != self.multiplier:
+            self.shares     = round(self.shares * multiplier / self.multiplier)
+            self.multiplier = multiplier
+        return self.shares
+
+    def __repr__(self):
+        return f"< Lot: transaction_id={self.transaction_id} symbol_id={self.symbol_id} open_time={self.open_time} shares={self.shares} cost={self.cost} >"
+
+
+class LotBook(object):
+    '''Open lots of one symbol for a matching method'''
+    def __init__(self, method):
+        self.method     = method
+        self.multiplier = Fraction(1)
+        self.by_id      = {}
+        self._lots      = [] if method == 'hifo' else deque()
+        self._counter   = 0
+
+    def add(self, lot):
+        if self.method == 'hifo':
+            #cost per share in base units does not change with splits
+            key = -Fraction(lot.cost * lot.multiplier, lot.shares)
+            heapq.heappush(self._lots, (key, self._counter, lot))
+            self._counter += 1
+        else:
+            self._lots.append(lot)
+        if self.method == 'specific':
+            self.by_id[lot.transaction_id] = lot
+
+    def next_lot(self):
+        '''Next lot to close (closed lots are dropped lazily), or None'''
+        if self.method == 'hifo':
+            while len(self._lots) > 0 and self._lots[0][2].shares <= 0:
+                heapq.heappop(self._lots)
+            return self._lots[0][2] if len(self._lots) > 0 else None
+
+        position = -1 if self.method == 'lifo' else 0
+        while len(self._lots) > 0 and self._lots[position].shares <= 0:
+            if position == 0:
+                self._lots.popleft()
+            else:
+                self._lots.pop()
+        return self._lots[position] if len(self._lots) > 0 else None
+
+    def open_lots(self):
+        lots = [entry[2] for entry in self._lots] if self.method == 'hifo' else self._lots
+        return [lot for lot in lots if lot.shares > 0]
+
+
+class LotEngine(object):
+    '''
+    Parameters
+    ----------
+    method: str
+        One of `METHODS`
+    specific_lots: dict, optional
+        For method 'specific': maps the id of a sell transaction to the ids of the buy
+        transactions (lots) it closes, in order. Sells not listed fall back to FIFO
+    long_term_days: int
+        Lots held at least this many days are long term
+    '''
+    def __init__(self, method='fifo', specific_lots=None, long_term_days=LONG_TERM_DAYS):
+        if method not in METHODS:
+            raise ValueError(f"Unknown lot matching method {method}. Options: {METHODS}")
+        self.method         = method
+        self.specific_lots  = specific_lots or {}
+        self.long_term_days = long_term_days
+        self.books          = {}
+        self.realized       = []
+        self.unmatched      = []    #(transaction_id, shares) sold without open lots
+
+    def _get_book(self, symbol_id):
+        book = self.books.get(symbol_id)
+        if book is None:
+            book = self.books[symbol_id] = LotBook(self.method)
+        return book
+
+    def is_long_term(self, open_time, close_time):
+        return (close_time - open_time).days >= self.long_term_days
+
+    #---------------------------------------------------------------
+    #   Events
+    #---------------------------------------------------------------
+    def apply_split(self, symbol_id, ratio):
+        self._get_book(symbol_id).multiplier *= ratio
+
+    def buy(self, transaction_id, symbol_id, time_execution, num_shares, cost):
+        book = self._get_book(symbol_id)
+        book.add(Lot(transaction_id, symbol_id, time_execution, num_shares, book.multiplier, cost))
+
+    def sell(self, transaction_id, symbol_id, time_execution, num_shares, proceeds):
+        '''`num_shares` (positive) are closed; `proceeds` is the money received for all of them'''
+        book      = self._get_book(symbol_id)
+        remaining = num_shares
+        left_proceeds = proceeds
+
+        chosen = [book.by_id.get(lot_id) for lot_id in self.specific_lots.get(transaction_id, [])]
+        lots   = iter([lot for lot in chosen if lot is not None])
+        while remaining > 0:
+            lot = next(lots, None)
+            if lot is None:
+                lot = book.next_lot()
+                if lot is None:
+                    self.unmatched.append((transaction_id, remaining))
+                    return
+            lot_shares = lot.current_shares(book.multiplier)
+            if lot_shares <= 0:
+                continue
+
+            closed = min(lot_shares, remaining)
+            if closed == lot_shares:
+                cost = lot.cost
+            else:
+                cost = round_fraction(lot.cost * closed, lot_shares)
+            part_proceeds = left_proceeds if closed == remaining else round_fraction(left_proceeds * closed, remaining)
+
+            lot.shares    -= closed
+            lot.cost      -= cost
+            remaining     -= closed
+            left_proceeds -= part_proceeds
+
+            self.realized.append({
+                'symbol_id'      : symbol_id,
+                'sell_id'        : transaction_id,
+                'lot_id'         : lot.transaction_id,
+                'open_time'      : lot.open_time,
+                'close_time'     : time_execution,
+                'num_shares'     : closed,
+                'cost'           : cost,
+                'proceeds'       : part_proceeds,
+                'gain'           : part_proceeds - cost,
+                'term'           : 'long' if self.is_long_term(lot.open_time, time_execution) else 'short',
+            })
+
+    #---------------------------------------------------------------
+    #   Streaming pass
+    #---------------------------------------------------------------
+    def process(self, ledger_df, splits_df):
+        '''
+        Runs the whole ledger in one pass. Splits are applied before transactions executed at
+        the same time or later (same rule as `split_engine.split_factors_for`).
+
+        Parameters
+        ----------
+        ledger_df: pandas.DataFrame
+            As returned by `load_lot_ledger`
+        splits_df: pandas.DataFrame
+            Split events with columns `symbol_id`, `event_date` and `split_factor`
+        '''
+        #splits and transactions merged by time; kind 0 (split) sorts before kind 1 (transaction)
+        events = pd.concat([
+            pd.DataFrame({
+                'time'      : pd.to_datetime(splits_df['event_date']),
+                'kind'      : 0,
+                'symbol_id' : splits_df['symbol_id'].to_numpy(dtype=np.int64),
+                'position'  : np.arange(len(splits_df)),
+            }),
+            pd.DataFrame({
+                'time'      : pd.to_datetime(ledger_df['time_execution']),
+                'kind'      : 1,
+                'symbol_id' : ledger_df['symbol_id'].to_numpy(dtype=np.int64),
+                'position'  : np.arange(len(ledger_df)),
+            }),
+        ], ignore_index=True).sort_values(['symbol_id','time','kind'], kind='stable')
+
+        ratios      = split_ratios(splits_df['split_factor'].to_numpy())
+        ids         = ledger_df['id'].to_numpy()
+        times       = ledger_df['time_execution'].tolist()
+        shares      = ledger_df['num_shares'].to_numpy()
+        costs       = ledger_df['cost_basis'].to_numpy()
+        for kind, symbol_id, position in zip(events['kind'].to_numpy(), events['symbol_id'].to_numpy(), events['position'].to_numpy()):
+            symbol_id = int(symbol_id)
+            if kind == 0:
+                self.apply_split(symbol_id, ratios[position])
+                continue
+
+            num_shares = int(shares[position])
+            money      = round_fraction(abs(num_shares) * int(costs[position]), SHARES_SCALE)
+            if num_shares > 0:
+                self.buy(int(ids[position]), symbol_id, times[position], num_shares, money)
+            elif num_shares < 0:
+                self.sell(int(ids[position]), symbol_id, times[position], -num_shares, money)
+        return self
+
+    #---------------------------------------------------------------
+    #   Results
+    #---------------------------------------------------------------
+    def open_lots_df(self, now=None):
+        '''
+        Open lots with shares in today's units and their term at `now` (default: current UTC time).
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns `symbol_id`, `lot_id`, `open_time`, `num_shares`, `invested` (fixed-point
+            ints) and `term`
+        '''
+        if now is None:
+            now = datetime.datetime.utcnow()
+        rows = []
+        for symbol_id, book in self.books.items():
+            for lot in book.open_lots():
+                rows.append({
+                    'symbol_id'  : symbol_id,
+                    'lot_id'     : lot.transaction_id,
+                    'open_time'  : lot.open_time,
+                    'num_shares' : lot.current_shares(book.multiplier),
+                    'invested'   : lot.cost,
+                    'term'       : 'long' if self.is_long_term(lot.open_time, now) else 'short',
+                })
+        return pd.DataFrame(rows, columns=['symbol_id','lot_id','open_time','num_shares','invested','term'])
+
+    def realized_df(self):
+        '''Realized gains with `num_shares`, `cost`, `proceeds` and `gain` as decimal.Decimal'''
+        columns = ['symbol_id','sell_id','lot_id','open_time','close_time','num_shares','cost','proceeds','gain','term']
+        df = pd.DataFrame(self.realized, columns=columns)
+        df['num_shares'] = [from_fixed(value, SHARES_DECIMALS) for value in df['num_shares']]
+        for column in ('cost','proceeds','gain'):
+            df[column] = [from_fixed(value, CURRENCY_DECIMALS) for value in df[column]]
+        return df
+
+
+def load_lot_ledger(db, symbol_ids=None):
+    '''Transactions with their id and fixed-point `num_shares` and `cost_basis`, ordered by symbol and time'''
+    query = db.session.query(
+                Transaction.id,
+                Transaction.symbol_id,
+                Transaction.time_execution,
+                scaled_column(Transaction.num_shares, SHARES_DECIMALS),
+                scaled_column(Transaction.cost_basis, CURRENCY_DECIMALS),
+                )
+    if symbol_ids is not None:
+        query = query.filter(Transaction.symbol_id.in_(list(symbol_ids)))
+    sql_statement = query.order_by(Transaction.symbol_id.asc(), Transaction.time_execution.asc(), Transaction.id.asc()).statement
+
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    df['time_execution'] = pd.to_datetime(df['time_execution'])
+    df['num_shares']     = df['num_shares'].astype(np.int64)
+    df['cost_basis']     = df['cost_basis'].astype(np.int64)
+    return df
+
+def run_lot_engine(db, method='fifo', specific_lots=None, symbol_ids=None):
+    '''Matches the lots of the whole ledger (or of `symbol_ids`) and returns the LotEngine'''
+    ledger_df = load_lot_ledger(db, symbol_ids)
+    splits_df = get_split_events_df(db, symbol_ids)
+    return LotEngine(method, specific_lots).process(ledger_df, splits_df)
+
+def get_cached_lot_engine(db, method='fifo'):
+    '''`run_lot_engine` over the whole ledger, rebuilt only when the ledger changes'''
+    version = (get_ledger_version(), get_positions_fingerprint(db))
+    return get_cached(f"lot_engine_{method}", version, lambda: run_lot_engine(db, method))
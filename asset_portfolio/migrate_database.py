@@ -0,0 +1,196 @@
+'''
+Brings an existing database up to date with the indexes and columns declared in `models.py`.
+
+`db.create_all()` only creates missing tables, so databases created by older versions of the
+app don't get the indexes added later on. Every revision below is idempotent: it checks what
+the database already has before changing anything, so `migrate_database` can run on every
+start up.
+
+Usage:
+    python migrate_database.py [mysql|sqlite]
+'''
+import os
+import sys
+
+from flask import Flask
+from sqlalchemy import inspect, text, bindparam
+
+from models import db, Security, Broker, Transaction, Event, Position, PositionSnapshot, Dividend
+from tools import get_mysql_uri, transaction_content_hash
+
+
+def get_existing_indexes(engine, table_name):
+    return {index['name'] for index in inspect(engine).get_indexes(table_name)}
+
+def get_existing_columns(engine, table_name):
+    return {column['name'] for column in inspect(engine).get_columns(table_name)}
+
+def delete_duplicate_rows(db, table_class, key_columns, chunk_size=1000):
+    '''
+    Deletes the rows of `table_class` that share the same `key_columns` values, keeping the
+    most recent one (highest id) of each group. It is needed before adding a unique index.
+    Rows with NULL in any of the `key_columns` are left alone (unique indexes allow them).
+
+    Returns
+    -------
+    int
+        Number of deleted rows
+    '''
+    table   = table_class.__table__
+    columns = [table.c[column] for column in key_columns]
+
+    latest_ids    = {}
+    ids_to_delete = []
+    for row in db.session.query(table.c.id, *columns).order_by(table.c.id).all():
+        key = tuple(row[1:])
+        if None in key:
+            continue
+        if key in latest_ids:
+            ids_to_delete.append(latest_ids[key])
+        latest_ids[key] = row[0]
+
+    for idx in range(0, len(ids_to_delete), chunk_size):
+        db.session.execute(table.delete().where(table.c.id.in_(ids_to_delete[idx:idx+chunk_size])))
+    db.session.commit()
+    return len(ids_to_delete)
+
+def create_model_indexes(db):
+    '''Creates the indexes declared in the models that are missing in the database'''
+    engine    = db.engine
+    inspector = inspect(engine)     #one inspector for every table; it only reads the schema
+    for table_class in (Transaction, Event, Position, PositionSnapshot, Dividend):
+        table    = table_class.__table__
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns  = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if any(column.name not in columns for column in index.columns):
+                continue    #the revision that adds the column also creates the index
+            if index.unique:
+                deleted = delete_duplicate_rows(db, table_class, [column.name for column in index.columns])
+                if deleted > 0:
+                    print(f"--> Removed {deleted} duplicated rows from {table.name} before creating {index.name}")
+            index.create(bind=engine)
+            print(f"--> Created index {index.name} on {table.name}")
+
+def fill_content_hashes(db, chunk_size=1000):
+    '''
+    Sets `content_hash` on the transactions without one. Identical transactions get increasing
+    occurrence numbers in the order they were inserted (see `tools.transaction_content_hash`).
+
+    Returns
+    -------
+    int
+        Number of updated rows
+    '''
+    rows = db.session.query(
+                Transaction.id,
+                Security.symbol,
+                Transaction.num_shares,
+                Transaction.cost_basis,
+                Transaction.is_dividend,
+                Transaction.time_execution,
+                Broker.name,
+                ).join(Security, Security.id==Transaction.symbol_id
+                ).join(Broker, Broker.id==Transaction.broker_id
+                ).filter(Transaction.content_hash.is_(None)
+                ).order_by(Transaction.id.asc()).all()
+    if len(rows) < 1:
+        return 0
+
+    taken   = {content_hash for content_hash, in db.session.query(Transaction.content_hash).filter(Transaction.content_hash.isnot(None))}
+    updates = []
+    for transaction_id, symbol, num_shares, cost_basis, is_dividend, time_execution, broker_name in rows:
+        occurrence   = 0
+        content_hash = transaction_content_hash(symbol, num_shares, cost_basis, is_dividend, time_execution, broker_name)
+        while content_hash in taken:
+            occurrence  += 1
+            content_hash = transaction_content_hash(symbol, num_shares, cost_basis, is_dividend, time_execution, broker_name, occurrence)
+        taken.add(content_hash)
+        updates.append({'transaction_id':transaction_id, 'new_hash':content_hash})
+
+    table = Transaction.__table__
+    #`last_updated` is kept: the hash is derived data, not an edit of the transaction, and the
+    #time of the migration would otherwise become the last update of every stored transaction
+    #(i.e. `Position.last_transaction_update` of every symbol)
+    stmt  = table.update().where(table.c.id==bindparam('transaction_id')).values(
+                content_hash=bindparam('new_hash'), last_updated=table.c.last_updated)
+    for idx in range(0, len(updates), chunk_size):
+        db.session.execute(stmt, updates[idx:idx+chunk_size])
+        db.session.commit()
+    return len(updates)
+
+def has_missing_content_hashes(db):
+    '''Whether any transaction has no `content_hash`. One row lookup (on the unique index once it exists)'''
+    return db.session.query(Transaction.id).filter(Transaction.content_hash.is_(None)).limit(1).first() is not None
+
+def add_transaction_content_hash(db):
+    '''
+    Adds `transactions.content_hash`, fills it for existing rows and creates its unique index.
+    On a migrated database it only checks that no transaction is missing its hash.
+    '''
+    table = Transaction.__table__
+    added = False
+    if 'content_hash' not in get_existing_columns(db.engine, table.name):
+        db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN content_hash VARCHAR(64)"))
+        db.session.commit()
+        print(f"--> Added column content_hash to {table.name}")
+        added = True
+
+    if not (added or has_missing_content_hashes(db)):
+        return
+    filled = fill_content_hashes(db)
+    if filled > 0:
+        print(f"--> Computed the content hash of {filled} transactions")
+    create_model_indexes(db)
+
+def add_position_last_transaction_id(db):
+    '''
+    Adds `security_positions.last_transaction_id`. Positions stored before it existed keep it
+    NULL and are rebuilt from scratch the next time they are updated.
+    '''
+    table = Position.__table__
+    if 'last_transaction_id' not in get_existing_columns(db.engine, table.name):
+        db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN last_transaction_id INTEGER"))
+        db.session.commit()
+        print(f"--> Added column last_transaction_id to {table.name}")
+
+#Revisions are applied in order. Each one must be safe to run on an already migrated database
+REVISIONS = [
+    ('model_indexes', create_model_indexes),
+    ('transaction_content_hash', add_transaction_content_hash),
+    ('position_last_transaction_id', add_position_last_transaction_id),
+]
+
+def migrate_database(db):
+    '''Runs every revision in `REVISIONS`. Call it after `db.create_all()`'''
+    for name, revision in REVISIONS:
+        revision(db)
+
+
+if __name__ == '__main__':
+    try:
+        DB_TYPE = sys.argv[1]
+    except IndexError:
+        DB_TYPE = 'mysql'
+
+    supported_dbs = ['mysql','sqlite']
+    if DB_TYPE == 'mysql':
+        database_URI = get_mysql_uri(config_file='mysql_config.yml')
+
+    elif DB_TYPE == 'sqlite':
+        project_dir  = os.path.dirname(os.path.abspath(__file__))
+        database_dir = os.path.join(project_dir, "asset_portfolio.db")
+        database_URI = f"sqlite:///{database_dir}"
+
+    else:
+        print(f'--> Database {DB_TYPE} not supported.\n\tDatabase options supported: {supported_dbs}')
+        sys.exit()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_URI
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        migrate_database(db)
@@ -39,6 +39,11 @@ class Security(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        db.Index('ix_transactions_symbol_time_execution', 'symbol_id', 'time_execution'),
+        db.Index('ix_transactions_symbol_last_updated', 'symbol_id', 'last_updated'),
+        db.Index('uq_transactions_content_hash', 'content_hash', unique=True),
+    )
     id             = db.Column(db.Integer, db.Sequence('transactions_id_seq'), primary_key=True)
     #symbol_id     = db.Column(db.Integer,       nullable=False)
     symbol_id      = db.Column(db.Integer, db.ForeignKey('securities.id'),  nullable=False)
@@ -49,6 +54,7 @@ class Transaction(db.Model):
     broker_id      = db.Column(db.Integer, db.ForeignKey('brokers.id'),  nullable=False)
     time_execution = db.Column(db.DateTime,server_default=db.func.now(), nullable=False)    #it is important to have the time of the actual execution, because the events table will use that time to determine accurate share counts
     last_updated   = db.Column(db.DateTime,server_default=db.func.now(), onupdate=db.func.now(),       nullable=True)
+    content_hash   = db.Column(db.String(64),                            nullable=True)     #see `tools.transaction_content_hash`; re-imported transactions are skipped with it
     
 
     def __init__(self,num_shares,cost_basis,is_dividend=False,broker_id=1,time_execution=None):
@@ -83,6 +89,9 @@ class Broker(db.Model):
 
 class Event(db.Model):
     __tablename__ = 'securities_events'
+    __table_args__ = (
+        db.Index('uq_securities_events_symbol_type_date', 'symbol_id', 'event_type', 'event_date', unique=True),
+    )
     id              = db.Column(db.Integer,db.Sequence('securities_events_id_seq'),primary_key=True)
     symbol_id       = db.Column(db.Integer, db.ForeignKey('securities.id'),  nullable=False)
     event_type      = db.Column(db.String(64), nullable=False) 
@@ -107,12 +116,16 @@ class Event(db.Model):
 
 class Position(db.Model):
     __tablename__ = 'security_positions'
+    __table_args__ = (
+        db.Index('uq_security_positions_symbol', 'symbol_id', unique=True),
+    )
     id               = db.Column(db.Integer,db.Sequence('securities_positions_id_seq'),primary_key=True)
     symbol_id        = db.Column(db.Integer, db.ForeignKey('securities.id'),  nullable=False)
     total_shares     = db.Column(db.Numeric(19,9, asdecimal=True),         nullable=False)
     cost_basis       = db.Column(db.Numeric(19,5, asdecimal=True),         nullable=False)
     invested         = db.Column(db.Numeric(19,5, asdecimal=True),         nullable=False)
     last_transaction_update = db.Column(db.DateTime,                              nullable=False)
+    last_transaction_id     = db.Column(db.Integer,                               nullable=True)     #highest `transactions.id` included in the position
     last_updated     = db.Column(db.DateTime,server_default=db.func.now(), onupdate=db.func.now(),       nullable=True)
 
     def __init__(self,**kwargs):
@@ -129,12 +142,15 @@ class Position(db.Model):
             Total amount invested. It should be `total_shares` * `cost_basis`
         last_transaction_update: datetime object
             Time of the last transaction update for this symbol id according to the transactions table
+        last_transaction_id: int
+            Highest id of the transactions included in the position
         last_updated: datetime object
             Last time this record was modified
         '''
         self.total_shares     = kwargs.get('total_shares', 0)
         self.cost_basis       = kwargs.get('cost_basis', 0)
         self.last_transaction_update = kwargs.get('last_transaction_update', None)
+        self.last_transaction_id     = kwargs.get('last_transaction_id', None)
         self.invested         = kwargs.get('invested', None)
         if self.invested is None:
             self.invested = self.total_shares * self.cost_basis
@@ -142,8 +158,27 @@ class Position(db.Model):
     def __repr__(self):
         return f"< Position: symbol_id={self.symbol_id} total_shares={self.total_shares} cost_basis={self.cost_basis} invested={self.invested} >"
 
+class PositionSnapshot(db.Model):
+    __tablename__ = 'position_snapshots'
+    __table_args__ = (
+        db.Index('uq_position_snapshots_symbol_date', 'symbol_id', 'snapshot_date', unique=True),
+    )
+    id               = db.Column(db.Integer,db.Sequence('position_snapshots_id_seq'),primary_key=True)
+    symbol_id        = db.Column(db.Integer, db.ForeignKey('securities.id'),  nullable=False)
+    snapshot_date    = db.Column(db.DateTime,                              nullable=False)    #state right before this time: transactions and splits dated earlier are included
+    total_shares     = db.Column(db.Numeric(19,9, asdecimal=True),         nullable=False)    #in units of the snapshot date (only splits before it are applied)
+    invested         = db.Column(db.Numeric(19,5, asdecimal=True),         nullable=False)
+    split_factor     = db.Column(db.Numeric(19,10),                        nullable=False)    #product of every split before `snapshot_date`
+    last_updated     = db.Column(db.DateTime,server_default=db.func.now(), onupdate=db.func.now(),       nullable=True)
+
+    def __repr__(self):
+        return f"< PositionSnapshot: symbol_id={self.symbol_id} snapshot_date={self.snapshot_date} total_shares={self.total_shares} invested={self.invested} split_factor={self.split_factor} >"
+
 class Dividend(db.Model):
     __tablename__    = "current_dividends"
+    __table_args__   = (
+        db.Index('uq_current_dividends_symbol', 'symbol_id', unique=True),
+    )
     id               = db.Column(db.Integer, db.Sequence('current_dividends_id_seq'), primary_key=True)
     symbol_id        = db.Column(db.Integer, db.ForeignKey('securities.id'),  nullable=False)
     dividend_amount  = db.Column(db.Numeric(19, 5, asdecimal=True),           nullable=True)
@@ -0,0 +1,323 @@
+'''
+Local store of daily price history (open, high, low, close, volume) per symbol.
+
+Every symbol has its own folder with one raw float64 file per field plus a small JSON file
+with the first date and the number of rows. Row `i` is the calendar day `start + i` (days
+without trading are NaN), so a date is found with a subtraction instead of a search, and
+files are read through `numpy.memmap`: slices are views of the file, nothing is copied or
+parsed until it is used. New days are appended at the end of the files.
+
+Usage:
+    python price_store.py yfinance [symbols ...]      #backfill from yfinance
+    python price_store.py csv <file_or_folder>        #backfill from local CSV files
+'''
+import os
+import sys
+import json
+import glob
+import threading
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from tools import fetch_concurrently
+
+PRICE_STORE_FOLDER = os.path.join('db_files','price_store')
+FIELDS = ('open','high','low','close','volume')
+DTYPE  = np.dtype('<f8')
+
+
+class PriceStore(object):
+    '''
+    Parameters
+    ----------
+    folder: str
+        Root folder of the store. It is created when the first symbol is written
+    '''
+    def __init__(self, folder=PRICE_STORE_FOLDER):
+        self.folder = folder
+        self._lock  = threading.Lock()
+        self._meta  = {}    #symbol -> {'start': Timestamp, 'length': int}
+        self._seen_fingerprint = None
+
+    #---------------------------------------------------------------
+    #   Files
+    #---------------------------------------------------------------
+    def _symbol_folder(self, symbol):
+        return os.path.join(self.folder, symbol.lower())
+
+    def _field_path(self, symbol, field):
+        return os.path.join(self._symbol_folder(symbol), f"{field}.f8")
+
+    def _meta_path(self, symbol):
+        return os.path.join(self._symbol_folder(symbol), 'meta.json')
+
+    def _version_path(self):
+        return os.path.join(self.folder, 'VERSION')
+
+    def _refresh_meta(self):
+        '''Forgets the cached metadata when another process (or store object) wrote to the folder'''
+        fingerprint = self.fingerprint()
+        if fingerprint != self._seen_fingerprint:
+            self._meta.clear()
+            self._seen_fingerprint = fingerprint
+
+    def get_meta(self, symbol):
+        '''First date and number of rows stored for `symbol`, or None if it is not in the store'''
+        symbol = symbol.lower()
+        meta   = self._meta.get(symbol)
+        if meta is None:
+            try:
+                with open(self._meta_path(symbol)) as f_handler:
+                    raw = json.load(f_handler)
+            except FileNotFoundError:
+                return None
+            meta = {'start':pd.Timestamp(raw['start']), 'length':int(raw['length'])}
+            self._meta[symbol] = meta
+        return meta
+
+    def _write_meta(self, symbol, start, length):
+        path = self._meta_path(symbol)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f_handler:
+            json.dump({'start':start.strftime('%Y-%m-%d'), 'length':int(length)}, f_handler)
+        os.replace(tmp_path, path)     #readers never see a half written file
+        self._meta[symbol.lower()] = {'start':start, 'length':int(length)}
+
+        with open(self._version_path(), 'w') as f_handler:
+            f_handler.write(str(pd.Timestamp.utcnow()))
+        self._seen_fingerprint = self.fingerprint()
+
+    def fingerprint(self):
+        '''Changes whenever any symbol is written (also by other processes)'''
+        try:
+            return os.stat(self._version_path()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def symbols(self):
+        return sorted(os.path.basename(os.path.dirname(path)) for path in glob.glob(os.path.join(self.folder, '*', 'meta.json')))
+
+    #---------------------------------------------------------------
+    #   Reading
+    #---------------------------------------------------------------
+    def offset(self, symbol, date):
+        '''Row of `date` in the files of `symbol` (can be negative or past the end)'''
+        return (pd.Timestamp(date).normalize() - self.get_meta(symbol)['start']).days
+
+    def get_column(self, symbol, field='close', start=None, end=None):
+        '''
+        Memory-mapped view of one field of `symbol` between `start` and `end` (inclusive),
+        clipped to the stored range.
+
+        Returns
+        -------
+        dates: pandas.DatetimeIndex
+        values: numpy.memmap (or empty numpy.ndarray)
+        '''
+        meta = self.get_meta(symbol)
+        if meta is None or meta['length'] < 1:
+            return pd.DatetimeIndex([]), np.zeros(0, dtype=DTYPE)
+
+        first = 0 if start is None else max(0, self.offset(symbol, start))
+        last  = meta['length'] if end is None else min(meta['length'], self.offset(symbol, end) + 1)
+        if last <= first:
+            return pd.DatetimeIndex([]), np.zeros(0, dtype=DTYPE)
+
+        values = np.memmap(self._field_path(symbol, field), dtype=DTYPE, mode='r', shape=(meta['length'],))
+        dates  = pd.date_range(meta['start'] + pd.Timedelta(days=first), periods=last-first, freq='D')
+        return dates, values[first:last]
+
+    def get_price(self, symbol, date, field='close'):
+        '''Value of `field` on `date` (NaN if it was not a trading day or it is not stored)'''
+        _, values = self.get_column(symbol, field, date, date)
+        return float(values[0]) if len(values) > 0 else np.nan
+
+    def close_matrix(self, symbols, start, end):
+        '''
+        Closing prices of `symbols` for every calendar day in [start, end].
+
+        Returns
+        -------
+        dates: pandas.DatetimeIndex
+        matrix: numpy.ndarray
+            dates x symbols, NaN where there is no price
+        '''
+        self._refresh_meta()
+        dates  = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize(), freq='D')
+        matrix = np.full((len(dates), len(symbols)), np.nan, dtype=DTYPE)
+        if len(dates) < 1:
+            return dates, matrix
+        for col, symbol in enumerate(symbols):
+            column_dates, values = self.get_column(symbol, 'close', dates[0], dates[-1])
+            if len(values) > 0:
+                first = (column_dates[0] - dates[0]).days
+                matrix[first:first+len(values), col] = values
+        return dates, matrix
+
+    def close_frame(self, symbols, start, end):
+        '''`close_matrix` as a DataFrame. Its signature is the one of `ValuationEngine.price_loader`'''
+        dates, matrix = self.close_matrix(symbols, start, end)
+        return pd.DataFrame(matrix, index=dates, columns=list(symbols))
+
+    #---------------------------------------------------------------
+    #   Writing
+    #---------------------------------------------------------------
+    def write_history(self, symbol, history, replace=False):
+        '''
+        Stores daily rows of `symbol`. Rows after the stored range are appended, rows inside
+        it overwrite the stored values. With `replace` (or when `history` starts before the
+        stored range) the files of the symbol are rewritten.
+
+        Parameters
+        ----------
+        symbol: str
+        history: pandas.DataFrame
+            Indexed by date, with any of the columns in `FIELDS` (case insensitive)
+        '''
+        if history is None or len(history) < 1:
+            return
+        symbol  = symbol.lower()
+        history = history.rename(columns=str.lower)
+        history.index = pd.to_datetime(history.index)
+        if history.index.tz is not None:
+            history.index = history.index.tz_localize(None)
+        history = history[~history.index.normalize().duplicated(keep='last')]
+        history.index = history.index.normalize()
+        history = history.sort_index()
+
+        with self._lock:
+            self._refresh_meta()
+            meta = self.get_meta(symbol)
+            if replace or (meta is None) or (history.index[0] < meta['start']):
+                self._rewrite(symbol, history, None if replace else meta)
+            else:
+                self._write_in_place(symbol, history, meta)
+
+    def _rewrite(self, symbol, history, meta):
+        start = history.index[0] if meta is None else min(history.index[0], meta['start'])
+        end   = history.index[-1] if meta is None else max(history.index[-1], meta['start'] + pd.Timedelta(days=meta['length']-1))
+        dates = pd.date_range(start, end, freq='D')
+        os.makedirs(self._symbol_folder(symbol), exist_ok=True)
+
+        for field in FIELDS:
+            values = np.full(len(dates), np.nan, dtype=DTYPE)
+            if meta is not None:
+                old_dates, old_values = self.get_column(symbol, field)
+                first = (old_dates[0] - start).days
+                values[first:first+len(old_values)] = old_values
+            if field in history:
+                rows = (history.index - start).days
+                values[rows] = history[field].to_numpy(dtype=DTYPE)
+
+            path = self._field_path(symbol, field)
+            values.tofile(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        self._write_meta(symbol, start, len(dates))
+
+    def _write_in_place(self, symbol, history, meta):
+        length   = meta['length']
+        end      = history.index[-1]
+        new_size = max(length, (end - meta['start']).days + 1)
+        rows     = (history.index - meta['start']).days.to_numpy()
+
+        for field in FIELDS:
+            path = self._field_path(symbol, field)
+            if new_size > length:
+                with open(path, 'ab') as f_handler:
+                    np.full(new_size - length, np.nan, dtype=DTYPE).tofile(f_handler)
+            if field in history:
+                values = np.memmap(path, dtype=DTYPE, mode='r+', shape=(new_size,))
+                values[rows] = history[field].to_numpy(dtype=DTYPE)
+                values.flush()
+                del values
+        self._write_meta(symbol, meta['start'], new_size)
+
+    def last_date(self, symbol):
+        meta = self.get_meta(symbol)
+        if meta is None or meta['length'] < 1:
+            return None
+        return meta['start'] + pd.Timedelta(days=meta['length']-1)
+
+    #---------------------------------------------------------------
+    #   Backfill
+    #---------------------------------------------------------------
+    def backfill_from_yfinance(self, symbols, start=None, full_refresh=(), max_workers=8, rate_limit=4.0):
+        '''
+        Downloads daily history of `symbols` concurrently and stores it. Symbols already in the
+        store only get the days after their last stored date, unless they are in `full_refresh`
+        (i.e. after a new split, when the whole split-adjusted history changes).
+
+        Returns
+        -------
+        dict
+            Errors per symbol
+        '''
+        full_refresh = {symbol.lower() for symbol in full_refresh}
+
+        def fetch(symbol):
+            last = None if symbol in full_refresh else self.last_date(symbol)
+            if last is not None:
+                history = yf.Ticker(symbol).history(start=last.strftime('%Y-%m-%d'), auto_adjust=False)
+            elif start is not None:
+                history = yf.Ticker(symbol).history(start=pd.Timestamp(start).strftime('%Y-%m-%d'), auto_adjust=False)
+            else:
+                history = yf.Ticker(symbol).history(period='max', auto_adjust=False)
+            return history
+
+        symbols = [symbol.lower() for symbol in symbols]
+        histories, errors = fetch_concurrently(fetch, symbols, max_workers=max_workers, rate_limit=rate_limit)
+        for symbol, history in histories.items():
+            #`Close` from yfinance is split-adjusted (but not dividend-adjusted), like the share counts
+            self.write_history(symbol, history[[column for column in history.columns if column.lower() in FIELDS]],
+                               replace=symbol in full_refresh)
+        return errors
+
+    def backfill_from_csv(self, path):
+        '''
+        Loads daily history from CSV files. `path` is either a folder of `<symbol>.csv` files
+        or a single file. Files need a `date` column and any of the columns in `FIELDS`
+        (case insensitive); a single file can hold several symbols in a `symbol` column.
+        '''
+        paths = sorted(glob.glob(os.path.join(path, '*.csv'))) if os.path.isdir(path) else [path]
+        for csv_path in paths:
+            df = pd.read_csv(csv_path)
+            df = df.rename(columns=str.lower)
+            df['date'] = pd.to_datetime(df['date'])
+            if 'symbol' in df:
+                for symbol, group in df.groupby('symbol'):
+                    self.write_history(symbol, group.set_index('date'))
+            else:
+                symbol = os.path.splitext(os.path.basename(csv_path))[0]
+                self.write_history(symbol, df.set_index('date'))
+
+
+_store_lock = threading.Lock()
+_store      = None
+
+def get_price_store():
+    '''Shared PriceStore of the process, so the metadata of the symbols is read only once'''
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PriceStore()
+        return _store
+
+
+if __name__ == '__main__':
+    try:
+        source = sys.argv[1]
+    except IndexError:
+        source = 'yfinance'
+
+    store = get_price_store()
+    if source == 'yfinance':
+        symbols = sys.argv[2:] if len(sys.argv) > 2 else store.symbols()
+        errors  = store.backfill_from_yfinance(symbols)
+        for symbol in errors:
+            print(f"--> Could not download prices for {symbol.upper()}: {errors[symbol]}")
+    elif source == 'csv':
+        store.backfill_from_csv(sys.argv[2])
+    else:
+        print(f"--> Unknown source {source}. Options: yfinance, csv")
@@ -0,0 +1,219 @@
+'''
+Counts the SQL statements sent to the database, and the time spent waiting for them, per
+Flask request and per background job.
+
+`install_query_profiler(app, db)` hooks the `before_cursor_execute` and `after_cursor_execute`
+events of the engine. Every statement is added to the active profile:
+
+    Flask request       a QueryProfile stored in `flask.g` for the duration of the request
+    background job      the QueryProfile of the innermost `profile_job(...)` block of the thread
+
+Statements slower than the threshold (`QUERY_PROFILER_SLOW_SECONDS` in the app config,
+`SLOW_QUERY_SECONDS` by default) are printed with the line of code (outside of the libraries)
+that issued them.
+Every response gets `X-Query-Count` and `X-Query-Time` headers, and the summaries of the last
+requests and jobs (with their most repeated statements, which is where N+1 loops show up)
+are served as JSON at `/debug/queries` when the app runs in debug mode or
+`QUERY_PROFILER_ENDPOINT` is set.
+
+Usage in a script:
+    install_query_profiler(app, db)
+    with profile_job('splits'):
+        events_table_updater(db)
+'''
+import os
+import sys
+import time
+import sysconfig
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from flask import g, request, jsonify, abort, current_app, has_request_context
+from sqlalchemy import event
+
+SLOW_QUERY_SECONDS = 0.25
+MAX_RECENT_PROFILES = 50
+MAX_REPEATED_STATEMENTS = 5
+
+_THIS_FILE    = os.path.abspath(__file__)
+_PROJECT_DIR  = os.path.dirname(_THIS_FILE)
+_LIBRARY_DIRS = tuple({os.path.abspath(path) for name, path in sysconfig.get_paths().items()
+                       if name in ('stdlib','platstdlib','purelib','platlib')})
+
+_settings = {'slow_query_seconds':SLOW_QUERY_SECONDS}
+_local    = threading.local()     #stack of the job profiles of each thread
+_lock     = threading.Lock()
+_recent   = deque(maxlen=MAX_RECENT_PROFILES)
+
+
+class QueryProfile(object):
+    '''Queries and database time of one request or job'''
+    def __init__(self, name, kind='request'):
+        self.name       = name
+        self.kind       = kind
+        self.started    = time.time()
+        self.finished   = None
+        self.count      = 0
+        self.db_time    = 0.0
+        self.slow       = []    #(seconds, statement, call site)
+        self.statements = {}    #statement -> [count, seconds]
+
+    def add(self, statement, seconds, call_site=None):
+        self.count   += 1
+        self.db_time += seconds
+        totals = self.statements.get(statement)
+        if totals is None:
+            totals = self.statements[statement] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+        if call_site is not None:
+            self.slow.append((seconds, statement, call_site))
+
+    def finish(self):
+        self.finished = time.time()
+        return self
+
+    def summary(self):
+        '''JSON-friendly dict with the totals, the slow statements and the most repeated ones'''
+        end      = self.finished if self.finished is not None else time.time()
+        repeated = sorted(self.statements.items(), key=lambda item: item[1][0], reverse=True)[:MAX_REPEATED_STATEMENTS]
+        return {
+            'name'         : self.name,
+            'kind'         : self.kind,
+            'started'      : self.started,
+            'total_time'   : end - self.started,
+            'query_count'  : self.count,
+            'db_time'      : self.db_time,
+            'slow_queries' : [{'seconds':seconds, 'statement':statement, 'call_site':call_site}
+                              for seconds, statement, call_site in self.slow],
+            'repeated'     : [{'statement':statement, 'count':count, 'seconds':seconds}
+                              for statement, (count, seconds) in repeated if count > 1],
+        }
+
+    def __repr__(self):
+        return f"<QueryProfile: {self.kind} {self.name} queries={self.count} db_time={self.db_time:.3f}s>"
+
+
+def get_current_profile():
+    '''Profile the queries of this thread go to: the innermost job, else the current request, else None'''
+    stack = getattr(_local, 'jobs', None)
+    if stack:
+        return stack[-1]
+    if has_request_context():
+        return g.get('query_profile')
+    return None
+
+def get_recent_profiles():
+    '''Summaries of the last finished requests and jobs, newest first'''
+    with _lock:
+        return [profile.summary() for profile in reversed(_recent)]
+
+def _record(profile):
+    with _lock:
+        _recent.append(profile.finish())
+
+def _call_site():
+    '''"file:line in function" of the innermost frame outside of the libraries (SQLAlchemy, pandas, etc) and this module'''
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith('<'):    #code generated at runtime, i.e. "<string>"
+            filename = os.path.abspath(filename)
+        if not (filename.startswith(_LIBRARY_DIRS) or (filename == _THIS_FILE) or filename.startswith('<')):
+            if filename.startswith(_PROJECT_DIR):
+                filename = os.path.relpath(filename, _PROJECT_DIR)
+            return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return '<unknown>'
+
+#---------------------------------------------------------------
+#   Engine events
+#---------------------------------------------------------------
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get('query_start_times')
+    if not start_times:
+        return
+    seconds = time.perf_counter() - start_times.pop()
+
+    slow      = seconds >= _settings['slow_query_seconds']
+    call_site = _call_site() if slow else None     #walking the stack is only paid for slow statements
+    if slow:
+        print(f"--> Slow query ({seconds*1000:.1f} ms) at {call_site}:\n\t{' '.join(statement.split())[:500]}")
+
+    profile = get_current_profile()
+    if profile is not None:
+        profile.add(statement, seconds, call_site)
+
+def instrument_engine(engine):
+    '''Hooks the profiler to the events of `engine` (only once per engine)'''
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+#---------------------------------------------------------------
+#   Jobs
+#---------------------------------------------------------------
+@contextmanager
+def profile_job(name, report=True):
+    '''
+    Profiles the queries run by this thread inside the block. The profile is kept with the
+    recent ones and, with `report`, its summary is printed at the end.
+
+    Yields
+    ------
+    QueryProfile
+    '''
+    profile = QueryProfile(name, kind='job')
+    if not hasattr(_local, 'jobs'):
+        _local.jobs = []
+    _local.jobs.append(profile)
+    try:
+        yield profile
+    finally:
+        _local.jobs.pop()
+        _record(profile)
+        if report:
+            print(f"--> Job {name}: {profile.count} queries, {profile.db_time:.3f} s in the database "
+                  f"({profile.finished - profile.started:.3f} s total)")
+
+#---------------------------------------------------------------
+#   Flask
+#---------------------------------------------------------------
+def _start_request_profile():
+    g.query_profile = QueryProfile(f"{request.method} {request.full_path.rstrip('?')}")
+
+def _finish_request_profile(response):
+    profile = g.pop('query_profile', None)
+    if profile is None:
+        return response
+    response.headers['X-Query-Count'] = str(profile.count)
+    response.headers['X-Query-Time']  = f"{profile.db_time*1000:.1f}ms"
+    if request.endpoint != 'debug_queries':
+        _record(profile)
+    return response
+
+def debug_queries():
+    '''Summaries of the last requests and jobs'''
+    if not (current_app.debug or current_app.config.get('QUERY_PROFILER_ENDPOINT')):
+        abort(404)
+    return jsonify({
+        'slow_query_seconds' : _settings['slow_query_seconds'],
+        'profiles'           : get_recent_profiles(),
+    })
+
+def install_query_profiler(app, db):
+    '''
+    Instruments the engine of `db` and adds the request hooks and the `/debug/queries` endpoint
+    to `app`. It also works for apps that only run jobs (the request hooks are never called).
+    '''
+    _settings['slow_query_seconds'] = float(app.config.get('QUERY_PROFILER_SLOW_SECONDS', SLOW_QUERY_SECONDS))
+    with app.app_context():
+        instrument_engine(db.engine)
+
+    app.before_request(_start_request_profile)
+    app.after_request(_finish_request_profile)
+    app.add_url_rule('/debug/queries', 'debug_queries', debug_queries)
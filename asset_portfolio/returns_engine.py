@@ -0,0 +1,211 @@
+'''
+Money-weighted (XIRR) and time-weighted (TWR) returns per symbol and for the portfolio.
+
+Cash flows come from the `transactions` table: money paid for buys goes out, money received
+for sells comes in, and the current market value (from the valuation engine) is the final
+inflow. Reinvested dividends are not cash flows (the money never left the portfolio), but
+their shares are part of the market value.
+
+XIRR is solved for every symbol and the portfolio at once: all cash flows live in flat
+arrays tagged with the index of their series, each Newton step evaluates every net present
+value with one `numpy.bincount`, and series where the Newton step leaves the bracket of the
+root take a bisection step instead. TWR chains the daily growth of the market value
+matrices of the valuation engine, also for all symbols at once.
+'''
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from models import Transaction
+from tools import get_positions_fingerprint
+from valuation_engine import get_valuation_engine
+from price_store import get_price_store
+from ledger_cache import get_cached, get_ledger_version
+
+DAYS_PER_YEAR = 365.0
+
+#XIRR is searched between -99% and +10000% per year
+MIN_RATE = -0.99
+MAX_RATE = 100.0
+
+
+def xirr_batch(series, years, flows, num_series, tolerance=1e-10, max_iterations=100):
+    '''
+    Solves the XIRR of many cash flow series at once.
+
+    Parameters
+    ----------
+    series: numpy.ndarray of int
+        Index (0 to `num_series`-1) of the series each cash flow belongs to
+    years: numpy.ndarray of float
+        Time of each cash flow, in years since the start of its series
+    flows: numpy.ndarray of float
+        Amount of each cash flow (negative for money paid, positive for money received)
+    num_series: int
+
+    Returns
+    -------
+    numpy.ndarray
+        Annual rate of each series. NaN when there is no rate in [`MIN_RATE`, `MAX_RATE`]
+        (i.e. all the cash flows have the same sign)
+    '''
+    series = np.asarray(series, dtype=np.int64)
+    years  = np.asarray(years, dtype=np.float64)
+    flows  = np.asarray(flows, dtype=np.float64)
+
+    def npv(rates):
+        discounted = flows * np.exp(-years * np.log1p(rates[series]))
+        value      = np.bincount(series, weights=discounted, minlength=num_series)
+        derivative = np.bincount(series, weights=-years * discounted, minlength=num_series) / (1 + rates)
+        return value, derivative
+
+    low  = np.full(num_series, MIN_RATE)
+    high = np.full(num_series, MAX_RATE)
+    npv_low, _  = npv(low)
+    npv_high, _ = npv(high)
+
+    rates  = np.full(num_series, np.nan)
+    active = np.sign(npv_low) != np.sign(npv_high)
+    rates[active] = 0.1
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iterations):
+            if not active.any():
+                break
+            value, derivative = npv(np.where(active, rates, 0.0))
+
+            #keep the root bracketed between `low` and `high`
+            below = np.sign(value) == np.sign(npv_low)
+            low     = np.where(active & below, rates, low)
+            npv_low = np.where(active & below, value, npv_low)
+            high    = np.where(active & ~below, rates, high)
+
+            newton = rates - value / derivative
+            bisect = ~np.isfinite(newton) | (newton <= low) | (newton >= high)
+            new_rates = np.where(bisect, (low + high) / 2, newton)
+
+            converged = (value == 0) | (np.abs(new_rates - rates) <= tolerance * (1 + np.abs(rates)))
+            rates     = np.where(active & (value != 0), new_rates, rates)
+            active    = active & ~converged
+    return rates
+
+def twr_batch(values, money_in, money_out):
+    '''
+    Time-weighted return of several series from their daily values.
+
+    Money put in during a day is counted as available from the start of the day and money
+    taken out as taken at the end of it, so the growth of day `t` is
+    (value[t] + money_out[t]) / (value[t-1] + money_in[t]). Days without a known value (on
+    that day or the previous one) or without anything invested are skipped.
+
+    Parameters
+    ----------
+    values: numpy.ndarray
+        dates x series, market value at the end of each day (NaN if unknown)
+    money_in, money_out: numpy.ndarray
+        dates x series, money paid for buys and received for sells each day (both >= 0)
+
+    Returns
+    -------
+    numpy.ndarray
+        Total return of each series (NaN for series without any known value)
+    '''
+    previous = np.vstack([np.zeros((1, values.shape[1])), values[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = (values + money_out) / (previous + money_in)
+    known  = np.isfinite(values) & np.isfinite(previous) & ((previous + money_in) > 0)
+    total  = np.prod(np.where(known, growth, 1.0), axis=0) - 1
+    return np.where(known.any(axis=0), total, np.nan)
+
+def load_cash_flows(db):
+    '''Money paid (negative) or received (positive) by every transaction that is not a reinvested dividend'''
+    sql_statement = db.session.query(
+                        Transaction.symbol_id,
+                        Transaction.time_execution,
+                        Transaction.num_shares,
+                        Transaction.cost_basis,
+                        ).filter(
+                            db.or_(Transaction.is_dividend.is_(None), Transaction.is_dividend==False)
+                        ).statement
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    df['time_execution'] = pd.to_datetime(df['time_execution'])
+    df['flow'] = -df['num_shares'].astype(float) * df['cost_basis'].astype(float)
+    return df[['symbol_id','time_execution','flow']]
+
+def compute_returns(db, end=None):
+    '''
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    end: date, optional
+        Valuation date (default: today)
+
+    Returns
+    -------
+    by_symbol: pandas.DataFrame
+        Indexed by symbol, with columns `xirr` (annual) and `twr` (total). NaN for symbols
+        without a stored price
+    portfolio: pandas.Series
+        `xirr` and `twr` of all the symbols with a known market value
+    '''
+    engine  = get_valuation_engine(db, end=end)
+    symbols = list(engine.symbols)
+    empty   = (pd.DataFrame({'xirr':pd.Series(dtype=float), 'twr':pd.Series(dtype=float)}),
+               pd.Series({'xirr':np.nan, 'twr':np.nan}))
+    if len(engine.dates) < 1 or len(symbols) < 1:
+        return empty
+
+    flows_df = load_cash_flows(db)
+    days     = (flows_df['time_execution'].dt.normalize() - engine.dates[0]).dt.days.to_numpy()
+    columns  = {symbol_id:idx for idx, symbol_id in enumerate(engine.symbol_ids)}
+    keep     = (days < len(engine.dates)) & flows_df['symbol_id'].isin(list(columns)).to_numpy()
+    days     = days[keep]
+    cols     = np.array([columns[symbol_id] for symbol_id in flows_df['symbol_id'][keep]], dtype=np.int64)
+    amounts  = flows_df['flow'].to_numpy()[keep]
+
+    values = engine.values()
+    #symbols sold out have nothing left to value, even without a price
+    values = np.where(np.abs(engine.shares) < 1e-9, 0.0, values)
+    last_values = pd.DataFrame(values).ffill().to_numpy()[-1]
+    has_value   = np.isfinite(last_values)
+
+    #----------------------------------------------------------------
+    #XIRR: one series per symbol plus the portfolio (series `len(symbols)`)
+    num_symbols  = len(symbols)
+    terminal     = np.flatnonzero(has_value)
+    portfolio_flows = has_value[cols]
+    series  = np.concatenate([cols, np.full(portfolio_flows.sum(), num_symbols), terminal, [num_symbols]])
+    flow_days = np.concatenate([days, days[portfolio_flows], np.full(len(terminal)+1, len(engine.dates)-1)])
+    flows   = np.concatenate([amounts, amounts[portfolio_flows], last_values[terminal], [last_values[terminal].sum()]])
+
+    first_day = np.full(num_symbols+1, len(engine.dates)-1, dtype=np.int64)
+    np.minimum.at(first_day, series, flow_days)
+    years = (flow_days - first_day[series]) / DAYS_PER_YEAR
+    xirr  = xirr_batch(series, years, flows, num_symbols+1)
+    xirr[:num_symbols][~has_value] = np.nan
+
+    #----------------------------------------------------------------
+    #TWR: the portfolio sums, day by day, the symbols with a known value on that day and the previous one
+    money_in  = np.zeros(values.shape)
+    money_out = np.zeros(values.shape)
+    np.add.at(money_in, (days, cols), np.where(amounts < 0, -amounts, 0.0))
+    np.add.at(money_out, (days, cols), np.where(amounts > 0, amounts, 0.0))
+    twr = twr_batch(values, money_in, money_out)
+
+    previous = np.vstack([np.zeros((1, num_symbols)), values[:-1]])
+    known    = np.isfinite(values) & np.isfinite(previous)
+    day_end   = np.where(known, values + money_out, 0).sum(axis=1)
+    day_start = np.where(known, previous + money_in, 0).sum(axis=1)
+    invested_days = day_start > 0
+    portfolio_twr = np.prod(day_end[invested_days] / day_start[invested_days]) - 1 if invested_days.any() else np.nan
+
+    by_symbol = pd.DataFrame({'xirr':xirr[:num_symbols], 'twr':twr}, index=pd.Index(symbols, name='symbol'))
+    portfolio = pd.Series({'xirr':xirr[num_symbols], 'twr':portfolio_twr})
+    return by_symbol, portfolio
+
+def get_cached_returns(db):
+    '''`compute_returns` for today, rebuilt only when the ledger, the stored prices or the date change'''
+    version = (get_ledger_version(), get_positions_fingerprint(db),
+               get_price_store().fingerprint(), datetime.date.today())
+    return get_cached('returns', version, lambda: compute_returns(db))
@@ -0,0 +1,180 @@
+'''Vectorized split adjustment for transactions.
+
+Instead of walking the split history one event at a time, the reverse cumulative
+split factor (the product of every split that happens *after* a given point in time)
+is computed once per symbol. Every transaction is then matched with its factor through
+a single sorted search, so a whole ledger (one or many symbols) is adjusted in one pass.
+'''
+import decimal
+import numpy as np
+import pandas as pd
+
+#Transactions and splits are matched on a single int64 key made of the symbol id and the
+#time in seconds: key = symbol_id * 2**40 + (seconds + 2**39). Seconds are shifted so that
+#dates before 1970 (the code uses 1800-01-01 as a "very old date") stay positive.
+_SYMBOL_SHIFT  = 2**40
+_SECONDS_SHIFT = 2**39
+
+SHARES_DECIMALS   = 9   #same precision as `num_shares` and `total_shares` columns
+CURRENCY_DECIMALS = 5   #same precision as `cost_basis` and `invested` columns
+
+
+def _to_seconds(values):
+    '''Converts datetime-like values (Series, Index, arrays) into int64 seconds since epoch'''
+    dt_values = np.asarray(pd.to_datetime(values), dtype='datetime64[s]')
+    return dt_values.astype(np.int64)
+
+def _make_keys(symbol_ids, seconds):
+    return np.asarray(symbol_ids, dtype=np.int64) * _SYMBOL_SHIFT + (seconds + _SECONDS_SHIFT)
+
+def to_decimal(value, places):
+    '''Converts a float (or numpy float) into a decimal.Decimal rounded to `places` decimals'''
+    return decimal.Decimal(f"{float(value):.{places}f}")
+
+def reverse_cumulative_factors(split_symbols, split_dates, split_factors):
+    '''
+    Sorts split events by symbol and date and computes, for each one, the product of
+    that split and every later split of the same symbol.
+
+    Parameters
+    ----------
+    split_symbols: array-like of int
+        `symbol_id` of each split event
+    split_dates: array-like of datetime
+        `event_date` of each split event
+    split_factors: array-like of numbers
+        `split_factor` of each split event (i.e. 4 for a 4:1 split, 0.1 for a 1:10 reverse split)
+
+    Returns
+    -------
+    keys: numpy.ndarray of int64
+        Sorted search keys (symbol and date) for each split
+    symbols: numpy.ndarray of int64
+        `symbol_id` for each key
+    factors: numpy.ndarray of float64
+        Reverse cumulative split factor for each key
+    '''
+    symbols = np.asarray(split_symbols, dtype=np.int64)
+    seconds = _to_seconds(split_dates)
+    factors = np.asarray(split_factors, dtype=np.float64)
+
+    order   = np.lexsort((seconds, symbols))
+    symbols = symbols[order]
+    seconds = seconds[order]
+    factors = factors[order]
+
+    #cumulative product from the latest split backwards, restarting for every symbol
+    reversed_factors = pd.Series(factors[::-1]).groupby(symbols[::-1]).cumprod().to_numpy()
+    factors = reversed_factors[::-1]
+
+    keys = _make_keys(symbols, seconds)
+    return keys, symbols, factors
+
+def first_later_split(trans_symbols, trans_dates, split_symbols, split_dates):
+    '''
+    Finds, for each transaction, the first split of the same symbol that happened after it
+    (same rule as `split_factors_for`).
+
+    Returns
+    -------
+    indices: numpy.ndarray of int64
+        Position of that split among the splits sorted by symbol and date, or -1 when no
+        split happened after the transaction
+    order: numpy.ndarray of int64
+        Permutation that sorts the splits by symbol and date
+    '''
+    trans_symbols = np.asarray(trans_symbols, dtype=np.int64)
+    indices = np.full(len(trans_symbols), -1, dtype=np.int64)
+    symbols = np.asarray(split_symbols, dtype=np.int64)
+    seconds = _to_seconds(split_dates) if len(symbols) > 0 else np.zeros(0, dtype=np.int64)
+    order   = np.lexsort((seconds, symbols))
+    if len(indices) < 1 or len(symbols) < 1:
+        return indices, order
+
+    symbols    = symbols[order]
+    keys       = _make_keys(symbols, seconds[order])
+    trans_keys = _make_keys(trans_symbols, _to_seconds(trans_dates))
+
+    positions = np.searchsorted(keys, trans_keys, side='right')
+    valid     = positions < len(keys)
+    valid[valid] = symbols[positions[valid]] == trans_symbols[valid]
+    indices[valid] = positions[valid]
+    return indices, order
+
+def split_factors_for(trans_symbols, trans_dates, split_symbols, split_dates, split_factors):
+    '''
+    Finds the total split factor that applies to each transaction, that is, the product
+    of all the splits of the same symbol that happened after the transaction was executed.
+    A split is considered effective from its `event_date` on, so transactions executed on
+    the same date or later are not multiplied by it.
+
+    Returns
+    -------
+    numpy.ndarray of float64
+        One factor per transaction (1.0 when no split happened after it)
+    '''
+    trans_symbols = np.asarray(trans_symbols, dtype=np.int64)
+    factors = np.ones(len(trans_symbols), dtype=np.float64)
+    if len(factors) < 1 or len(split_symbols) < 1:
+        return factors
+
+    keys, symbols, cum_factors = reverse_cumulative_factors(split_symbols, split_dates, split_factors)
+    trans_keys = _make_keys(trans_symbols, _to_seconds(trans_dates))
+
+    #index of the first split strictly after each transaction. It only applies when it belongs to the same symbol
+    positions = np.searchsorted(keys, trans_keys, side='right')
+    valid     = positions < len(keys)
+    valid[valid] = symbols[positions[valid]] == trans_symbols[valid]
+
+    factors[valid] = cum_factors[positions[valid]]
+    return factors
+
+def adjust_transactions(trans_df, splits_df):
+    '''
+    Adds columns `split_factor` and `adjusted_shares` to a copy of `trans_df`.
+
+    Parameters
+    ----------
+    trans_df: pandas.DataFrame
+        Transactions with columns `symbol_id`, `time_execution`, `num_shares` and `cost_basis`
+    splits_df: pandas.DataFrame
+        Split events with columns `symbol_id`, `event_date` and `split_factor`.
+        It can contain splits from symbols not present in `trans_df`
+
+    Returns
+    -------
+    pandas.DataFrame
+    '''
+    trans_df = trans_df.copy()
+    trans_df['split_factor'] = split_factors_for(trans_df['symbol_id'].to_numpy(),
+                                                 trans_df['time_execution'],
+                                                 splits_df['symbol_id'].to_numpy(),
+                                                 splits_df['event_date'],
+                                                 splits_df['split_factor'].to_numpy())
+    trans_df['adjusted_shares'] = trans_df['num_shares'].astype(np.float64) * trans_df['split_factor']
+    return trans_df
+
+def aggregate_positions(trans_df, splits_df):
+    '''
+    Computes the split-adjusted position of every symbol in `trans_df` in one pass.
+    See `adjust_transactions` for the expected columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by `symbol_id`, with columns `total_shares`, `invested` and `cost_basis`.
+        `cost_basis` is the average price paid per (split-adjusted) share and is 0 when
+        there are no shares left.
+    '''
+    adjusted = adjust_transactions(trans_df, splits_df)
+    adjusted['invested'] = adjusted['num_shares'].astype(np.float64) * adjusted['cost_basis'].astype(np.float64)
+
+    positions = adjusted.groupby('symbol_id')[['adjusted_shares','invested']].sum()
+    positions = positions.rename(columns={'adjusted_shares':'total_shares'})
+
+    total_shares = positions['total_shares'].to_numpy()
+    invested     = positions['invested'].to_numpy()
+    cost_basis   = np.zeros(len(positions), dtype=np.float64)
+    np.divide(invested, total_shares, out=cost_basis, where=total_shares!=0)
+    positions['cost_basis'] = cost_basis
+    return positions
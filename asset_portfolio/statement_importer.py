@@ -0,0 +1,279 @@
+'''
+Imports transactions from broker statement files.
+
+Supported files:
+    - CSV exports with the layouts in `LAYOUTS` (Robinhood, Schwab and ShareOwner style). The
+      layout is picked from the broker name (aliases in `BROKER_ALIASES_DICT` work) or, when
+      no broker is given, from the header of the file.
+    - Text files (.txt) with `command_engine` transactions, one or more per line.
+
+Files are read in chunks of `chunk_size` rows, so memory use does not grow with the size of
+the file. Every chunk is inserted and committed on its own (an error stops the import, but
+the chunks before it stay imported). Positions of the imported symbols are updated once, at
+the end, also when the import stops with an error. Transactions already in the database are
+skipped, so a file can be imported again (i.e. after an error, or a statement overlapping a
+previous one) without duplicating rows.
+
+Usage:
+    python statement_importer.py <mysql|sqlite> <file> [--broker name] [--layout name] [--chunk-size n]
+'''
+import os
+import sys
+import time
+import itertools
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+
+from models import db
+from command_engine import parse_commands, TransactionBatch, CommandSyntaxError
+from table_updaters import bulk_insert_transactions, incremental_update_positions_table, get_broker_name
+from migrate_database import migrate_database
+from query_profiler import install_query_profiler, profile_job
+from tools import get_mysql_uri
+
+DEFAULT_CHUNK_SIZE = 5000
+COMMAND_FILE_EXTENSIONS = ('.txt','.cmd')
+
+#what each action does: (sign of the shares, is it a dividend reinvestment)
+BUY      = (1, False)
+SELL     = (-1, False)
+DIVIDEND = (1, True)
+
+#column names are compared in lowercase; actions not listed (cash dividends, interest, transfers) are skipped
+LAYOUTS = {
+    'robinhood' : {
+        'date'     : 'activity date',
+        'symbol'   : 'instrument',
+        'action'   : 'trans code',
+        'quantity' : 'quantity',
+        'price'    : 'price',
+        'actions'  : {'buy':BUY, 'sell':SELL},
+        'dividend_column'  : 'description',     #buys described as a reinvestment are dividends
+        'dividend_keyword' : 'reinvest',
+    },
+    'schwab' : {
+        'date'     : 'date',
+        'symbol'   : 'symbol',
+        'action'   : 'action',
+        'quantity' : 'quantity',
+        'price'    : 'price',
+        'actions'  : {'buy':BUY, 'sell':SELL, 'reinvest shares':DIVIDEND},
+    },
+    'shareowner' : {
+        'date'     : 'trade date',
+        'symbol'   : 'symbol',
+        'action'   : 'transaction type',
+        'quantity' : 'shares',
+        'price'    : 'share price',
+        'actions'  : {'purchase':BUY, 'buy':BUY, 'sale':SELL, 'sell':SELL,
+                      'dividend reinvestment':DIVIDEND, 'reinvestment':DIVIDEND},
+    },
+}
+
+
+def detect_layout(columns):
+    '''Name of the first layout whose columns are all in `columns`, or None'''
+    columns = {column.strip().lower() for column in columns}
+    for name, layout in LAYOUTS.items():
+        required = {layout[key] for key in ('date','symbol','action','quantity','price')}
+        if required.issubset(columns):
+            return name
+    return None
+
+def clean_numbers(values):
+    '''Number strings without currency signs or thousands separators; "(1.5)" becomes "-1.5"'''
+    values = values.fillna('').astype(str).str.strip().str.replace(r"[$,\s]", '', regex=True)
+    negative = values.str.startswith('(') & values.str.endswith(')')
+    values = values.str.strip('()')
+    return values.where(~negative, '-' + values)
+
+def batch_from_chunk(chunk, layout, broker, first_row=0):
+    '''
+    Turns a chunk of a CSV export into a TransactionBatch (vectorized over the chunk).
+
+    Returns
+    -------
+    batch: TransactionBatch
+        Positions are the row numbers in the file
+    num_skipped: int
+        Rows with actions that are not transactions or with missing values
+    '''
+    chunk = chunk.rename(columns=lambda column: column.strip().lower())
+    actions = chunk[layout['action']].fillna('').str.strip().str.lower()
+    effects = actions.map(layout['actions'])
+
+    quantity = clean_numbers(chunk[layout['quantity']]).str.lstrip('+-')
+    price    = clean_numbers(chunk[layout['price']]).str.lstrip('+-')
+    symbols  = chunk[layout['symbol']].fillna('').str.strip().str.lower()
+    dates    = pd.to_datetime(chunk[layout['date']].fillna('').str.split(' as of ').str[0], errors='coerce')
+
+    valid = (effects.notna() & (symbols != '') & dates.notna()
+             & pd.to_numeric(quantity, errors='coerce').gt(0) & pd.to_numeric(price, errors='coerce').notna())
+    if not valid.any():
+        return TransactionBatch(), len(chunk)
+
+    effects = effects[valid]
+    signs   = np.array([effect[0] for effect in effects])
+    is_dividend = np.array([effect[1] for effect in effects])
+    if 'dividend_column' in layout:
+        described = chunk.loc[valid, layout['dividend_column']].fillna('').str.lower().str.contains(layout['dividend_keyword'], regex=False)
+        is_dividend = is_dividend | described.to_numpy()
+
+    #same rule as the `-date` flag of command_engine: a date without time is taken at 08:00
+    datetimes = (dates[valid].dt.normalize() + pd.Timedelta(hours=8)).tolist()
+    batch = TransactionBatch.from_columns(
+                tickers     = symbols[valid],
+                num_shares  = np.where(signs < 0, '-' + quantity[valid], quantity[valid]),
+                cost_basis  = price[valid],
+                datetimes   = datetimes,
+                brokers     = [broker]*int(valid.sum()),
+                is_dividend = is_dividend,
+                positions   = first_row + np.flatnonzero(valid.to_numpy()),
+                )
+    return batch, int((~valid).sum())
+
+def read_csv_batches(f_handler, layout, broker, chunk_size):
+    '''Yields (TransactionBatch, rows read, rows skipped) for every chunk of a CSV export'''
+    first_row = 0
+    with pd.read_csv(f_handler, dtype=str, chunksize=chunk_size, skipinitialspace=True, on_bad_lines='skip') as reader:
+        for chunk in reader:
+            batch, num_skipped = batch_from_chunk(chunk, layout, broker, first_row)
+            first_row += len(chunk)
+            yield batch, len(chunk), num_skipped
+
+def read_command_batches(f_handler, chunk_size):
+    '''Yields (TransactionBatch, lines read, 0) for every `chunk_size` lines of a command file'''
+    last_ticker = None
+    first_line  = 1
+    while True:
+        lines = list(itertools.islice(f_handler, chunk_size))
+        if len(lines) < 1:
+            return
+        command = ''.join(lines)
+        try:
+            batch = parse_commands(command, last_ticker=last_ticker)
+        except CommandSyntaxError as e:
+            line = first_line + e.command.count('\n', 0, e.position)
+            raise CommandSyntaxError(f"{e.message}. Line {line} of the file", e.command, e.position, e.item) from None
+        if len(batch) > 0:
+            last_ticker = batch.tickers[-1]
+        first_line += len(lines)
+        yield batch, len(lines), 0
+
+def import_statement(db, path, broker=None, layout=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=print):
+    '''
+    Imports all the transactions of a statement file.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    path: str
+    broker: str, optional
+        Broker of the transactions in a CSV file (any alias in `BROKER_ALIASES_DICT`). It
+        also selects the layout when `layout` is not given. Defaults to the layout name.
+    layout: str, optional
+        One of `LAYOUTS`, or 'commands' for command_engine files. Detected when not given
+    chunk_size: int
+        Rows (or lines) read, inserted and committed at a time
+    progress: callable or None
+        Called with a progress message after every chunk
+
+    Returns
+    -------
+    dict
+        Number of rows read, transactions imported, transactions already in the database (not
+        imported again) and rows skipped, and the symbols in the file
+    '''
+    if broker is not None:
+        broker = get_broker_name(broker.strip().lower())
+    if layout is None:
+        if os.path.splitext(path)[1].lower() in COMMAND_FILE_EXTENSIONS:
+            layout = 'commands'
+        elif broker in LAYOUTS:
+            layout = broker
+        else:
+            layout = detect_layout(pd.read_csv(path, nrows=0).columns)
+            if layout is None:
+                raise ValueError(f"Could not detect the layout of {path}. Options: {list(LAYOUTS)} or 'commands'")
+    if (layout != 'commands') and (layout not in LAYOUTS):
+        raise ValueError(f"Unknown layout {layout}. Options: {list(LAYOUTS)} or 'commands'")
+
+    summary   = {'rows':0, 'imported':0, 'skipped':0, 'duplicates':0, 'symbols':set()}
+    occurrences = {}    #shared by all the chunks, so identical rows in different chunks are told apart
+    start     = time.time()
+    try:
+        with open(path, newline='' if layout != 'commands' else None, encoding='utf-8-sig') as f_handler:
+            if layout == 'commands':
+                batches = read_command_batches(f_handler, chunk_size)
+            else:
+                batches = read_csv_batches(f_handler, LAYOUTS[layout], broker or layout, chunk_size)
+
+            for batch, num_rows, num_skipped in batches:
+                num_imported = 0
+                if len(batch) > 0:
+                    inserted = bulk_insert_transactions(db, batch, occurrences=occurrences, dedupe=True)     #commits the chunk
+                    num_imported = sum(inserted.values())
+                summary['rows']       += num_rows
+                summary['imported']   += num_imported
+                summary['duplicates'] += len(batch) - num_imported
+                summary['skipped']    += num_skipped
+                summary['symbols'].update(batch.tickers)
+
+                #no percentage: pandas reads the file ahead of the rows it has parsed
+                if progress is not None:
+                    elapsed = max(time.time() - start, 1e-9)
+                    progress(f"--> {os.path.basename(path)}: {summary['rows']} rows read, {summary['imported']} transactions imported, "
+                             f"{summary['duplicates']} already imported, {summary['skipped']} skipped ({summary['rows']/elapsed:.0f} rows/s)")
+    finally:
+        #symbols of the chunks committed before an error too, their transactions are already stored
+        db.session.rollback()       #leftovers of the chunk that failed, if any
+        if len(summary['symbols']) > 0:
+            incremental_update_positions_table(db, summary['symbols'])
+    return summary
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {'--broker':None, '--layout':None, '--chunk-size':DEFAULT_CHUNK_SIZE}
+    for option in options:
+        if option in args:
+            idx = args.index(option)
+            options[option] = args[idx+1]
+            del args[idx:idx+2]
+
+    if len(args) < 2:
+        print(__doc__)
+        sys.exit()
+    DB_TYPE, path = args[0], args[1]
+
+    supported_dbs = ['mysql','sqlite']
+    if DB_TYPE == 'mysql':
+        database_URI = get_mysql_uri(config_file='mysql_config.yml')
+
+    elif DB_TYPE == 'sqlite':
+        project_dir  = os.path.dirname(os.path.abspath(__file__))
+        database_dir = os.path.join(project_dir, "asset_portfolio.db")
+        database_URI = f"sqlite:///{database_dir}"
+
+    else:
+        print(f'--> Database {DB_TYPE} not supported.\n\tDatabase options supported: {supported_dbs}')
+        sys.exit()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_URI
+    db.init_app(app)
+    install_query_profiler(app, db)
+    with app.app_context():
+        db.create_all()
+        migrate_database(db)
+        try:
+            with profile_job(f"import {os.path.basename(path)}"):
+                summary = import_statement(db, path, broker=options['--broker'], layout=options['--layout'],
+                                           chunk_size=int(options['--chunk-size']))
+        except CommandSyntaxError as e:
+            print(f"--> Import stopped. {e}")
+            sys.exit(1)
+        print(f"--> Imported {summary['imported']} transactions of {len(summary['symbols'])} symbols "
+              f"({summary['duplicates']} already imported, {summary['skipped']} rows skipped)")
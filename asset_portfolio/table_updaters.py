@@ -1,7 +1,14 @@
 '''Functions to be called from the main sites. It is to make the app code cleaner'''
+import os
+import json
+import time
 import datetime
+import decimal
+import threading
 import pandas as pd
 import yfinance as yf
+from flask import g, has_app_context
+from sqlalchemy import event
 
 from models import (Security, Transaction, Broker, 
                     Event, CryptoCurrency, CryptoWallet,
@@ -12,7 +19,20 @@ from tools import (compute_shares_after_splits, yf_flags,
                    get_symbol_to_id_dict,
                    compute_num_shares, 
                    get_last_transaction_datetime,
-                   get_last_split_datetime)
+                   get_last_split_datetime,
+                   get_split_events_df,
+                   bulk_insert_rows,
+                   upsert_rows,
+                   transaction_content_hash,
+                   get_existing_content_hashes,
+                   fetch_concurrently,
+                   FileCache)
+from split_engine import SHARES_DECIMALS, CURRENCY_DECIMALS
+from fixed_point import (load_ledger, aggregate_positions_fixed,
+                         to_fixed, from_fixed, average_cost)
+from ledger_cache import bump_ledger_version
+from command_engine import TransactionBatch
+from asof_engine import invalidate_position_snapshots
 
 
 CRYPTO_SYMBOL_TO_NAME = {
@@ -57,33 +77,109 @@ def get_broker_name(broker_name):
     return broker_name    #we only get to this point if the broker name is not recognized as a valid alias.
 
 def get_Broker_object(db,broker_name):
-    broker_name = broker_name.strip().lower()   #keep everything lowercase and stripped
-    broker_name = get_broker_name(broker_name)  #matches user-provided broker value with what exists in the database
-
-    broker = Broker.query.filter(Broker.name==broker_name).first()
-    if broker is None:
-        #creates broker and registers it in the database
-        broker = create_new_broker_object(broker_name)
-        db.session.add(broker)
-        db.session.commit()
-    return broker
+    broker_id = get_entity_resolver(db).broker_id(broker_name)   #creates and registers the broker if it does not exist
+    return Broker.query.get(broker_id)
 
 def get_cryptocurrency_object(db,crypto_symbol):
-    crypto_symbol = crypto_symbol.strip().lower()
-    crypto_object = CryptoCurrency.query.filter(CryptoCurrency.symbol==crypto_symbol).first()
-    if crypto_object is None:
-        name = get_crypto_name(crypto_symbol)
-        crypto_object = CryptoCurrency(symbol=crypto_symbol,name=name)
-        db.session.add(crypto_object)
-        db.session.commit()
-    return crypto_object
+    crypto_id = get_entity_resolver(db).cryptocurrency_id(crypto_symbol)
+    return CryptoCurrency.query.get(crypto_id)
+
+#-----Security metadata
+METADATA_CACHE_FOLDER = os.path.join('db_files','metadata_cache')
+
+def fetch_yfinance_info(symbol):
+    return yf.Ticker(symbol).info
+
+def is_useful_info(info):
+    '''False for the empty (or all-None, i.e. {'trailingPegRatio': None}) dicts yfinance returns for unknown symbols and failures'''
+    return any(value is not None for value in (info or {}).values())
+
+class SecurityMetadataProvider(object):
+    '''
+    Provides the yfinance `info` dictionary of a symbol, fetching it at most once per `ttl`
+    seconds. Results are kept in memory and on disk (json files in `cache_folder`), so
+    they survive restarts of the app. `prefetch` downloads the metadata of many symbols
+    concurrently.
+
+    Empty results and failed fetches are never written to disk. They are kept in memory for
+    `empty_ttl` seconds only, so a symbol yfinance does not know about does not block every
+    request, but a temporary failure is retried soon.
+    '''
+    def __init__(self, cache_folder=METADATA_CACHE_FOLDER, ttl=7*24*3600, fetcher=fetch_yfinance_info, max_workers=8, empty_ttl=15*60):
+        self.ttl         = ttl
+        self.empty_ttl   = empty_ttl
+        self.fetcher     = fetcher
+        self.max_workers = max_workers
+        self._disk_cache = FileCache(cache_folder, ttl=ttl, suffix='.json')
+        self._memory     = {}   #symbol -> (time fetched, info)
+        self._lock       = threading.Lock()
+
+    def _from_memory(self, symbol):
+        with self._lock:
+            cached = self._memory.get(symbol)
+        if cached is None:
+            return None
+        ttl = self.ttl if is_useful_info(cached[1]) else self.empty_ttl
+        if time.time() - cached[0] <= ttl:
+            return cached[1]
+        return None
+
+    def _to_memory(self, symbol, info):
+        with self._lock:
+            self._memory[symbol] = (time.time(), info)
+
+    def _from_disk(self, symbol):
+        content = self._disk_cache.get(symbol)
+        if content is None:
+            return None
+        info = json.loads(content)
+        return info if is_useful_info(info) else None     #empty files written by older versions are fetched again
 
-def create_new_security_object(symbol):
-    ticker = yf.Ticker(symbol)
-    instrument_type = ticker.info.get(yf_flags.FLAG_INSTRUMENT_TYPE,None)
-    company_name    = ticker.info.get(yf_flags.FLAG_NAME,None)
-    sector          = ticker.info.get(yf_flags.FLAG_SECTOR,None)
-    currency        = ticker.info.get(yf_flags.FLAG_CURRENCY,'USD')
+    def is_cached(self, symbol):
+        return (self._from_memory(symbol) is not None) or (self._from_disk(symbol) is not None)
+
+    def get(self, symbol):
+        info = self._from_memory(symbol)
+        if info is not None:
+            return info
+
+        info = self._from_disk(symbol)
+        if info is None:
+            info = self.fetcher(symbol) or {}
+            if is_useful_info(info):
+                self._disk_cache.set(symbol, json.dumps(info, default=str))
+        self._to_memory(symbol, info)
+        return info
+
+    def prefetch(self, symbols):
+        '''Fetches (concurrently) the metadata of every symbol in `symbols` that is not cached yet'''
+        missing = [symbol for symbol in symbols if not self.is_cached(symbol)]
+        if len(missing) < 1:
+            return
+        _, errors = fetch_concurrently(self.get, missing, max_workers=self.max_workers, retries=1)
+        for symbol in errors:
+            #do not block the next requests on it; kept in memory for `empty_ttl` only
+            print(f"\n--> Could not fetch metadata for {symbol.upper()}: {errors[symbol]}")
+            self._to_memory(symbol, {})
+
+_metadata_provider = None
+
+def get_metadata_provider():
+    '''Returns the SecurityMetadataProvider shared by the whole app'''
+    global _metadata_provider
+    if _metadata_provider is None:
+        _metadata_provider = SecurityMetadataProvider()
+    return _metadata_provider
+
+def create_new_security_object(symbol, metadata_provider=None):
+    if metadata_provider is None:
+        metadata_provider = get_metadata_provider()
+    info = metadata_provider.get(symbol)   #one (cached) yfinance call instead of one per field
+
+    instrument_type = info.get(yf_flags.FLAG_INSTRUMENT_TYPE,None)
+    company_name    = info.get(yf_flags.FLAG_NAME,None)
+    sector          = info.get(yf_flags.FLAG_SECTOR,None)
+    currency        = info.get(yf_flags.FLAG_CURRENCY,'USD')
 
     new_sec = Security(symbol,
                        instrument_type=instrument_type,
@@ -97,140 +193,365 @@ def create_new_broker_object(broker_name,website=''):
     broker = Broker(broker_name,website)
     return broker
 
-def update_transactions_table(db,tickers_dict):
+def create_new_cryptocurrency_object(crypto_symbol):
+    name = get_crypto_name(crypto_symbol)
+    crypto_object = CryptoCurrency(symbol=crypto_symbol,name=name)
+    return crypto_object
+
+#-----Entity resolution
+#Every insert into one of these tables bumps its version, so that in-memory maps held by
+#an EntityResolver know they need to be reloaded
+_ENTITY_VERSIONS = {
+    Security.__tablename__       : 0,
+    Broker.__tablename__         : 0,
+    CryptoCurrency.__tablename__ : 0,
+}
+
+@event.listens_for(Security, 'after_insert')
+@event.listens_for(Broker, 'after_insert')
+@event.listens_for(CryptoCurrency, 'after_insert')
+def _bump_entity_version(mapper, connection, target):
+    _ENTITY_VERSIONS[target.__tablename__] += 1
+
+class EntityResolver(object):
+    '''
+    Resolves security symbols, broker names and crypto symbols into their database ids
+    without a query per row. Each map (i.e. symbol->id) is loaded with a single query 
+    the first time it is needed and kept in memory. A map is reloaded when a row was
+    inserted into its table since it was loaded.
+
+    Missing entities are created (and flushed to get their id), but not committed.
+    Use `get_entity_resolver` to get the resolver of the current request.
+    '''
+    def __init__(self,db):
+        self.db = db
+        self._maps     = {}
+        self._versions = {}
+
+    def _get_map(self,table_class,key_column):
+        table_name = table_class.__tablename__
+        if self._versions.get(table_name) != _ENTITY_VERSIONS[table_name]:
+            self._maps[table_name]     = dict(self.db.session.query(key_column,table_class.id).all())
+            self._versions[table_name] = _ENTITY_VERSIONS[table_name]
+        return self._maps[table_name]
+
+    def _resolve(self,table_class,key_column,key,create_function):
+        id_map = self._get_map(table_class,key_column)
+        entity_id = id_map.get(key)
+        if entity_id is not None:
+            return entity_id
+
+        #it may have been inserted by another process since the map was loaded
+        entity_id = self.db.session.query(table_class.id).filter(key_column==key).scalar()
+        if entity_id is None:
+            new_object = create_function(key)
+            self.db.session.add(new_object)
+            self.db.session.flush()
+            entity_id = new_object.id
+
+            #our own insert bumped the version; the map is still valid
+            table_name = table_class.__tablename__
+            if self._versions.get(table_name) == _ENTITY_VERSIONS[table_name] - 1:
+                self._versions[table_name] = _ENTITY_VERSIONS[table_name]
+
+        id_map[key] = entity_id
+        return entity_id
+
+    def security_id(self,symbol):
+        return self._resolve(Security, Security.symbol, symbol, create_new_security_object)
+
+    def unknown_symbols(self,symbols):
+        '''Symbols from `symbols` that are not registered in the `securities` table yet'''
+        id_map = self._get_map(Security, Security.symbol)
+        return [symbol for symbol in symbols if symbol not in id_map]
+
+    def broker_id(self,broker_name):
+        broker_name = broker_name.strip().lower()   #keep everything lowercase and stripped
+        broker_name = get_broker_name(broker_name)  #matches user-provided broker value with what exists in the database
+        return self._resolve(Broker, Broker.name, broker_name, create_new_broker_object)
+
+    def cryptocurrency_id(self,crypto_symbol):
+        crypto_symbol = crypto_symbol.strip().lower()
+        return self._resolve(CryptoCurrency, CryptoCurrency.symbol, crypto_symbol, create_new_cryptocurrency_object)
+
+def get_entity_resolver(db):
+    '''Returns the EntityResolver of the current request (or app context), creating it if needed'''
+    if not has_app_context():
+        return EntityResolver(db)
+    if 'entity_resolver' not in g:
+        g.entity_resolver = EntityResolver(db)
+    return g.entity_resolver
+
+def bulk_insert_transactions(db,transactions,chunk_size=1000,occurrences=None,dedupe=False):
+    '''
+    Inserts all the transactions from `transactions` with multi-row INSERT statements inside
+    a single database transaction. Foreign keys (securities and brokers) are resolved in batch
+    through the request's EntityResolver, and rows are built straight from the columns of the
+    TransactionBatch, so no objects are created per transaction apart from the row itself.
+
+    Every transaction gets a content hash (see `tools.transaction_content_hash`), and the
+    hashes of the whole batch are looked up with one IN query per chunk. With `dedupe`, the
+    transactions already in the table are skipped, so importing an overlapping statement
+    again only adds what is new. Without it (transactions typed by the user) every
+    transaction is inserted, and the ones equal to a stored transaction get the next free
+    occurrence number in their hash.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    transactions: TransactionBatch or dict
+        Batch returned by `command_engine.parse_commands` (or built from a statement file).
+        Dictionaries of TransactionEvent lists returned by method `command_engine` are
+        turned into a batch first.
+    chunk_size: int
+        Maximum number of rows per INSERT statement (to stay within the parameter limits
+        of the database driver). All chunks are still committed together.
+    occurrences: dict, optional
+        Times each transaction was seen so far in the statement (keyed by its first content
+        hash). Pass the same dict for all the batches of one statement, so that identical
+        transactions in different batches are told apart. It is updated in place.
+    dedupe: bool
+        Skip the transactions that are already stored (for statement imports)
+
+    Returns
+    -------
+    dict
+        Number of rows inserted for each symbol, i.e. {'aapl':3, 'msft':0}
+    '''
+    if isinstance(transactions, dict):
+        transactions = TransactionBatch.from_tickers_dict(transactions)
+    resolver = get_entity_resolver(db)
+    if occurrences is None:
+        occurrences = {}
+    symbols = transactions.symbols()
+
+    #metadata of new securities is downloaded concurrently before any insert happens
+    get_metadata_provider().prefetch(resolver.unknown_symbols(symbols))
+    symbol_ids   = {symbol:resolver.security_id(symbol) for symbol in symbols}
+    broker_names = {broker:get_broker_name(broker.strip().lower()) for broker in set(transactions.brokers)}
+    broker_ids   = {broker:resolver.broker_id(name) for broker, name in broker_names.items()}
+
+    #transactions without a time get the current UTC time, taken once for the batch. It is not
+    #left to the database: now() is UTC on SQLite but the session's local time on MySQL. Whole
+    #seconds, so the hashed time is the stored one (DATETIME columns have no fractions)
+    utc_now = datetime.datetime.utcnow().replace(microsecond=0)
+
+    rows     = []
+    contents = []   #what each hash was computed from, with its occurrence number
+    for symbol, num_shares, cost_basis, time_execution, broker, is_dividend in transactions.rows():
+        if time_execution is None:
+            time_execution = utc_now
+        content_hash = transaction_content_hash(symbol, num_shares, cost_basis, is_dividend, time_execution, broker_names[broker])
+        occurrence   = occurrences.get(content_hash, 0)
+        occurrences[content_hash] = occurrence + 1
+        if occurrence > 0:
+            content_hash = transaction_content_hash(symbol, num_shares, cost_basis, is_dividend, time_execution, broker_names[broker], occurrence)
+
+        rows.append({
+            'symbol_id'      : symbol_ids[symbol],
+            'num_shares'     : decimal.Decimal(num_shares),
+            'cost_basis'     : decimal.Decimal(cost_basis),
+            'is_dividend'    : is_dividend,
+            'broker_id'      : broker_ids[broker],
+            'time_execution' : time_execution,
+            'content_hash'   : content_hash,
+        })
+        contents.append([symbol, num_shares, cost_basis, is_dividend, time_execution, broker_names[broker], occurrence])
+
+    existing = get_existing_content_hashes(db, [row['content_hash'] for row in rows], chunk_size=chunk_size)
+    if dedupe:
+        rows = [row for row in rows if row['content_hash'] not in existing]
+    else:
+        #rows equal to stored ones move to the next occurrence number that is free in the batch and in the table
+        taken     = {row['content_hash'] for row in rows} | existing
+        conflicts = [idx for idx, row in enumerate(rows) if row['content_hash'] in existing]
+        while len(conflicts) > 0:
+            for idx in conflicts:
+                content_hash = rows[idx]['content_hash']
+                while content_hash in taken:
+                    contents[idx][-1] += 1
+                    content_hash = transaction_content_hash(*contents[idx])
+                rows[idx]['content_hash'] = content_hash
+                taken.add(content_hash)
+            existing  = get_existing_content_hashes(db, [rows[idx]['content_hash'] for idx in conflicts], chunk_size=chunk_size)
+            taken    |= existing
+            conflicts = [idx for idx in conflicts if rows[idx]['content_hash'] in existing]
+
+    id_to_symbol        = {symbol_id:symbol for symbol, symbol_id in symbol_ids.items()}
+    inserted_per_symbol = {symbol:0 for symbol in symbols}
+    earliest_dates      = {}    #back-dated transactions make later position snapshots stale
+    for row in rows:
+        symbol_id = row['symbol_id']
+        inserted_per_symbol[id_to_symbol[symbol_id]] += 1
+        if (symbol_id not in earliest_dates) or (row['time_execution'] < earliest_dates[symbol_id]):
+            earliest_dates[symbol_id] = row['time_execution']
+
+    if dedupe:
+        #the unique index still guards against the same rows being inserted concurrently
+        upsert_rows(db, Transaction, rows, ['content_hash'], chunk_size=chunk_size)
+    else:
+        bulk_insert_rows(db, Transaction, rows, chunk_size=chunk_size)
+    invalidate_position_snapshots(db, earliest_dates)
+    db.session.commit()
+    if len(rows) > 0:
+        bump_ledger_version()
+
+    return inserted_per_symbol
+
+def update_transactions_table(db,transactions):
     '''Use this function with TransactionsForm
     Parameters
     ----------
     db: database
-    tickers_dict: dict
-        Dictionary returned by method `command_engine`
+    transactions: TransactionBatch or dict
+        Batch returned by `command_engine.parse_commands` (or the dictionary returned by
+        method `command_engine`). All of them are inserted, even the ones equal to a stored
+        transaction (the user may really have bought the same shares twice)
+
+    Returns
+    -------
+    dict
+        Number of rows inserted for each symbol (see `bulk_insert_transactions`)
     '''
-    for symbol in tickers_dict:
-        SYMBOL_object = Security.query.filter(Security.symbol==symbol).first()     #without .first() the return is a query object
-        if SYMBOL_object is None:
-            SYMBOL_object = create_new_security_object(symbol)
-            db.session.add(SYMBOL_object)
-            db.session.commit()
-        print(f"\n\n--> {SYMBOL_object}\n\n")
-        
-        trans_events = tickers_dict[symbol]   #gets list of TransactionEvent objects
-        for trans in trans_events:
-            BROKER_object = get_Broker_object(db, trans.broker)
-            TRANS_object = Transaction(
-                #trans.ticker, 
-                trans.amount, 
-                trans.cost_basis, 
-                trans.is_dividend(),
-                #get_broker_id(trans.broker),
-                time_execution=trans.datetime,
-            )
-
-            SYMBOL_object.transactions.append(TRANS_object)
-            BROKER_object.transactions.append(TRANS_object)
-            db.session.add(TRANS_object)
+    return bulk_insert_transactions(db,transactions)
+
+def write_positions(db, positions):
+    '''
+    Bulk upsert of computed positions into the `security_positions` table. It does not commit.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    positions: pandas.DataFrame
+        Indexed by `symbol_id`, with fixed-point columns `total_shares`, `cost_basis`, `invested`,
+        `last_transaction_update` and `last_transaction_id` (as returned by
+        `fixed_point.aggregate_positions_fixed` plus the last transaction update time and id)
+    '''
+    rows = []
+    for row in positions.itertuples():
+        rows.append({
+            'symbol_id'        : int(row.Index),
+            'total_shares'     : from_fixed(row.total_shares, SHARES_DECIMALS),
+            'cost_basis'       : from_fixed(row.cost_basis, CURRENCY_DECIMALS),
+            'invested'         : from_fixed(row.invested, CURRENCY_DECIMALS),
+            'last_transaction_update': row.last_transaction_update.to_pydatetime(),
+            'last_transaction_id'    : int(row.last_transaction_id),
+        })
+
+    upsert_rows(db, Position, rows, key_columns=['symbol_id'],
+                update_columns=['total_shares','cost_basis','invested','last_transaction_update','last_transaction_id'])
+
+def rebuild_positions(db, symbol_ids):
+    '''
+    Recomputes the positions of `symbol_ids` from their full transaction history and split
+    events (one query each) and writes them with `write_positions`. It does not commit.
+    Symbols without transactions are skipped.
+    '''
+    ledger_df = load_ledger(db, symbol_ids)
+    if len(ledger_df) < 1:
+        return
+    splits_df = get_split_events_df(db, symbol_ids)
+
+    positions = aggregate_positions_fixed(ledger_df, splits_df)
+    positions['last_transaction_update'] = ledger_df.groupby('symbol_id')['last_updated'].max()
+    positions['last_transaction_id']     = ledger_df.groupby('symbol_id')['id'].max()
+
+    write_positions(db, positions)
 
-    db.session.commit()
 def update_positions_table(db,symbols_list):
-    sec_dict = get_symbol_to_id_dict(db)
-
-    for symbol in symbols_list:
-        symbol_id = sec_dict[symbol]
-        SEC_object        = db.session.query(Security).filter(Security.symbol==symbol).first()
-        POSITION_object   = db.session.query(Position).filter(Position.symbol_id==symbol_id).first()
-
-        adjusted_vals = compute_shares_after_splits(db,symbol_id)
-        _total_shares = adjusted_vals[0]
-        _cost_basis   = adjusted_vals[1]
-        _invested     = adjusted_vals[2]
-
-        last_transaction_update = db.session.query(Transaction.last_updated).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.last_updated.desc()).first()[0]
-        print(f"\n\n--->LAST_TRANSACTION_UPDATE:\n\t{last_transaction_update}\n\n")
-        if POSITION_object is None:
-            POSITION_object = Position(total_shares=_total_shares,cost_basis=_cost_basis,invested=_invested,last_transaction_update=last_transaction_update)
-            SEC_object.positions.append(POSITION_object)
-            db.session.add(POSITION_object)
-        else:
-            update_dict = {
-                'total_shares'    :_total_shares,
-                'cost_basis'      :_cost_basis,
-                'invested'        :_invested,
-                'last_transaction_update':last_transaction_update,
-            }
-            #POSITION_object.update(update_dict)
-            db.session.query(Position).filter_by(symbol_id=symbol_id).update(update_dict)
-
-        db.session.commit()
-
-def PROBLEM_update_positions_table(db,symbols_list):
-    sec_dict = get_symbol_to_id_dict(db)
-
-    for symbol in symbols_list:
-        symbol_id = sec_dict[symbol]
-        SEC_object        = db.session.query(Security).filter(Security.symbol==symbol).first()
-        POSITION_object   = db.session.query(Position).filter(Position.symbol_id==symbol_id).first()
-        last_transaction  = get_last_transaction_datetime(db,symbol_id)
-        #last_event       = get_last_split_datetime(db,symbol_id)
-        last_event_update = db.session.query(Event).filter(Event.symbol_id==symbol_id,Event.event_type=='split').order_by(Event.last_updated.desc()).first()[0]
-        if last_event_update is None:
-            last_event_update = datetime.datetime.fromisoformat('1800-01-01')  #just a very old date. It is the best I can do right now
-
-        if (POSITION_object is None) or (POSITION_object.last_updated < last_event_update):
-            #when there is no record of this object for the first time or when a new split is applied, we need to calculate with the entire history
-            adjusted_vals = compute_shares_after_splits(db,symbol_id)
-            total_shares  = adjusted_vals[0]
-            cost_basis    = adjusted_vals[1]
-            invested      = adjusted_vals[2]
-            
-            last_transaction_update = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.last_updated.desc()).first()[0]
-            POSITION_object = Position(total_shares=total_shares,cost_basis=cost_basis,invested=invested,last_transaction_update=last_transaction_update)
-            SEC_object.positions.append(POSITION_object)
-            db.session.add(POSITION_object)
-        
-        else:
-            sql_query = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id,Transaction.last_updated>POSITION_object.last_transaction_update).order_by(Transaction.time_execution.asc()).statement
-            trans_df = pd.read_sql(sql=sql_query,con=db.session.bind)
-            if len(trans_df) < 1:
-                continue
-
-            trans_df = trans_df.set_index('time_execution',drop=True)
-
-            old_total_shares = POSITION_object.total_shares
-            old_invested     = POSITION_object.invested
-
-            adjusted_vals = compute_shares_after_splits(db,symbol_id,trans_df)
-            _total_shares = adjusted_vals[0] + old_total_shares
-            _invested     = adjusted_vals[2] + old_invested
-            _cost_basis   = _invested / _total_shares
-            update_dict = {
-                'total_shares'    :_total_shares,
-                'cost_basis'      :_cost_basis,
-                'invested'        :_invested,
-                'last_transaction':last_transaction,
-            }
-            POSITION_object.update(update_dict) 
-
-        """    
+    '''
+    Rebuilds the positions of every symbol in `symbols_list` from their full history.
+    Transactions and split events for all the symbols are read with one query each, 
+    positions are computed in a single vectorized pass and written back with one bulk
+    upsert and a single commit.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    symbols_list: iterable of str
+        Symbols to rebuild. Symbols without transactions are skipped.
+    '''
+    sec_dict   = get_symbol_to_id_dict(db)
+    symbol_ids = [sec_dict[symbol] for symbol in symbols_list]
+    if len(symbol_ids) < 1:
+        return
+
+    rebuild_positions(db, symbol_ids)
+    db.session.commit()
+    bump_ledger_version()
+
+def incremental_update_positions_table(db,symbols_list):
+    '''
+    Updates the positions of `symbols_list` by folding only the transactions that were
+    added after the stored position was computed. `Position.last_transaction_id` is the
+    high-water mark: it holds the id of the newest transaction already included in the
+    position (transactions are only ever inserted, so ids only grow).
+
+    A full rebuild of a symbol only happens when it has no position yet (or one stored before
+    `last_transaction_id` existed), or when a split `Event` was stored after the position was
+    last updated (a new split changes the adjustment of every older transaction).
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    symbols_list: iterable of str
+        Symbols whose positions should be brought up to date
+    '''
+    sec_dict   = get_symbol_to_id_dict(db)
+    symbol_ids = [sec_dict[symbol] for symbol in symbols_list]
+    if len(symbol_ids) < 1:
+        return
+
+    stored_positions = {
+        POSITION_object.symbol_id : POSITION_object
+        for POSITION_object in db.session.query(Position).filter(Position.symbol_id.in_(symbol_ids)).all()
+    }
+    last_split_updates = dict(db.session.query(Event.symbol_id, db.func.max(Event.last_updated)).filter(
+                                    Event.symbol_id.in_(symbol_ids),
+                                    Event.event_type.in_(('split','reverse_split')),
+                                    ).group_by(Event.symbol_id).all())
+
+    ids_to_rebuild     = []
+    ids_to_incremental = []
+    for symbol_id in symbol_ids:
+        POSITION_object   = stored_positions.get(symbol_id)
+        last_split_update = last_split_updates.get(symbol_id)
+        if (POSITION_object is None) or (POSITION_object.last_transaction_id is None):
+            ids_to_rebuild.append(symbol_id)
+        elif (last_split_update is not None) and (POSITION_object.last_updated is not None) and (last_split_update >= POSITION_object.last_updated):
+            ids_to_rebuild.append(symbol_id)
         else:
-            #find all new transactions created since after the last update
-            last_transaction_update = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.last_updated.desc()).first()
-            if POSITION_object.last_transaction < last_transaction:
-                old_total_shares = POSITION_object.total_shares
-                old_cost_basis   = POSITION_object.cost_basis
-                old_invested     = POSITION_object.invested
-
-                sql_query = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id,Transaction.last_updated>POSITION_object.last_transaction_update).order_by(Transaction.time_execution.asc()).statement
-                trans_df = pd.read_sql(sql=sql_query,con=db.session.bind)
-                trans_df = trans_df.set_index('time_execution',drop=True)
-                adjusted_vals = compute_shares_after_splits(db,symbol_id,trans_df)
-                _total_shares = adjusted_vals[0] + old_total_shares
-                _invested     = adjusted_vals[2] + old_invested
-                _cost_basis   = _invested / _total_shares
-                update_dict = {
-                    'total_shares'    :_total_shares,
-                    'cost_basis'      :_cost_basis,
-                    'invested'        :_invested,
-                    'last_transaction':last_transaction,
-                }
-                POSITION_object.update(update_dict)
-        """
-        db.session.commit()  #maybe it needs to go after the for loop; test this
\ No newline at end of file
+            ids_to_incremental.append(symbol_id)
+
+    if len(ids_to_rebuild) > 0:
+        rebuild_positions(db, ids_to_rebuild)
+
+    if len(ids_to_incremental) > 0:
+        #only the transactions newer than each position's high-water mark
+        new_ledger_df = load_ledger(db, ids_to_incremental, newer_than_positions=True)
+
+        if len(new_ledger_df) > 0:
+            #splits are still needed: a new transaction can be back-dated to before an existing split
+            splits_df = get_split_events_df(db, new_ledger_df['symbol_id'].unique().tolist())
+            deltas    = aggregate_positions_fixed(new_ledger_df, splits_df)
+            last_transaction_updates = new_ledger_df.groupby('symbol_id')['last_updated'].max()
+            last_transaction_ids     = new_ledger_df.groupby('symbol_id')['id'].max()
+
+            updated_rows = []
+            for row in deltas.itertuples():
+                POSITION_object = stored_positions[row.Index]
+                total_shares = to_fixed(POSITION_object.total_shares, SHARES_DECIMALS) + row.total_shares
+                invested     = to_fixed(POSITION_object.invested, CURRENCY_DECIMALS) + row.invested
+
+                updated_rows.append({
+                    'id'               : POSITION_object.id,
+                    'total_shares'     : from_fixed(total_shares, SHARES_DECIMALS),
+                    'cost_basis'       : from_fixed(average_cost(invested, total_shares), CURRENCY_DECIMALS),
+                    'invested'         : from_fixed(invested, CURRENCY_DECIMALS),
+                    'last_transaction_update': max(last_transaction_updates[row.Index].to_pydatetime(), POSITION_object.last_transaction_update),
+                    'last_transaction_id'    : int(last_transaction_ids[row.Index]),
+                })
+            db.session.bulk_update_mappings(Position, updated_rows)
+
+    db.session.commit()
+    bump_ledger_version()
@@ -0,0 +1,72 @@
+'''
+Shared fixtures. The modules of the app import each other by name (`from models import db`),
+so the folder of the app goes first in `sys.path`. Every test gets a fresh SQLite database
+and works in a temporary folder, so caches (metadata, price store) never touch `db_files`.
+'''
+import os
+import sys
+import decimal
+import datetime
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from flask import Flask
+
+from models import db, Security, Broker, Transaction, Event
+import table_updaters
+from migrate_database import migrate_database
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fake_metadata(symbol):
+    return {'longName':symbol.upper(), 'quoteType':'EQUITY', 'sector':'Technology', 'currency':'USD'}
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(table_updaters, '_metadata_provider',
+                        table_updaters.SecurityMetadataProvider(cache_folder=str(tmp_path/'metadata'), fetcher=fake_metadata))
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path/'test.db'}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+def add_transaction(symbol_id, num_shares, cost_basis, time_execution, broker_id=1, is_dividend=False):
+    TRANSACTION_object = Transaction(decimal.Decimal(num_shares), decimal.Decimal(cost_basis), is_dividend,
+                                     broker_id=broker_id, time_execution=time_execution)
+    TRANSACTION_object.symbol_id = symbol_id
+    db.session.add(TRANSACTION_object)
+    return TRANSACTION_object
+
+@pytest.fixture
+def seeded(app):
+    '''aapl (id 1) and tsla (id 2) with a few transactions and splits, broker robinhood (id 1)'''
+    db.session.add(Broker('robinhood'))
+    for symbol in ('aapl','tsla'):
+        db.session.add(Security(symbol))
+    db.session.commit()
+
+    D = datetime.datetime
+    add_transaction(1, '10', '100', D(2019,1,5))
+    add_transaction(1, '2',  '150', D(2020,9,1,8))
+    add_transaction(2, '3',  '600', D(2019,6,1))
+    for symbol_id, factor, date in ((1, 4, D(2020,8,31)), (2, 5, D(2020,8,31))):
+        EVENT_object = Event('split', date, split_factor=factor)
+        EVENT_object.symbol_id = symbol_id
+        db.session.add(EVENT_object)
+    db.session.commit()
+    #splits collected long ago: positions computed now are newer, so they are updated incrementally
+    db.session.query(Event).update({'last_updated':datetime.datetime(2020,9,1)}, synchronize_session=False)
+    db.session.commit()
+    migrate_database(db)    #like the app on start up (content hashes of the rows above)
+    return db
@@ -0,0 +1,82 @@
+import re
+import datetime
+
+import pytest
+
+import command_engine
+from command_engine import parse_commands, command_engine as run_command, CommandSyntaxError, TransactionEvent
+
+D = datetime.datetime
+
+COMMANDS = [
+    'aapl 3.5 148.5 -div -b robinhood, msft 10 220.8 -b robinhood, nrz 5 9.68',
+    'aapl 1 130 -date 2021-01-05\n2 131 -date 2021-01-06 -t 10:30\n.5 132 -dt 2021-01-07 09:15:00',
+    't 3 29.8 -date 2021-03-01 -b cs,,\n\n vz -2 +55.10 -div -x',
+    'o 1 60 -dt 2021-01-07 09:15:00 -date 2021-02-01',
+    'aapl 1 2 -b',
+]
+
+def columns(batch):
+    return [batch.tickers, batch.num_shares, batch.cost_basis, batch.datetimes, batch.brokers,
+            batch.is_dividend, batch.flags, batch.positions]
+
+@pytest.fixture
+def token_path_only(monkeypatch):
+    '''Every transaction goes through the tokenizer (ITEM_RE never matches)'''
+    monkeypatch.setattr(command_engine, 'ITEM_RE', re.compile(r"(?!)"))
+
+@pytest.mark.parametrize('command', COMMANDS)
+def test_fast_path_and_token_path_agree(command, request):
+    fast = parse_commands(command)
+    request.getfixturevalue('token_path_only')
+    assert columns(parse_commands(command)) == columns(fast)
+
+def test_fields():
+    batch = parse_commands(COMMANDS[1])
+    assert batch.tickers   == ['aapl']*3
+    assert batch.datetimes == [D(2021,1,5,8), D(2021,1,6,10,30), D(2021,1,7,9,15)]
+    assert batch.positions == [0, 28, 60]
+
+    batch = parse_commands(COMMANDS[2])
+    assert (batch.tickers, batch.num_shares, batch.cost_basis) == (['t','vz'], ['3','-2'], ['29.8','+55.10'])
+    assert (batch.brokers, batch.is_dividend) == (['cs','robinhood'], [False, True])
+    assert batch.flags == [[], [('x','')]]
+
+    batch = parse_commands(COMMANDS[3])
+    assert batch.datetimes == [D(2021,2,1,8)]
+    assert batch.flags     == [[('dt','2021-01-07 09:15:00')]]
+
+def test_irregular_transactions_take_the_token_path():
+    batch = parse_commands('-b cs aapl 1 2 -date 2021-01-05, 3 4')
+    assert (batch.tickers, batch.brokers) == (['aapl','aapl'], ['cs','robinhood'])
+    assert batch.datetimes[0] == D(2021,1,5,8)
+
+def test_valueless_broker_flag_is_dropped():
+    for command in ('aapl 1 2 -b', 'aapl 1 2 -b -div', 'aapl -b 1 2'):
+        batch = parse_commands(command)
+        assert batch.brokers == [TransactionEvent.DEFAULT_BROKER]
+        assert batch.flags   == [[]]
+    event = TransactionEvent('aapl', '1', '2', [('b','')])
+    assert (event.broker, event.flags) == (TransactionEvent.DEFAULT_BROKER, ())
+
+def test_ticker_carries_over():
+    batch = parse_commands('aapl 1 2, 3 4\n msft 5 6, 7 8')
+    assert batch.tickers == ['aapl','aapl','msft','msft']
+    assert parse_commands('1 2, 3 4', last_ticker='ko').tickers == ['ko','ko']
+    assert parse_commands('1 2 -div', last_ticker='ko').is_dividend == [True]   #token path
+    assert list(run_command('aapl 1 2, 3 4')) == ['aapl']
+
+@pytest.mark.parametrize('command, position, item, message', [
+    ('1 2',                              0,  0, 'Missing ticker symbol'),
+    ('aapl 1 2, msft 1',                10,  1, 'Expected number of shares and price'),
+    ('aapl 1 2 3',                       9,  0, 'Unexpected number'),
+    ('aapl 1 2, 3 msft 4',              12,  1, "Unexpected word 'msft'"),
+    ('aapl 1 2\nmsft 1 $2',             16,  1, "Invalid token '$2'"),
+    ('aapl 1 2, msft 1 2 -date 2021-13-01', 19, 1, 'Invalid date or time'),
+])
+def test_error_offsets(command, position, item, message):
+    with pytest.raises(CommandSyntaxError) as info:
+        parse_commands(command)
+    assert (info.value.position, info.value.item) == (position, item)
+    assert info.value.message.startswith(message)
+    assert str(info.value).endswith('\n' + ' '*(position - command.rfind('\n', 0, position) - 1) + '^')
@@ -0,0 +1,101 @@
+import decimal
+import datetime
+
+from sqlalchemy import text, event
+
+from models import db, Transaction, Position
+from command_engine import parse_commands
+from migrate_database import migrate_database, add_transaction_content_hash, get_existing_columns
+from conftest import add_transaction
+from table_updaters import (bulk_insert_transactions, update_transactions_table,
+                            update_positions_table, incremental_update_positions_table)
+
+
+def drop_content_hash(db):
+    '''Turns the test database into one created before `transactions.content_hash` existed'''
+    db.session.execute(text("DROP INDEX uq_transactions_content_hash"))
+    db.session.execute(text("ALTER TABLE transactions DROP COLUMN content_hash"))
+    db.session.commit()
+
+def get_total_shares(symbol_id):
+    return db.session.query(Position.total_shares).filter(Position.symbol_id==symbol_id).scalar()
+
+
+def test_backfill_keeps_last_updated_and_positions(seeded):
+    old_time = datetime.datetime(2021,1,1)
+    db.session.execute(text("UPDATE transactions SET last_updated = :old_time"), {'old_time':old_time})
+    db.session.commit()
+    update_positions_table(db, ['aapl'])
+    assert get_total_shares(1) == decimal.Decimal('42')     #10*4 + 2
+
+    drop_content_hash(db)
+    add_transaction_content_hash(db)
+    assert 'content_hash' in get_existing_columns(db.engine, 'transactions')
+    assert db.session.query(Transaction).filter(Transaction.content_hash.is_(None)).count() == 0
+    assert {last_updated for last_updated, in db.session.query(Transaction.last_updated)} == {old_time}
+
+    bulk_insert_transactions(db, parse_commands('aapl 1 200 -date 2021-06-01'))
+    incremental_update_positions_table(db, ['aapl'])
+    assert get_total_shares(1) == decimal.Decimal('43')
+
+def test_backfill_numbers_identical_rows(seeded):
+    add_transaction(1, '10', '100', datetime.datetime(2019,1,5))    #same as the first one
+    db.session.commit()
+
+    drop_content_hash(db)
+    add_transaction_content_hash(db)
+    add_transaction_content_hash(db)     #runs on every start up
+    hashes = [content_hash for content_hash, in db.session.query(Transaction.content_hash)]
+    assert len(hashes) == 4 and len(set(hashes)) == 4
+
+def test_typed_transactions_are_never_dropped(seeded):
+    command = 'aapl 1 150 -date 2024-01-05, aapl 1 150 -date 2024-01-05'
+    assert update_transactions_table(db, parse_commands(command)) == {'aapl':2}
+    assert update_transactions_table(db, parse_commands(command)) == {'aapl':2}     #submitted again
+    hashes = [content_hash for content_hash, in db.session.query(Transaction.content_hash).filter(Transaction.symbol_id==1)]
+    assert len(hashes) == 6 and len(set(hashes)) == 6
+
+def test_dedupe_skips_stored_transactions(seeded):
+    command = 'aapl 1 150 -date 2024-01-05, aapl 1 150 -date 2024-01-05, tsla 2 700 -date 2024-01-06'
+    assert bulk_insert_transactions(db, parse_commands(command), dedupe=True) == {'aapl':2, 'tsla':1}
+    assert bulk_insert_transactions(db, parse_commands(command), dedupe=True) == {'aapl':0, 'tsla':0}
+
+    #one more of the same, in a statement that has it three times
+    command = 'aapl 1 150 -date 2024-01-05, aapl 1 150 -date 2024-01-05, aapl 1 150 -date 2024-01-05'
+    assert bulk_insert_transactions(db, parse_commands(command), dedupe=True) == {'aapl':1}
+
+def test_occurrences_are_shared_between_batches(seeded):
+    occurrences = {}
+    for _ in range(2):
+        inserted = bulk_insert_transactions(db, parse_commands('tsla 2 700 -date 2024-01-06'), occurrences=occurrences, dedupe=True)
+        assert inserted == {'tsla':1}
+    assert db.session.query(Transaction).filter(Transaction.symbol_id==2).count() == 3
+
+def test_migrated_database_is_not_scanned(seeded):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(' '.join(statement.split()).lower())
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        migrate_database(db)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    reads = [statement for statement in statements if ' from transactions' in statement]
+    assert len(reads) == 1 and 'limit' in reads[0]     #only the "any hash missing?" lookup
+    assert not any(statement.startswith(('update','insert','delete','alter','create')) for statement in statements)
+
+def test_missing_hashes_are_filled_on_start_up(seeded):
+    db.session.execute(text("UPDATE transactions SET content_hash = NULL WHERE id = 2"))
+    db.session.commit()
+    migrate_database(db)
+    assert db.session.query(Transaction).filter(Transaction.content_hash.is_(None)).count() == 0
+
+def test_transactions_without_time_get_one_utc_time(seeded):
+    before = datetime.datetime.utcnow().replace(microsecond=0)
+    bulk_insert_transactions(db, parse_commands('aapl 1 200, tsla 2 700 -div, aapl 3 201 -date 2021-06-01'))
+    after  = datetime.datetime.utcnow()
+    times  = [time_execution for time_execution, in db.session.query(Transaction.time_execution).filter(Transaction.id > 3).order_by(Transaction.id)]
+    assert times[0] == times[1]
+    assert before <= times[0] <= after and times[0].microsecond == 0
+    assert times[2] == datetime.datetime(2021,6,1,8)
@@ -0,0 +1,38 @@
+import datetime
+
+import numpy as np
+
+from models import db, Dividend
+from dividend_engine import schedule_months, build_dividend_calendar, MONTHS
+from table_updaters import update_positions_table
+
+
+def paid_months(schedule, payment_month):
+    row = schedule_months(np.array([schedule]), np.array([payment_month]))[0]
+    return [MONTHS[idx] for idx in np.flatnonzero(row)]
+
+def test_quarterly_cycle_follows_the_last_payment():
+    assert paid_months(1, 1)  == ['Jan','Apr','Jul','Oct']
+    assert paid_months(2, 11) == ['Feb','May','Aug','Nov']
+    #codes of the old off-by-one formula: the payment month wins
+    assert paid_months(2, 1)  == ['Jan','Apr','Jul','Oct']
+    assert paid_months(1, 12) == ['Mar','Jun','Sep','Dec']
+    #without a payment date the code is all there is
+    assert paid_months(3, 0)  == ['Mar','Jun','Sep','Dec']
+
+def test_other_schedules():
+    assert len(paid_months(0, 5)) == 12
+    assert paid_months(4, 8)  == ['Feb','Aug']
+    assert paid_months(5, 7)  == ['Jul']
+    assert paid_months(-1, 0) == []
+
+def test_calendar_with_a_stale_quarterly_code(seeded):
+    update_positions_table(db, ['aapl'])
+    DIVIDEND_object = Dividend(0.22, 3, datetime.datetime(2022,2,4), datetime.datetime(2022,2,10))   #Feb payer stored as Mar cycle
+    DIVIDEND_object.symbol_id = 1
+    db.session.add(DIVIDEND_object)
+    db.session.commit()
+
+    calendar = build_dividend_calendar(db)
+    assert [month for month in MONTHS if calendar.loc['aapl', month] > 0] == ['Feb','May','Aug','Nov']
+    assert round(calendar.loc['aapl', 'Feb'], 6) == round(0.22*42, 6)
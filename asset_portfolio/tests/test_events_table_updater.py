@@ -0,0 +1,109 @@
+import time
+import datetime
+import threading
+
+import pandas as pd
+
+from models import db, Security, Event
+from database_operations import events_table_updater
+
+D = datetime.datetime
+
+
+def splits(*items):
+    '''Split history like the one of yfinance: factors indexed by tz-aware dates'''
+    dates = pd.DatetimeIndex([pd.Timestamp(date) for date, _ in items]).tz_localize('America/New_York')
+    return pd.Series([factor for _, factor in items], index=dates, dtype=float)
+
+class FakeFetcher(object):
+    '''
+    Split histories from `histories` (an Exception is raised). The first `failures[symbol]`
+    calls of a symbol raise. Records the start time of every call and the peak of
+    concurrent calls.
+    '''
+    def __init__(self, histories, failures=None, delay=0.0):
+        self.histories = histories
+        self.failures  = dict(failures or {})
+        self.delay     = delay
+        self.calls     = []     #(symbol, start time)
+        self.active    = 0
+        self.peak      = 0
+        self._lock     = threading.Lock()
+
+    def __call__(self, symbol):
+        with self._lock:
+            self.calls.append((symbol, time.monotonic()))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            failing = self.failures.get(symbol, 0) > 0
+            if failing:
+                self.failures[symbol] -= 1
+        try:
+            time.sleep(self.delay)
+            history = self.histories.get(symbol, splits())
+            if failing or isinstance(history, Exception):
+                raise history if isinstance(history, Exception) else ConnectionError(f"{symbol} timed out")
+            return history
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def count(self, symbol):
+        return sum(1 for called, _ in self.calls if called == symbol)
+
+def stored_splits():
+    query = (db.session.query(Security.symbol, Event.event_date, Event.split_factor)
+             .join(Security, Security.id == Event.symbol_id).order_by(Security.symbol, Event.event_date))
+    return [(symbol, date, float(factor)) for symbol, date, factor in query.all()]
+
+def add_securities(count):
+    for idx in range(count):
+        db.session.add(Security(f"sym{idx}"))
+    db.session.commit()
+
+
+def test_new_splits_are_stored_once(seeded):
+    fetcher = FakeFetcher({
+        'aapl' : splits(('2014-06-09', 7), ('2020-08-31', 4)),
+        'tsla' : splits(('2020-08-31', 5), ('2022-08-25', 3)),
+    })
+    assert events_table_updater(db, fetcher=fetcher, rate_limit=None) == {'aapl':1, 'tsla':1}
+    assert stored_splits() == [
+        ('aapl', D(2014,6,9),   7.0),
+        ('aapl', D(2020,8,31),  4.0),
+        ('tsla', D(2020,8,31),  5.0),
+        ('tsla', D(2022,8,25),  3.0),
+    ]
+    assert events_table_updater(db, fetcher=fetcher, rate_limit=None) == {}
+    assert len(stored_splits()) == 4
+
+def test_fetches_are_bounded_by_max_workers(seeded):
+    add_securities(10)
+    fetcher = FakeFetcher({}, delay=0.05)
+    events_table_updater(db, fetcher=fetcher, max_workers=3, rate_limit=None)
+    assert len(fetcher.calls) == 12
+    assert 1 < fetcher.peak <= 3
+
+def test_fetches_are_rate_limited(seeded):
+    add_securities(4)
+    fetcher = FakeFetcher({})
+    events_table_updater(db, fetcher=fetcher, max_workers=6, rate_limit=20.0)
+    starts = sorted(start for _, start in fetcher.calls)
+    assert len(starts) == 6
+    assert starts[-1] - starts[0] >= 5/20.0 * 0.9
+    assert min(later - earlier for earlier, later in zip(starts, starts[1:])) >= 1/20.0 * 0.9
+
+def test_failed_fetches_are_retried_and_skipped(seeded):
+    fetcher = FakeFetcher({'aapl':splits(('2014-06-09', 7)), 'tsla':ValueError('no data')},
+                          failures={'aapl':2})
+    new_events = events_table_updater(db, fetcher=fetcher, rate_limit=None, retries=2, backoff=0.01)
+    assert new_events == {'aapl':1}
+    assert (fetcher.count('aapl'), fetcher.count('tsla')) == (3, 3)
+    assert ('aapl', D(2014,6,9), 7.0) in stored_splits()
+
+    #retries go through the rate limiter too
+    fetcher = FakeFetcher({}, failures={'aapl':1, 'tsla':1})
+    events_table_updater(db, fetcher=fetcher, rate_limit=20.0, retries=1, backoff=0.0)
+    starts = sorted(start for _, start in fetcher.calls)
+    assert len(starts) == 4
+    assert starts[-1] - starts[0] >= 3/20.0 * 0.9
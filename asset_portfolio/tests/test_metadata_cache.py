@@ -0,0 +1,69 @@
+import os
+import time
+
+from table_updaters import SecurityMetadataProvider
+
+
+class FakeYfinance(object):
+    '''Fetcher returning `responses[symbol]` (an exception is raised), counting the calls'''
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls     = []
+
+    def __call__(self, symbol):
+        self.calls.append(symbol)
+        response = self.responses[symbol]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+def make_provider(tmp_path, fetcher, **kwargs):
+    return SecurityMetadataProvider(cache_folder=str(tmp_path), fetcher=fetcher, **kwargs)
+
+
+def test_metadata_is_cached_in_memory_and_on_disk(tmp_path):
+    fetcher  = FakeYfinance({'aapl':{'longName':'Apple Inc.'}})
+    provider = make_provider(tmp_path, fetcher)
+    assert provider.get('aapl') == {'longName':'Apple Inc.'}
+    assert provider.get('aapl') == {'longName':'Apple Inc.'}
+    assert make_provider(tmp_path, fetcher).get('aapl') == {'longName':'Apple Inc.'}     #after a restart
+    assert fetcher.calls == ['aapl']
+
+def test_empty_results_are_not_written_to_disk(tmp_path):
+    fetcher  = FakeYfinance({'xyz':{}, 'zzz':{'trailingPegRatio':None}, 'nil':None})
+    provider = make_provider(tmp_path, fetcher)
+    for symbol in ('xyz','zzz','nil'):
+        provider.get(symbol)
+        provider.get(symbol)
+    assert fetcher.calls == ['xyz','zzz','nil']     #kept in memory for a while
+    assert os.listdir(tmp_path) == []
+
+    fetcher.responses['xyz'] = {'longName':'Now listed'}
+    assert make_provider(tmp_path, fetcher).get('xyz') == {'longName':'Now listed'}
+
+def test_empty_results_expire_after_empty_ttl(tmp_path):
+    fetcher  = FakeYfinance({'xyz':{}})
+    provider = make_provider(tmp_path, fetcher, empty_ttl=60)
+    provider.get('xyz')
+    provider._memory['xyz'] = (time.time() - 61, {})
+    assert not provider.is_cached('xyz')
+    provider.get('xyz')
+    assert fetcher.calls == ['xyz','xyz']
+
+def test_empty_files_of_older_versions_are_refetched(tmp_path):
+    (tmp_path/'aapl.json').write_text('{}')
+    fetcher = FakeYfinance({'aapl':{'longName':'Apple Inc.'}})
+    assert make_provider(tmp_path, fetcher).get('aapl') == {'longName':'Apple Inc.'}
+    assert (tmp_path/'aapl.json').read_text() == '{"longName": "Apple Inc."}'
+
+def test_prefetch_failures_are_not_cached_on_disk(tmp_path):
+    fetcher  = FakeYfinance({'aapl':{'longName':'Apple Inc.'}, 'bad':ConnectionError('timeout')})
+    provider = make_provider(tmp_path, fetcher)
+    provider.prefetch(['aapl','bad'])
+    assert fetcher.calls.count('bad') == 2          #one retry
+    assert provider.get('bad') == {}                #no new call while `empty_ttl` lasts
+    assert fetcher.calls.count('bad') == 2
+    assert sorted(os.listdir(tmp_path)) == ['aapl.json']
+
+    fetcher.responses['bad'] = {'longName':'Back online'}
+    assert make_provider(tmp_path, fetcher).get('bad') == {'longName':'Back online'}
@@ -0,0 +1,58 @@
+import decimal
+import datetime
+
+from sqlalchemy import text
+
+from models import db, Transaction, Position
+from conftest import add_transaction
+from table_updaters import update_positions_table, incremental_update_positions_table
+from migrate_database import migrate_database, get_existing_columns
+
+
+def get_position(symbol_id):
+    return db.session.query(Position).filter(Position.symbol_id==symbol_id).one()
+
+def test_transaction_stored_in_the_same_second_is_folded(seeded):
+    update_positions_table(db, ['aapl'])
+    high_water_time = get_position(1).last_transaction_update
+
+    #same `last_updated` as the newest transaction already in the position
+    TRANSACTION_object = add_transaction(1, '1', '200', datetime.datetime(2021,6,1))
+    db.session.flush()
+    db.session.execute(text("UPDATE transactions SET last_updated = :time WHERE id = :id"),
+                       {'time':high_water_time, 'id':TRANSACTION_object.id})
+    db.session.commit()
+
+    incremental_update_positions_table(db, ['aapl'])
+    POSITION_object = get_position(1)
+    assert POSITION_object.total_shares == decimal.Decimal('43')
+    assert POSITION_object.last_transaction_id == TRANSACTION_object.id
+
+def test_updated_transaction_is_not_counted_twice(seeded):
+    update_positions_table(db, ['aapl'])
+    db.session.query(Transaction).filter(Transaction.symbol_id==1).update(
+        {'is_dividend':False, 'last_updated':datetime.datetime(2100,1,1)}, synchronize_session=False)
+    db.session.commit()
+
+    incremental_update_positions_table(db, ['aapl'])
+    assert get_position(1).total_shares == decimal.Decimal('42')
+
+def test_position_without_high_water_mark_is_rebuilt(seeded):
+    update_positions_table(db, ['aapl'])
+    db.session.execute(text("UPDATE security_positions SET last_transaction_id = NULL, total_shares = 0"))
+    db.session.commit()
+
+    incremental_update_positions_table(db, ['aapl'])
+    assert get_position(1).total_shares == decimal.Decimal('42')
+
+def test_migration_adds_the_high_water_mark(seeded):
+    update_positions_table(db, ['aapl'])
+    db.session.execute(text("ALTER TABLE security_positions DROP COLUMN last_transaction_id"))
+    db.session.commit()
+
+    migrate_database(db)
+    assert 'last_transaction_id' in get_existing_columns(db.engine, 'security_positions')
+    add_transaction(1, '1', '200', datetime.datetime(2021,6,1))
+    db.session.commit()
+    incremental_update_positions_table(db, ['aapl'])
+    assert get_position(1).total_shares == decimal.Decimal('43')
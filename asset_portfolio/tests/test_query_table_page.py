@@ -0,0 +1,38 @@
+import datetime
+
+from models import db, Broker, Transaction
+from tools import query_table_page
+
+from conftest import add_transaction
+
+D = datetime.datetime
+
+
+def test_broker_aliases(seeded):
+    db.session.add(Broker('schwab'))
+    db.session.commit()
+    add_transaction(1, '1', '120', D(2021,1,5), broker_id=2)
+    db.session.commit()
+
+    for alias in ('cs', ' Charles Schwab ', 'schwab'):
+        df, _, _ = query_table_page(db, Transaction, broker=alias)
+        assert df['id'].tolist() == [4]
+    df, _, _ = query_table_page(db, Broker, broker='rb')
+    assert df['name'].tolist() == ['robinhood']
+
+def test_date_only_date_to_includes_the_whole_day(seeded):
+    #transaction 2 is on 2020-09-01 08:00
+    df, _, _ = query_table_page(db, Transaction, date_to=datetime.date(2020,9,1))
+    assert df['id'].tolist() == [1, 2, 3]
+    df, _, _ = query_table_page(db, Transaction, date_to=D(2020,9,1))
+    assert df['id'].tolist() == [1, 3]
+    df, _, _ = query_table_page(db, Transaction, date_from=datetime.date(2020,9,1), date_to=datetime.date(2020,9,1))
+    assert df['id'].tolist() == [2]
+
+def test_keyset_pages(seeded):
+    df, has_older, has_newer = query_table_page(db, Transaction, num_rows=2, columns=['num_shares'])
+    assert (df.columns.tolist(), df['id'].tolist(), has_older, has_newer) == (['id','num_shares'], [2, 3], True, False)
+    df, has_older, has_newer = query_table_page(db, Transaction, num_rows=2, before_id=2)
+    assert (df['id'].tolist(), has_older, has_newer) == ([1], False, True)
+    df, has_older, has_newer = query_table_page(db, Transaction, num_rows=1, after_id=1)
+    assert (df['id'].tolist(), has_older, has_newer) == ([2], True, True)
@@ -0,0 +1,106 @@
+import os
+import decimal
+import datetime
+
+import pytest
+
+from models import db, Security, Broker, Transaction, Position
+from command_engine import CommandSyntaxError
+from statement_importer import import_statement, detect_layout
+import statement_importer
+
+from conftest import FIXTURES_DIR
+
+
+def fixture(name):
+    return os.path.join(FIXTURES_DIR, name)
+
+def stored_transactions():
+    '''(symbol, broker, num_shares, cost_basis, is_dividend, time_execution) of every transaction, by id'''
+    query = (db.session.query(Security.symbol, Broker.name, Transaction.num_shares, Transaction.cost_basis,
+                              Transaction.is_dividend, Transaction.time_execution)
+             .join(Security, Security.id == Transaction.symbol_id)
+             .join(Broker, Broker.id == Transaction.broker_id)
+             .order_by(Transaction.id))
+    return [tuple(row) for row in query.all()]
+
+def total_shares(symbol):
+    return (db.session.query(Position.total_shares).join(Security, Security.id == Position.symbol_id)
+            .filter(Security.symbol == symbol).scalar())
+
+D = datetime.datetime
+Q = decimal.Decimal
+
+
+def test_detect_layout():
+    assert detect_layout(['Activity Date','Process Date','Instrument','Trans Code','Quantity','Price']) == 'robinhood'
+    assert detect_layout([' Date','Action','Symbol','Quantity','Price']) == 'schwab'
+    assert detect_layout(['Trade Date','Symbol','Transaction Type','Shares','Share Price']) == 'shareowner'
+    assert detect_layout(['Date','Symbol','Amount']) is None
+
+def test_robinhood_with_broker_alias(app):
+    summary = import_statement(db, fixture('robinhood.csv'), broker='rb', chunk_size=2, progress=None)
+    assert (summary['rows'], summary['imported'], summary['skipped']) == (5, 3, 2)     #cash dividend and footer skipped
+    assert stored_transactions() == [
+        ('aapl', 'robinhood', Q('2'),           Q('130.50'), False, D(2021,1,5,8)),
+        ('aapl', 'robinhood', Q('0.012345678'), Q('135.10'), True,  D(2021,2,11,8)),
+        ('tsla', 'robinhood', Q('-1'),          Q('690.00'), False, D(2021,3,1,8)),
+    ]
+    assert total_shares('aapl') == Q('2.012345678')
+
+def test_schwab_detected_from_header(app):
+    summary = import_statement(db, fixture('schwab.csv'), progress=None)
+    assert (summary['imported'], summary['skipped']) == (2, 1)
+    assert stored_transactions() == [
+        ('msft', 'schwab', Q('10'),     Q('220.80'), False, D(2021,1,5,8)),     #"as of" dates are ignored
+        ('msft', 'schwab', Q('0.0254'), Q('240.00'), True,  D(2021,2,11,8)),
+    ]
+
+def test_shareowner_thousands_separator(app):
+    import_statement(db, fixture('shareowner.csv'), broker='soo', progress=None)
+    assert stored_transactions() == [
+        ('ko', 'shareowner', Q('1000'), Q('45.10'), False, D(2020,6,1,8)),
+        ('ko', 'shareowner', Q('9.02'), Q('46.00'), True,  D(2020,7,1,8)),
+    ]
+
+def test_import_again_skips_stored_transactions(app):
+    import_statement(db, fixture('shareowner.csv'), broker='shareowner', progress=None)
+    summary = import_statement(db, fixture('shareowner.csv'), broker='shareowner', progress=None)
+    assert (summary['imported'], summary['duplicates']) == (0, 2)
+    assert total_shares('ko') == Q('1009.02')
+
+def test_command_file_carries_ticker_between_chunks(app):
+    summary = import_statement(db, fixture('commands.txt'), chunk_size=1, progress=None)
+    assert (summary['rows'], summary['imported']) == (4, 3)
+    assert [row[:5] for row in stored_transactions()] == [
+        ('aapl', 'robinhood', Q('3'), Q('129.8'), False),
+        ('aapl', 'robinhood', Q('1'), Q('130'),   True),
+        ('tsla', 'schwab',    Q('2'), Q('550'),   False),
+    ]
+
+def test_command_file_error_reports_line_and_keeps_committed_chunks(app):
+    with pytest.raises(CommandSyntaxError, match='Line 3 of the file'):
+        import_statement(db, fixture('bad_commands.txt'), chunk_size=2, progress=None)
+    assert len(stored_transactions()) == 2
+    assert total_shares('tsla') == Q('4')      #positions of the chunks committed before the error
+
+def test_positions_updated_when_a_chunk_fails(app, monkeypatch):
+    insert = statement_importer.bulk_insert_transactions
+    calls  = []
+    def failing_insert(db, batch, **kwargs):
+        calls.append(len(batch))
+        if len(calls) > 1:
+            raise RuntimeError('connection lost')
+        return insert(db, batch, **kwargs)
+    monkeypatch.setattr(statement_importer, 'bulk_insert_transactions', failing_insert)
+
+    with pytest.raises(RuntimeError):
+        import_statement(db, fixture('schwab.csv'), chunk_size=1, progress=None)
+    assert total_shares('msft') == Q('10')
+
+def test_progress_messages(app):
+    messages = []
+    import_statement(db, fixture('robinhood.csv'), broker='robinhood', chunk_size=2, progress=messages.append)
+    assert len(messages) == 3
+    assert messages[-1].startswith('--> robinhood.csv: 5 rows read, 3 transactions imported')
+    assert '%' not in ''.join(messages)
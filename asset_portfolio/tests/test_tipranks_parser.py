@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import tools
+from tools import parse_tipranks_dividends, _extract_fundamentals_text, _parse_fundamentals_text
+
+from conftest import FIXTURES_DIR
+
+PAGES_DIR = os.path.join(FIXTURES_DIR, 'tipranks')
+PAGES     = sorted(os.listdir(PAGES_DIR))
+
+def read_page(name):
+    with open(os.path.join(PAGES_DIR, name), encoding='utf-8') as f_handler:
+        return f_handler.read()
+
+
+@pytest.mark.parametrize('name', PAGES)
+def test_fast_parser_matches_html5lib(name):
+    html = read_page(name)
+    assert parse_tipranks_dividends('x', html) == parse_tipranks_dividends('x', html, parser='html5lib')
+
+@pytest.mark.parametrize('name', ['o_monthly.html', 't_script_in_block.html', 'vz_semi_entities.html'])
+def test_fast_path_skips_closing_tags_in_scripts_and_comments(name, monkeypatch):
+    html = read_page(name)
+    expected = parse_tipranks_dividends('x', html, parser='html5lib')
+    assert _parse_fundamentals_text('x', _extract_fundamentals_text(html)) == expected
+
+    def no_full_parser(html):
+        raise AssertionError('the fast path should not need html5lib here')
+    monkeypatch.setattr(tools, '_extract_fundamentals_text_html5lib', no_full_parser)
+    assert parse_tipranks_dividends('x', html) == expected
+
+def test_unbalanced_block_is_left_to_html5lib():
+    html = read_page('ko_unclosed_block.html')
+    assert _extract_fundamentals_text(html) is None
+    assert parse_tipranks_dividends('ko', html)[1] == '0.44'
+
+@pytest.mark.parametrize('name', ['amzn_no_dividend.html', 'brk_b_no_dividend.html'])
+def test_no_dividend_block_is_a_fast_result(name, monkeypatch):
+    def no_full_parser(html):
+        raise AssertionError('a found block without dividend should not need html5lib')
+    monkeypatch.setattr(tools, '_extract_fundamentals_text_html5lib', no_full_parser)
+    assert parse_tipranks_dividends('x', read_page(name)) == ('x', None, None, None, None, None)
+
+def test_missing_block_falls_back(monkeypatch):
+    html = read_page('o_monthly.html')
+    monkeypatch.setattr(tools, '_extract_fundamentals_text', lambda html: None)
+    assert parse_tipranks_dividends('o', html)[5] == 'monthly'
+
+def test_unparseable_fast_result_falls_back(monkeypatch):
+    html = read_page('o_monthly.html')
+    monkeypatch.setattr(tools, '_extract_fundamentals_text', lambda html: 'Dividend Amount Per Share $0.257 Monthly')  #no dates
+    assert parse_tipranks_dividends('o', html) == parse_tipranks_dividends('o', html, parser='html5lib')
@@ -0,0 +1,70 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from models import db, Security, Event
+from conftest import add_transaction
+from valuation_engine import ValuationEngine
+
+END = datetime.date(2021,1,10)
+
+
+class FakePrices(object):
+    '''Price loader with a fingerprint, like the price store'''
+    def __init__(self, prices):
+        self.prices  = prices     #symbol -> close price (the same every day)
+        self.version = 0
+
+    def load(self, symbols, start, end):
+        dates = pd.date_range(start, end, freq='D')
+        return pd.DataFrame({symbol:self.prices[symbol] for symbol in symbols if symbol in self.prices}, index=dates)
+
+    def fingerprint(self):
+        return self.version
+
+
+def test_new_symbol_with_a_historic_split(seeded):
+    engine = ValuationEngine(FakePrices({}).load).sync(db, end=END)
+    assert engine.symbols == ['aapl','tsla']
+
+    db.session.add(Security('msft'))
+    db.session.commit()
+    add_transaction(3, '1', '200', datetime.datetime(2020,1,6))
+    EVENT_object = Event('split', datetime.datetime(2020,6,1), split_factor=2)
+    EVENT_object.symbol_id = 3
+    db.session.add(EVENT_object)
+    db.session.commit()
+
+    engine.sync(db, end=END)
+    engine.sync(db, end=END)
+    assert engine.symbols == ['aapl','tsla','msft']
+    assert engine.shares_frame()['msft'].iloc[-1] == 2
+
+def test_prices_reload_when_the_fingerprint_changes(seeded):
+    prices = FakePrices({'aapl':100.0})
+    engine = ValuationEngine(prices.load, prices.fingerprint).sync(db, end=END)
+    assert np.isnan(engine.symbol_values()['tsla'].iloc[-1])
+
+    prices.prices['tsla'] = 50.0     #i.e. the prices job backfilled tsla
+    engine.sync(db, end=END)
+    assert np.isnan(engine.symbol_values()['tsla'].iloc[-1])     #same fingerprint, nothing reloaded
+
+    prices.version += 1
+    engine.sync(db, end=END)
+    assert engine.symbol_values()['tsla'].iloc[-1] == 15 * 50.0
+    assert engine.symbol_values()['aapl'].iloc[-1] == 42 * 100.0
+
+def test_corrected_split_factor_rebuilds_the_column(seeded):
+    engine = ValuationEngine(FakePrices({}).load).sync(db, end=END)
+    assert engine.shares_frame()['aapl'].iloc[-1] == 42
+    assert engine.shares_frame()['tsla'].iloc[-1] == 15
+
+    #a corrected factor stored in place: same id, newer `last_updated`
+    EVENT_object = db.session.query(Event).filter(Event.symbol_id==1).one()
+    EVENT_object.split_factor = 2
+    db.session.commit()
+
+    engine.sync(db, end=END)
+    assert engine.shares_frame()['aapl'].iloc[-1] == 22      #10*2 + 2
+    assert engine.shares_frame()['tsla'].iloc[-1] == 15
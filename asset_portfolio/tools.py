@@ -1,9 +1,9 @@
 """Collection of tools to use in different situations"""
-import math
 import decimal
+import hashlib
 from numpy.lib.arraysetops import isin
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from types import SimpleNamespace
 
 from models import db
@@ -11,12 +11,21 @@ from models import (Security, Transaction, Broker,
                     Event, CryptoCurrency, CryptoWallet,
                     Position, Dividend)
 
+from split_engine import SHARES_DECIMALS, CURRENCY_DECIMALS
+from fixed_point import load_ledger, aggregate_positions_fixed, to_fixed, from_fixed
+
 from bs4 import BeautifulSoup
 import requests
+import requests.adapters
 import re
 import os
+from html import unescape
 import sys
+import time
+import threading
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from flask import Flask
 
 yf_flags = SimpleNamespace(
@@ -84,19 +93,81 @@ def get_id_to_symbol_dict(db):
     return sec_dict
 
 
-def get_split_events_df(db):
-    '''NOT OPERATIONAL YET'''
-    sql_statement = db.session.query(
-                        Event.event_date, 
-                        Event.symbol_id, 
-                        Event.split_factor,
-                        ).filter(
-                            Event.event_type=='split' or Event.event_type=='reverse_split'
-                        ).statement
+def get_split_events_df(db, symbol_ids=None):
+    '''Split events for `symbol_ids` (all symbols if None), sorted by symbol and date'''
+    query = db.session.query(
+                Event.symbol_id,
+                Event.event_date,
+                Event.split_factor,
+                ).filter(
+                    Event.event_type.in_(('split','reverse_split'))
+                )
+    if symbol_ids is not None:
+        query = query.filter(Event.symbol_id.in_(list(symbol_ids)))
+    sql_statement = query.order_by(Event.symbol_id.asc(), Event.event_date.asc()).statement
 
     df = pd.read_sql(sql=sql_statement,con=db.session.bind)
     return df
 
+def get_transactions_df(db, symbol_ids=None):
+    '''Transactions for `symbol_ids` (all symbols if None), sorted by symbol and execution time.
+    Only the columns needed for computing positions are read.'''
+    query = db.session.query(
+                Transaction.symbol_id,
+                Transaction.time_execution,
+                Transaction.num_shares,
+                Transaction.cost_basis,
+                Transaction.last_updated,
+                )
+    if symbol_ids is not None:
+        query = query.filter(Transaction.symbol_id.in_(list(symbol_ids)))
+    sql_statement = query.order_by(Transaction.symbol_id.asc(), Transaction.time_execution.asc()).statement
+
+    df = pd.read_sql(sql=sql_statement,con=db.session.bind)
+    return df
+
+def get_positions_fingerprint(db):
+    '''Cheap summary (row count, last update) of the `security_positions` table. It changes
+    whenever positions are written, including by background jobs running in another process'''
+    count, last_updated = db.session.query(db.func.count(Position.id), db.func.max(Position.last_updated)).one()
+    return (count, last_updated)
+
+def get_dividends_fingerprint(db):
+    '''Same as `get_positions_fingerprint`, for the `current_dividends` table. The sum of the
+    amounts also catches changes made within the same second as the last update'''
+    return tuple(db.session.query(db.func.count(Dividend.id), db.func.max(Dividend.last_updated),
+                                  db.func.sum(Dividend.dividend_amount)).one())
+
+def transaction_content_hash(symbol, num_shares, cost_basis, is_dividend, time_execution, broker_name, occurrence=0):
+    '''
+    SHA-256 (hex) of what makes a transaction unique: symbol, shares, cost basis, dividend flag,
+    execution time (to the second) and broker. Amounts are compared as fixed-point ints, so
+    "1.50" and "1.5" give the same hash. `broker_name` must already be the canonical name (see
+    `table_updaters.get_broker_name`).
+
+    `occurrence` tells apart identical transactions of the same statement: the first one is 0,
+    the second one 1 and so on. Importing the statement again gives the same hashes.
+    '''
+    content = '|'.join([
+        symbol.strip().lower(),
+        str(to_fixed(num_shares, SHARES_DECIMALS)),
+        str(to_fixed(cost_basis, CURRENCY_DECIMALS)),
+        '1' if is_dividend else '0',
+        time_execution.strftime('%Y-%m-%d %H:%M:%S'),
+        broker_name.strip().lower(),
+        str(occurrence),
+    ])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def get_existing_content_hashes(db, content_hashes, chunk_size=1000):
+    '''Subset of `content_hashes` already in the `transactions` table, with one query per `chunk_size` hashes'''
+    content_hashes = list(content_hashes)
+    existing = set()
+    for idx in range(0, len(content_hashes), chunk_size):
+        existing.update(content_hash for content_hash, in db.session.query(Transaction.content_hash).filter(
+                            Transaction.content_hash.in_(content_hashes[idx:idx+chunk_size])))
+    return existing
+
 def get_last_transaction_datetime(db,symbol_id):
     TRANS_object = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.time_execution.desc()).first()
     if TRANS_object is None:
@@ -110,37 +181,8 @@ def get_last_split_datetime(db,symbol_id):
     return EVENT_object.event_date
 
 def compute_num_shares(db,symbol_id):
-
-    #get transactions for current symbol, ordered by date, ascending
-    sql_statement = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.time_execution.asc()).statement
-    trans_df = pd.read_sql(sql=sql_statement,con=db.session.bind)
-    trans_df = trans_df.set_index('time_execution', drop=True)
-
-    #get split events for current symbol, ordered by date, ascending
-    event_type = 'split'
-    sql_statement = db.session.query(Event).filter(Event.symbol_id==symbol_id,Event.event_type==event_type).order_by(Event.event_date.asc()).statement
-    splits = pd.read_sql(sql=sql_statement,con=db.session.bind)
-    splits = splits[['event_date','split_factor']].set_index('event_date', drop=True)
-
-    if len(splits) < 1:
-        total_shares = trans_df['num_shares'].sum()
-    else:
-        total_shares = 0
-        prev_split_date = '1800-01-01'
-        for row in splits.itertuples():
-            split_date   = row.Index
-            split_factor = row[1]
-
-            shares_to_split = trans_df[prev_split_date:split_date]
-            total_split_factor = splits[split_date:].aggregate(math.prod)[0]   #gets the single factor from multiplying all the splits from this time to the present
-
-            total_shares += (shares_to_split['num_shares']*total_split_factor).sum()
-
-            prev_split_date = split_date
-
-        #Here we add the last portion of shares purchased after last split
-        total_shares += trans_df[prev_split_date:]['num_shares'].sum()
-
+    '''Total number of shares for `symbol_id` after applying all split events'''
+    total_shares, _, _ = compute_shares_after_splits(db,symbol_id)
     return total_shares
 
 def compute_shares_after_splits(db,symbol_id,trans_df=None):
@@ -175,99 +217,368 @@ def compute_shares_after_splits(db,symbol_id,trans_df=None):
     '''
     #if trans_df is not provided, use all transactions (this will be the case when the `positions` table is first created)
     if trans_df is None:
-        sql_query = db.session.query(Transaction).filter(Transaction.symbol_id==symbol_id).order_by(Transaction.time_execution.asc()).statement
-        trans_df = pd.read_sql(sql=sql_query,con=db.session.bind)
-        trans_df = trans_df.set_index('time_execution', drop=True)
+        ledger_df = load_ledger(db, symbol_ids=[symbol_id])
+    else:
+        ledger_df = pd.DataFrame({
+            'symbol_id'      : symbol_id,
+            'time_execution' : trans_df.index,
+            'num_shares'     : [to_fixed(value, SHARES_DECIMALS) for value in trans_df['num_shares']],
+            'cost_basis'     : [to_fixed(value, CURRENCY_DECIMALS) for value in trans_df['cost_basis']],
+        })
 
     #get split events for current symbol, ordered by date, ascending
-    event_type = 'split'
-    sql_statement = db.session.query(Event).filter(Event.symbol_id==symbol_id,Event.event_type==event_type).order_by(Event.event_date.asc()).statement
-    splits = pd.read_sql(sql=sql_statement,con=db.session.bind)
-    splits = splits[['event_date','split_factor']].set_index('event_date', drop=True)
-
-    if len(splits) < 1:
-        total_shares = trans_df['num_shares'].sum()
-        money_invested = (trans_df['num_shares'] * trans_df['cost_basis']).sum()
-        if total_shares == 0:
-            adjusted_cost_basis = 0
-        else:
-            adjusted_cost_basis = money_invested / total_shares
-    else:
-        total_shares    = 0
-        prev_split_date = '1800-01-01'
-        for row in splits.itertuples():
-            split_date   = row.Index
-            split_factor = row[1]
-
-            shares_to_split = trans_df[prev_split_date:split_date]
-            total_split_factor = splits[split_date:].aggregate(math.prod)[0]   #gets the single factor from multiplying all the splits from this time to the present
-            total_shares += (shares_to_split['num_shares']*total_split_factor).sum()
-
-            prev_split_date = split_date
-
-        #Here we add the last portion of shares purchased after last split
-        total_shares += trans_df[prev_split_date:]['num_shares'].sum()
-        money_invested = (trans_df['num_shares'] * trans_df['cost_basis']).sum()
-        if total_shares == 0:
-            adjusted_cost_basis = 0
-        else:
-            adjusted_cost_basis = money_invested / total_shares
+    splits = get_split_events_df(db, symbol_ids=[symbol_id])
+
+    positions = aggregate_positions_fixed(ledger_df, splits)
+    if len(positions) < 1:
+        return (decimal.Decimal(0), decimal.Decimal(0), decimal.Decimal(0),)
 
-    return (decimal.Decimal(total_shares),
-            decimal.Decimal(adjusted_cost_basis),
-            decimal.Decimal(money_invested),)
+    total_shares, money_invested, adjusted_cost_basis = positions.loc[symbol_id, ['total_shares','invested','cost_basis']]
 
+    return (from_fixed(total_shares, SHARES_DECIMALS),
+            from_fixed(adjusted_cost_basis, CURRENCY_DECIMALS),
+            from_fixed(money_invested, CURRENCY_DECIMALS),)
 
-def webscrape_tipranks(ticker):
+
+def bulk_insert_rows(db, table_class, rows, chunk_size=1000):
+    '''
+    Inserts `rows` (list of dicts with the same keys) into the table of `table_class` with 
+    multi-row INSERT statements of at most `chunk_size` rows. It does not commit.
+    '''
+    for idx in range(0, len(rows), chunk_size):
+        db.session.execute(table_class.__table__.insert().values(rows[idx:idx+chunk_size]))
+
+def upsert_rows(db, table_class, rows, key_columns, update_columns=None, chunk_size=1000):
+    '''
+    Inserts `rows` (list of dicts with the same keys) into the table of `table_class`. When
+    a row with the same `key_columns` already exists, its `update_columns` are updated
+    instead; with no `update_columns` the existing row is left untouched (insert or ignore).
+    It relies on a unique index over `key_columns` and does not commit.
+
+    MySQL (ON DUPLICATE KEY UPDATE / INSERT IGNORE) and SQLite (ON CONFLICT) use native
+    upserts. Other databases look up the existing keys first and split the rows into
+    inserts and updates.
+    '''
+    if len(rows) < 1:
+        return
+    table   = table_class.__table__
+    dialect = db.session.bind.dialect.name
+
+    update_columns = list(update_columns or [])
+    if len(update_columns) > 0 and ('last_updated' in table.c) and ('last_updated' not in update_columns):
+        touch_last_updated = True    #onupdate defaults are not applied by native upserts
+    else:
+        touch_last_updated = False
+
+    if dialect in ('mysql', 'sqlite'):
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        for idx in range(0, len(rows), chunk_size):
+            stmt = insert(table).values(rows[idx:idx+chunk_size])
+            if dialect == 'mysql':
+                new_values = {column:stmt.inserted[column] for column in update_columns}
+            else:
+                new_values = {column:stmt.excluded[column] for column in update_columns}
+            if touch_last_updated:
+                new_values['last_updated'] = db.func.now()
+
+            if len(new_values) < 1:
+                stmt = stmt.prefix_with('IGNORE') if dialect == 'mysql' else stmt.on_conflict_do_nothing(index_elements=key_columns)
+            elif dialect == 'mysql':
+                stmt = stmt.on_duplicate_key_update(new_values)
+            else:
+                stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=new_values)
+            db.session.execute(stmt)
+        return
+
+    #-----generic fallback
+    first_key = table.c[key_columns[0]]
+    existing  = db.session.query(*[table.c[column] for column in key_columns], table.c.id).filter(
+                    first_key.in_(list({row[key_columns[0]] for row in rows}))).all()
+    existing  = {tuple(match[:-1]):match[-1] for match in existing}
+
+    new_rows     = []
+    updated_rows = []
+    for row in rows:
+        key = tuple(row[column] for column in key_columns)
+        if key not in existing:
+            new_rows.append(row)
+        elif len(update_columns) > 0:
+            updated_row = {column:row[column] for column in update_columns}
+            updated_row['id'] = existing[key]
+            updated_rows.append(updated_row)
+
+    if len(new_rows) > 0:
+        db.session.bulk_insert_mappings(table_class, new_rows)
+    if len(updated_rows) > 0:
+        db.session.bulk_update_mappings(table_class, updated_rows)
+
+class RateLimiter(object):
+    '''Thread-safe limiter that spaces out calls so that at most `rate` calls start per second'''
+    def __init__(self, rate=None):
+        self.interval   = 1.0 / rate if rate else 0.0
+        self._lock      = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_time       = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+def call_with_retries(function, *args, retries=3, backoff=1.0, rate_limiter=None, **kwargs):
+    '''Calls `function`, retrying up to `retries` times with exponential backoff (backoff, 2*backoff, ...)'''
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+def fetch_concurrently(function, items, max_workers=8, rate_limit=None, retries=3, backoff=1.0):
+    '''
+    Calls `function(item)` for every item through a bounded thread pool. Calls are
+    rate limited (`rate_limit` calls per second, unlimited if None) and retried with
+    exponential backoff when they raise.
+
+    Returns
+    -------
+    results: dict
+        Maps each item to the value returned by `function`
+    errors: dict
+        Maps each item that still failed after all the retries to its exception
+    '''
+    rate_limiter = RateLimiter(rate_limit)
+    results = {}
+    errors  = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(call_with_retries, function, item, retries=retries, backoff=backoff, rate_limiter=rate_limiter) : item
+            for item in items
+        }
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                errors[item] = e
+    return results, errors
+
+class FileCache(object):
+    '''
+    Simple on-disk cache of text content. Each key is stored in its own file inside
+    `folder` and it expires `ttl` seconds after it was written (never if `ttl` is None).
+    '''
+    def __init__(self, folder, ttl=None, suffix='.txt'):
+        self.folder = folder
+        self.ttl    = ttl
+        self.suffix = suffix
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, key):
+        safe_key = re.sub(r"[^a-zA-Z0-9_.\-]", "_", str(key))
+        return os.path.join(self.folder, f"{safe_key}{self.suffix}")
+
+    def get(self, key):
+        '''Returns the stored content or None if it does not exist or it has expired'''
+        path = self._path(key)
+        try:
+            if (self.ttl is not None) and (time.time() - os.path.getmtime(path) > self.ttl):
+                return None
+            with open(path, encoding='utf-8') as f_handler:
+                return f_handler.read()
+        except OSError:
+            return None
+
+    def set(self, key, content):
+        path     = self._path(key)
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f_handler:
+            f_handler.write(content)
+        os.replace(tmp_path, path)   #atomic, so readers never see a partially written file
+
+class HttpFetcher(object):
+    '''
+    Shared HTTP session for concurrent scraping. It limits the number of simultaneous 
+    requests to each host and can keep the raw responses in a FileCache.
+    '''
+    def __init__(self, max_per_host=2, timeout=20, cache=None):
+        self.max_per_host = max_per_host
+        self.timeout      = timeout
+        self.cache        = cache
+        self.session      = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, max_per_host))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_semaphores[host]
+
+    def get_text(self, url, cache_key=None):
+        '''Body of the response for `url`, from the cache when `cache_key` is given and still fresh'''
+        if (self.cache is not None) and (cache_key is not None):
+            content = self.cache.get(cache_key)
+            if content is not None:
+                return content
+
+        with self._get_semaphore(url):
+            r = self.session.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        content = r.text
+
+        if (self.cache is not None) and (cache_key is not None):
+            self.cache.set(cache_key, content)
+        return content
+
+def get_tipranks_url(ticker):
     base_url    = "https://www.tipranks.com/stocks/"
     url_section = "/dividends"
     url  = f"{base_url}{ticker}{url_section}"
+    return url
+
+def webscrape_tipranks(ticker, fetcher=None):
+    '''
+    Scrapes the latest dividend information of `ticker` from tipranks.com.
+    `fetcher` is an optional HttpFetcher (shared session and response cache).
+
+    Returns
+    -------
+    tuple
+        (ticker, div_str, div_amount, ex_div_date, payment_date, schedule_type). All but
+        `ticker` are None when no dividend information was found.
+    '''
+    url = get_tipranks_url(ticker)
     
     #==================
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'html5lib')
+    if fetcher is None:
+        html = requests.get(url).text
+    else:
+        html = fetcher.get_text(url, cache_key=ticker)
+    return parse_tipranks_dividends(ticker, html)
+
+#========Regex Patterns for tipranks dividend pages (compiled once)
+_float_pattern = r"\$([0-9]+.[0-9]+)"  #for values like $1.64, $0.78, etc
+_int_pattern   = r"\$([0-9]+)"         #for values like $2, $10, $1, etc (no decimal point)
+_negative_float_pattern = r"(?:\$[0-9]+.[0-9]+)"  #for values like $1.64, $0.78, etc
+_negative_int_pattern   = r"(?:\$[0-9]+)"         #for values like $2, $10, $1, etc (no decimal point)
+_months = r"(jan|feb|mar|apr|may|jun|july|aug|sep|oct|nov|dec)"
+
+DIV_AMOUNT_RE    = re.compile(f"{_float_pattern}|{_int_pattern}")
+SCHEDULE_TYPE_RE = re.compile(f"(?:{_negative_float_pattern}|{_negative_int_pattern})([a-z]+)\\s*")
+DATE_RE          = re.compile(f"({_months} ([0-9]+), ([0-9]+))")
+
+#used by the fast path to find the fundamentals block without building a document tree
+_FUNDAMENTALS_DIV_RE = re.compile(r"""<div\b[^>]*\bdata-s\s*=\s*["']?fundamentals(?=["'\s>])[^>]*>""", re.IGNORECASE)
+#comments, scripts and styles are matched whole, so a "</div>" inside them is not counted as a tag
+_DIV_TAG_RE          = re.compile(r"<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(?P<closing>/?)div\b[^>]*>", re.IGNORECASE | re.DOTALL)
+_COMMENT_RE          = re.compile(r"<!--.*?-->", re.DOTALL)
+_TAG_RE              = re.compile(r"<[^>]*>")
+
+def _extract_fundamentals_text(html):
+    '''
+    Fast path: scans the raw html for the first `div[data-s=fundamentals]` element, stops at
+    its matching closing tag and returns its text (like BeautifulSoup's `.text`).
+    Returns None if the element cannot be found or its closing tag is missing.
+    '''
+    start_match = _FUNDAMENTALS_DIV_RE.search(html)
+    if start_match is None:
+        return None
+
+    depth = 1
+    end = None
+    for tag_match in _DIV_TAG_RE.finditer(html, start_match.end()):
+        closing = tag_match.group('closing')
+        if closing is None:     #comment, script or style
+            continue
+        if closing:
+            depth -= 1
+            if depth == 0:
+                end = tag_match.start()
+                break
+        else:
+            depth += 1
+    if end is None:
+        return None     #unbalanced divs: the block cannot be delimited without the full parser
+
+    fragment = html[start_match.end():end]
+    fragment = _COMMENT_RE.sub('', fragment)
+    fragment = _TAG_RE.sub('', fragment)
+    return unescape(fragment)
+
+def _extract_fundamentals_text_html5lib(html):
+    '''Slow path: full html5lib document tree. Returns None if the element cannot be found'''
+    soup = BeautifulSoup(html, 'html5lib')
     fundamentals = soup.find_all('div', attrs={'data-s':'fundamentals'})
     
     try:
         item = fundamentals[0]
     except IndexError:
-        return ticker, None, None, None, None, None
-    
-    #========Regex Patterns
-    float_pattern = r"\$([0-9]+.[0-9]+)"  #for values like $1.64, $0.78, etc
-    int_pattern   = r"\$([0-9]+)"         #for values like $2, $10, $1, etc (no decimal point)
-    pattern       = f"{float_pattern}|{int_pattern}"
-    
-    negative_float_pattern = r"(?:\$[0-9]+.[0-9]+)"  #for values like $1.64, $0.78, etc
-    negative_int_pattern   = r"(?:\$[0-9]+)"         #for values like $2, $10, $1, etc (no decimal point)
-    schedule_type_pattern  = f"(?:{negative_float_pattern}|{negative_int_pattern})([a-z]+)\s*"
-    
-    months  = r"(jan|feb|mar|apr|may|jun|july|aug|sep|oct|nov|dec)"
-    date_pattern = f"({months} ([0-9]+), ([0-9]+))"
-    
-    ex_div_date_pattern  = f"(?:next ex-dividend date)\s*{date_pattern}"  #the ?: makes sure that the whole group inside the parenthesis is not captured
-    payment_date_pattern = f"(?:payment date)\s*{date_pattern}" 
-    
-    if item is not None:
-        str_item = item.text.lower()
-
-        res = re.search(pattern, str_item)
-        if res:
-            div_str    = res.group()
-            div_str    = div_str.replace("$", "")
-            div_amount = decimal.Decimal(div_str)
-            
-            #_str_ex_div_date = re.search(ex_div_date_pattern, str_item).groups()[0]  #first item   #date comes in format: Dec 15, 2021
-            
-            dates = re.findall(date_pattern, str_item)
-            _str_ex_div_date = dates[0][0]
-            _str_pay_date    = dates[1][0]
-            
-            ex_div_date   = datetime.strptime(_str_ex_div_date, "%b %d, %Y")    #datetime.strptime('Jun 1, 2005  1:33PM', '%b %d, %Y %I:%M%p')
-            payment_date  = datetime.strptime(_str_pay_date, "%b %d, %Y")
-            schedule_type = re.search(schedule_type_pattern, str_item).groups()[0].strip()
+        return None
+    return item.text
+
+def _parse_fundamentals_text(ticker, str_item):
+    div_str, div_amount, ex_div_date, payment_date, schedule_type = None, None, None, None, None
+    str_item = str_item.lower()
+
+    res = DIV_AMOUNT_RE.search(str_item)
+    if res:
+        div_str    = res.group()
+        div_str    = div_str.replace("$", "")
+        div_amount = decimal.Decimal(div_str)
+        
+        dates = DATE_RE.findall(str_item)    #date comes in format: Dec 15, 2021
+        _str_ex_div_date = dates[0][0]
+        _str_pay_date    = dates[1][0]
+        
+        ex_div_date   = datetime.strptime(_str_ex_div_date, "%b %d, %Y")    #datetime.strptime('Jun 1, 2005  1:33PM', '%b %d, %Y %I:%M%p')
+        payment_date  = datetime.strptime(_str_pay_date, "%b %d, %Y")
+        schedule_type = SCHEDULE_TYPE_RE.search(str_item).groups()[0].strip()
             
-        return ticker, div_str, div_amount, ex_div_date, payment_date, schedule_type
+    return ticker, div_str, div_amount, ex_div_date, payment_date, schedule_type
+
+def parse_tipranks_dividends(ticker, html, parser='fast'):
+    '''
+    Extracts the dividend information from the html of a tipranks dividends page. See `webscrape_tipranks`.
+
+    Parameters
+    ----------
+    ticker: str
+    html: str
+        Raw html of the page
+    parser: str
+        'fast' scans the raw html for the fundamentals block only and falls back to the
+        full parser when the block is not found or its text cannot be parsed. A block
+        without a dividend amount is a valid "no dividend" result. 'html5lib' always builds
+        the full document tree.
+    '''
+    if parser == 'fast':
+        str_item = _extract_fundamentals_text(html)
+        if str_item is not None:
+            try:
+                return _parse_fundamentals_text(ticker, str_item)
+            except (IndexError, AttributeError, ValueError, decimal.InvalidOperation):
+                pass   #unexpected layout of the fragment; let the full parser try
+
+    str_item = _extract_fundamentals_text_html5lib(html)
+    if str_item is None:
+        return ticker, None, None, None, None, None
+    return _parse_fundamentals_text(ticker, str_item)
 
 def write_table_to_csv(db, table='transactions', output_file=''):
     TABLE_MAP = {
@@ -297,6 +608,120 @@ def write_table_to_csv(db, table='transactions', output_file=''):
         df = df.replace({'symbol_id':ids_to_tickers_dict})
     df.to_csv(output_file,)
 
+#tables that can be browsed from the /check_entries page (keys are the choices of CheckEntryForm)
+CHECK_ENTRIES_TABLES = {
+    '0' : Security,
+    '1' : Transaction,
+    '2' : Broker,
+    '3' : CryptoCurrency,
+    '4' : CryptoWallet,
+    '5' : Event,
+    '6' : Position,
+    '7' : Dividend,
+}
+
+def _get_date_column(table_class):
+    '''Column used by the date filters of `query_table_page`'''
+    DATE_COLUMNS = {
+        Transaction : Transaction.time_execution,
+        Event       : Event.event_date,
+        Dividend    : Dividend.exdividend_date,
+    }
+    return DATE_COLUMNS.get(table_class, table_class.last_updated)
+
+def query_table_page(db, table_class, num_rows=None, before_id=None, after_id=None,
+                     columns=None, symbol=None, broker=None, date_from=None, date_to=None):
+    '''
+    Reads one page of rows from the table of `table_class` using keyset (id-based) paging.
+    Column projection, filters, ordering and limits are all done by the database.
+
+    Parameters
+    ----------
+    db: Flask-SQLAlchemy handle
+    table_class: db.Model
+        One of the models in `CHECK_ENTRIES_TABLES`
+    num_rows: int or None
+        Rows per page. None reads every row that matches the filters
+    before_id: int or None
+        Read the page of rows older than this id
+    after_id: int or None
+        Read the page of rows newer than this id. Without `before_id` or `after_id` the
+        latest page is returned
+    columns: list of str or None
+        Columns to read (unknown names are ignored). `id` is always included
+    symbol: str or None
+        Only rows of this security (tables with a `symbol_id` column, or the securities table)
+    broker: str or None
+        Only rows of this broker (transactions and brokers tables)
+    date_from, date_to: datetime, date or None
+        Only rows whose date column (see `_get_date_column`) falls in [date_from, date_to]. A
+        `date_to` without time (a `date`) includes the whole day
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        Rows of the page sorted by ascending id
+    has_older: bool
+        Whether there are rows older than this page
+    has_newer: bool
+        Whether there are rows newer than this page
+    '''
+    table = table_class.__table__
+    if columns:
+        selected = ['id'] + [column for column in columns if column in table.c and column != 'id']
+    else:
+        selected = [column.name for column in table.c]
+    query = db.session.query(*[table.c[column] for column in selected])
+
+    #-----filters
+    if symbol:
+        symbol = symbol.strip().lower()
+        if table_class is Security:
+            query = query.filter(Security.symbol==symbol)
+        elif 'symbol_id' in table.c:
+            symbol_id = db.session.query(Security.id).filter(Security.symbol==symbol).scalar_subquery()
+            query = query.filter(table.c.symbol_id==symbol_id)
+    if broker:
+        from table_updaters import get_broker_name     #table_updaters imports this module
+        broker = get_broker_name(broker.strip().lower())
+        if table_class is Broker:
+            query = query.filter(Broker.name==broker)
+        elif 'broker_id' in table.c:
+            broker_id = db.session.query(Broker.id).filter(Broker.name==broker).scalar_subquery()
+            query = query.filter(table.c.broker_id==broker_id)
+    if (date_from is not None) or (date_to is not None):
+        date_column = _get_date_column(table_class)
+        if date_from is not None:
+            query = query.filter(date_column >= (date_from if isinstance(date_from, datetime) else datetime.combine(date_from, datetime.min.time())))
+        if isinstance(date_to, datetime):
+            query = query.filter(date_column <= date_to)
+        elif date_to is not None:
+            query = query.filter(date_column < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+
+    #-----keyset paging
+    if after_id is not None:
+        query = query.filter(table.c.id > after_id).order_by(table.c.id.asc())
+    else:
+        if before_id is not None:
+            query = query.filter(table.c.id < before_id)
+        query = query.order_by(table.c.id.desc())
+
+    if num_rows is not None:
+        query = query.limit(num_rows + 1)   #the extra row tells if there is another page
+
+    df = pd.read_sql(sql=query.statement,con=db.session.bind)
+    has_more = (num_rows is not None) and (len(df) > num_rows)
+    if has_more:
+        df = df.iloc[:num_rows]
+
+    if after_id is not None:
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, before_id is not None
+        df = df.iloc[::-1]
+
+    return df.reset_index(drop=True), has_older, has_newer
+
 def get_mysql_uri(config_file='mysql_config.yml', database_name=None):
     with open(config_file) as f_handler:
         config = yaml.safe_load(f_handler)
@@ -315,10 +740,13 @@ def exists_in_table(new_entry, db):
     match = False
 
     if isinstance(new_entry, Security):
-        match = db.session.query(table_class).fitler(table_class.symbol==new_entry.symbol).first()
+        match = db.session.query(table_class).filter(table_class.symbol==new_entry.symbol).first()
     elif isinstance(new_entry, Broker):
         pass
 
+    elif isinstance(new_entry, Transaction) and new_entry.content_hash is not None:
+        match = db.session.query(table_class.id).filter(table_class.content_hash==new_entry.content_hash).first()
+
     elif isinstance(new_entry, Transaction):
         match = db.session.query(table_class).filter(
             table_class.symbol_id==new_entry.symbol_id,
@@ -0,0 +1,308 @@
+'''
+Daily market value of the portfolio, as a whole and per symbol.
+
+The engine keeps two dates x symbols matrices (one row per calendar day, one column per
+symbol): the number of shares held at the end of each day and the closing price of that
+day. Shares are expressed in today's units (adjusted for every split), so they can be
+multiplied directly with split-adjusted closing prices. Prices of days without trading
+(weekends, holidays) are carried forward from the previous close.
+
+Prices come from the local price store (`price_store.py`), so no network call is made.
+Updates are incremental: a new day appends rows, new transactions only add to the rows
+from their execution date on, and a new or corrected split rebuilds the column of that
+symbol alone.
+'''
+import threading
+
+import numpy as np
+import pandas as pd
+
+from models import Transaction, Event
+from tools import get_transactions_df, get_split_events_df, get_id_to_symbol_dict
+from split_engine import adjust_transactions
+from price_store import get_price_store
+
+#prices are requested a few days before the first date, so it can start on a weekend or holiday
+PRICE_LOOKBACK_DAYS = 7
+
+
+class ValuationEngine(object):
+    '''
+    Parameters
+    ----------
+    price_loader: callable
+        `price_loader(symbols, start, end)` returns a DataFrame of split-adjusted closing
+        prices, indexed by date and with one column per symbol (missing symbols or dates
+        are allowed)
+    price_fingerprint: callable, optional
+        Returns a value that changes whenever the prices behind `price_loader` change (i.e.
+        `PriceStore.fingerprint`). The price matrix is reloaded by `sync` when it does
+    '''
+    def __init__(self, price_loader, price_fingerprint=None):
+        self.price_loader = price_loader
+        self.price_fingerprint = price_fingerprint
+        self.dates        = pd.DatetimeIndex([])
+        self.symbol_ids   = []
+        self.symbols      = []
+        self.shares       = np.zeros((0,0), dtype=np.float64)
+        self.prices       = np.zeros((0,0), dtype=np.float64)
+        self.last_transaction_id = None
+        self.last_split_id       = None
+        self.last_split_update   = None
+        self.is_built     = False
+        self._price_version = None
+        self._columns     = {}
+        self._pending     = _empty_pending()
+
+    #---------------------------------------------------------------
+    #   Building
+    #---------------------------------------------------------------
+    def build(self, db, end=None):
+        '''Computes both matrices from the full transaction and split history'''
+        end       = _to_day(end)
+        trans_df  = get_transactions_df(db)
+        splits_df = get_split_events_df(db)
+        id_to_symbol = get_id_to_symbol_dict(db)
+
+        self.symbol_ids = sorted(int(symbol_id) for symbol_id in trans_df['symbol_id'].unique())
+        self.symbols    = [id_to_symbol[symbol_id] for symbol_id in self.symbol_ids]
+        self._columns   = {symbol_id:idx for idx, symbol_id in enumerate(self.symbol_ids)}
+
+        if len(trans_df) > 0:
+            start = pd.Timestamp(trans_df['time_execution'].min()).normalize()
+            self.dates = pd.date_range(start, max(start, end), freq='D')
+        else:
+            self.dates = pd.DatetimeIndex([])
+
+        self.shares   = np.zeros((len(self.dates), len(self.symbol_ids)), dtype=np.float64)
+        self._pending = _empty_pending()
+        self._add_transactions(trans_df, splits_df)
+        self._price_version = self._get_price_version()
+        self.prices = self._load_prices(self.symbols, self.dates)
+
+        self.last_transaction_id = db.session.query(db.func.max(Transaction.id)).scalar()
+        self.last_split_id, self.last_split_update = self._get_split_marks(db)
+        self.is_built = True
+        return self
+
+    def _add_transactions(self, trans_df, splits_df):
+        '''Adds the split-adjusted shares of `trans_df` to the rows from each execution date on'''
+        if len(trans_df) < 1:
+            return
+        adjusted = adjust_transactions(trans_df, splits_df)
+        self._add_adjusted(adjusted[['symbol_id','time_execution','adjusted_shares']])
+
+    def _add_adjusted(self, adjusted):
+        days    = ((pd.to_datetime(adjusted['time_execution']).dt.normalize() - self.dates[0]).dt.days).to_numpy()
+        columns = np.array([self._columns[symbol_id] for symbol_id in adjusted['symbol_id']], dtype=np.int64)
+
+        #transactions dated after the last row wait until that day is appended
+        in_range = days < len(self.dates)
+        if not in_range.all():
+            self._pending = pd.concat([self._pending, adjusted[~in_range]], ignore_index=True)
+        days = days[in_range]
+        if len(days) < 1:
+            return
+        first_day = days.min()
+
+        deltas = np.zeros((len(self.dates) - first_day, len(self.symbol_ids)), dtype=np.float64)
+        np.add.at(deltas, (days - first_day, columns[in_range]), adjusted['adjusted_shares'].to_numpy()[in_range])
+        self.shares[first_day:] += np.cumsum(deltas, axis=0)
+
+    def _load_prices(self, symbols, dates):
+        prices = np.full((len(dates), len(symbols)), np.nan, dtype=np.float64)
+        if len(dates) < 1 or len(symbols) < 1:
+            return prices
+
+        price_df = self.price_loader(symbols, dates[0] - pd.Timedelta(days=PRICE_LOOKBACK_DAYS), dates[-1])
+        if price_df is None or len(price_df) < 1:
+            return prices
+        price_df = price_df.reindex(columns=symbols)
+        price_df.index = pd.to_datetime(price_df.index).normalize()
+        price_df = price_df[~price_df.index.duplicated(keep='last')]
+        price_df = price_df.reindex(price_df.index.union(dates)).ffill().reindex(dates)
+        return price_df.to_numpy(dtype=np.float64)
+
+    def _get_price_version(self):
+        return self.price_fingerprint() if self.price_fingerprint is not None else None
+
+    def _get_split_marks(self, db):
+        '''(highest id, latest `last_updated`) of the split events: new and corrected splits'''
+        return tuple(db.session.query(db.func.max(Event.id), db.func.max(Event.last_updated)).filter(
+                    Event.event_type.in_(('split','reverse_split'))).one())
+
+    #---------------------------------------------------------------
+    #   Incremental updates
+    #---------------------------------------------------------------
+    def append_days(self, end=None):
+        '''Appends one row per day until `end` (default: today). Shares are carried forward'''
+        end = _to_day(end)
+        if len(self.dates) < 1 or end <= self.dates[-1]:
+            return
+        new_dates = pd.date_range(self.dates[-1] + pd.Timedelta(days=1), end, freq='D')
+
+        new_shares = np.repeat(self.shares[-1:], len(new_dates), axis=0)
+        new_prices = self._load_prices(self.symbols, self.dates[-1:].append(new_dates))[1:]
+        #symbols without a new price keep their last known close
+        missing = np.isnan(new_prices)
+        if missing.any():
+            filled = pd.DataFrame(np.vstack([self.prices[-1:], new_prices])).ffill().to_numpy()[1:]
+            new_prices[missing] = filled[missing]
+
+        self.dates  = self.dates.append(new_dates)
+        self.shares = np.vstack([self.shares, new_shares])
+        self.prices = np.vstack([self.prices, new_prices])
+
+        if len(self._pending) > 0:
+            pending, self._pending = self._pending, _empty_pending()
+            self._add_adjusted(pending)
+
+    def _add_columns(self, db, symbol_ids):
+        id_to_symbol = get_id_to_symbol_dict(db)
+        new_ids      = [symbol_id for symbol_id in symbol_ids if symbol_id not in self._columns]
+        if len(new_ids) < 1:
+            return
+        new_symbols = [id_to_symbol[symbol_id] for symbol_id in new_ids]
+        for symbol_id in new_ids:
+            self._columns[symbol_id] = len(self.symbol_ids)
+            self.symbol_ids.append(symbol_id)
+        self.symbols = self.symbols + new_symbols
+
+        self.shares = np.hstack([self.shares, np.zeros((len(self.dates), len(new_ids)), dtype=np.float64)])
+        self.prices = np.hstack([self.prices, self._load_prices(new_symbols, self.dates)])
+
+    def apply_transactions(self, db, trans_df):
+        '''
+        Adds new transactions (columns as in `tools.get_transactions_df`). Only the rows from
+        the earliest execution date on are touched. Returns False if a transaction is older
+        than the first row, in which case the engine must be rebuilt.
+        '''
+        if len(trans_df) < 1:
+            return True
+        if len(self.dates) < 1 or pd.Timestamp(trans_df['time_execution'].min()).normalize() < self.dates[0]:
+            return False
+
+        self._add_columns(db, [int(symbol_id) for symbol_id in trans_df['symbol_id'].unique()])
+        splits_df = get_split_events_df(db, trans_df['symbol_id'].unique().tolist())
+        self._add_transactions(trans_df, splits_df)
+        return True
+
+    def rebuild_column(self, db, symbol_id):
+        '''
+        Recomputes shares and prices of one symbol, i.e. after a new split changed its history.
+        Returns False (and does nothing) when the symbol has no column yet.
+        '''
+        if symbol_id not in self._columns:
+            return False
+        col       = self._columns[symbol_id]
+        trans_df  = get_transactions_df(db, [symbol_id])
+        splits_df = get_split_events_df(db, [symbol_id])
+
+        self.shares[:, col] = 0
+        self._pending = self._pending[self._pending['symbol_id'] != symbol_id]
+        self._add_transactions(trans_df, splits_df)
+        self.prices[:, col] = self._load_prices([self.symbols[col]], self.dates)[:, 0]
+        return True
+
+    def sync(self, db, end=None):
+        '''
+        Brings the engine up to date with the database: rebuilds the columns of symbols with
+        new or updated splits (i.e. a corrected `split_factor`, which keeps its id), applies
+        transactions stored since the last sync and appends the missing days. Prices are
+        reloaded when `price_fingerprint` changed (i.e. history backfilled into the price
+        store). Everything is rebuilt only on the first call or when a
+        transaction is back-dated to before the first row.
+        '''
+        if not self.is_built:
+            return self.build(db, end)
+
+        trans_query = db.session.query(
+                        Transaction.id,
+                        Transaction.symbol_id,
+                        Transaction.time_execution,
+                        Transaction.num_shares,
+                        Transaction.cost_basis,
+                        )
+        #transactions are only ever inserted, so the highest id seen is the high-water mark
+        if self.last_transaction_id is not None:
+            trans_query = trans_query.filter(Transaction.id > self.last_transaction_id)
+        new_trans_df = pd.read_sql(sql=trans_query.statement, con=db.session.bind)
+
+        #new splits raise the highest id; corrected ones (upserted in place) raise `last_updated`
+        rebuilt_ids = set()
+        last_split_id, last_split_update = self._get_split_marks(db)
+        if (last_split_id, last_split_update) != (self.last_split_id, self.last_split_update):
+            changed = Event.id > self.last_split_id if self.last_split_id is not None else Event.id.isnot(None)
+            if self.last_split_update is not None:
+                #`>=`: `last_updated` has second resolution, so an update in the same second as
+                #the previous mark is not missed (at worst a column is rebuilt twice)
+                changed = changed | (Event.last_updated >= self.last_split_update)
+            split_query = db.session.query(Event.symbol_id).filter(Event.event_type.in_(('split','reverse_split')), changed)
+            for (symbol_id,) in split_query.distinct().all():
+                #symbols without a column yet get one (with the split applied) from their new transactions
+                if self.rebuild_column(db, symbol_id):
+                    rebuilt_ids.add(symbol_id)
+            self.last_split_id, self.last_split_update = last_split_id, last_split_update
+
+        self.append_days(end)
+
+        if len(new_trans_df) > 0:
+            #rebuilt columns already include their new transactions
+            if not self.apply_transactions(db, new_trans_df[~new_trans_df['symbol_id'].isin(rebuilt_ids)]):
+                return self.build(db, end)
+            self.last_transaction_id = int(new_trans_df['id'].max())
+
+        price_version = self._get_price_version()
+        if price_version != self._price_version:
+            self.prices = self._load_prices(self.symbols, self.dates)
+            self._price_version = price_version
+        return self
+
+    #---------------------------------------------------------------
+    #   Results
+    #---------------------------------------------------------------
+    def values(self):
+        '''Market value of each symbol (dates x symbols). Days without a known price are NaN'''
+        return self.shares * self.prices
+
+    def symbol_values(self):
+        return pd.DataFrame(self.values(), index=self.dates, columns=self.symbols)
+
+    def shares_frame(self):
+        return pd.DataFrame(self.shares, index=self.dates, columns=self.symbols)
+
+    def portfolio_series(self):
+        '''Total market value per day (symbols without a known price count as 0)'''
+        return pd.Series(np.nansum(self.values(), axis=1), index=self.dates, name='market_value')
+
+
+def _empty_pending():
+    return pd.DataFrame({'symbol_id':pd.Series(dtype=np.int64),
+                         'time_execution':pd.Series(dtype='datetime64[ns]'),
+                         'adjusted_shares':pd.Series(dtype=np.float64)})
+
+def _to_day(date):
+    if date is None:
+        return pd.Timestamp.utcnow().tz_localize(None).normalize()
+    return pd.Timestamp(date).normalize()
+
+
+_engine_lock = threading.Lock()
+_engine      = None
+
+def get_valuation_engine(db, price_loader=None, end=None):
+    '''
+    Shared engine of the process, synced with the database on every call (a sync without
+    changes costs two small queries). Prices are read from the local price store, and
+    reloaded when it is written to, unless a different `price_loader` is given, which
+    starts a new engine.
+    '''
+    global _engine
+    price_fingerprint = None
+    if price_loader is None:
+        price_loader      = get_price_store().close_frame
+        price_fingerprint = get_price_store().fingerprint
+    with _engine_lock:
+        if (_engine is None) or (_engine.price_loader != price_loader):
+            _engine = ValuationEngine(price_loader, price_fingerprint)
+        return _engine.sync(db, end)